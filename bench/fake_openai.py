@@ -0,0 +1,106 @@
+"""本地的 OpenAI Chat Completions 替身伺服器 (離線壓測用)
+
+只實作 POST /v1/chat/completions：可設定首個 token 前的延遲、每秒產生的 token 數、回應長度與錯誤率，
+支援 stream=True 的 SSE 格式與 stream_options.include_usage。
+"""
+import asyncio
+import json
+import time
+import random
+import socket
+import itertools
+
+from aiohttp import web
+
+# 用來組成假回應的詞彙 (中英混合，讓 token 估算與切割邏輯都有機會被觸發)
+_WORDS = ("測試", "回應", "效能", "token", "stream", "資料庫", "延遲", "throughput", "頻道", "訊息")
+
+
+class FakeOpenAIServer:
+    """以 aiohttp 執行的假補全伺服器；start() 之後以 base_url 提供給 OpenAI 用戶端"""
+
+    def __init__(self, latency_ms: float = 300, token_rate: float = 50, reply_tokens: int = 120,
+                 error_rate: float = 0.0, host: str = "127.0.0.1", port: int = 0, seed: int = 0):
+        self.latency = latency_ms / 1000
+        self.token_rate = token_rate
+        self.reply_tokens = reply_tokens
+        self.error_rate = error_rate
+        self.host = host
+        self.port = port
+        self._random = random.Random(seed)
+        self._ids = itertools.count(1)
+        self._runner = None
+        self.requests = 0
+        self.errors = 0
+
+    @property
+    def base_url(self) -> str:
+        return f"http://{self.host}:{self.port}/v1"
+
+    async def start(self) -> "FakeOpenAIServer":
+        app = web.Application()
+        app.router.add_post("/v1/chat/completions", self._handle_completion)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        # 自行綁定 socket，port 為 0 時可取回系統指派的連接埠
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind((self.host, self.port))
+        self.port = sock.getsockname()[1]
+        await web.SockSite(self._runner, sock).start()
+        return self
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    def _reply_words(self) -> list:
+        return [self._random.choice(_WORDS) for _ in range(self.reply_tokens)]
+
+    def _token_delay(self) -> float:
+        return 1 / self.token_rate if self.token_rate > 0 else 0.0
+
+    async def _handle_completion(self, request: web.Request) -> web.StreamResponse:
+        self.requests += 1
+        body = await request.json()
+        if self.error_rate and self._random.random() < self.error_rate:
+            self.errors += 1
+            return web.json_response({"error": {"message": "injected failure", "type": "server_error"}}, status=500)
+
+        completion_id = f"chatcmpl-fake-{next(self._ids)}"
+        model = body.get("model", "gpt-fake")
+        prompt_tokens = sum(len(str(m.get("content", ""))) // 4 + 4 for m in body.get("messages", []))
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": self.reply_tokens,
+                 "total_tokens": prompt_tokens + self.reply_tokens}
+        await asyncio.sleep(self.latency)
+
+        if not body.get("stream"):
+            await asyncio.sleep(self.reply_tokens * self._token_delay())
+            return web.json_response({
+                "id": completion_id, "object": "chat.completion", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(self._reply_words())},
+                             "finish_reason": "stop"}],
+                "usage": usage
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream", "Cache-Control": "no-cache"})
+        await response.prepare(request)
+
+        def chunk(choices: list, **extra) -> bytes:
+            payload = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                       "model": model, "choices": choices, **extra}
+            return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8")
+
+        delay = self._token_delay()
+        await response.write(chunk([{"index": 0, "delta": {"role": "assistant", "content": ""}, "finish_reason": None}]))
+        for word in self._reply_words():
+            if delay:
+                await asyncio.sleep(delay)
+            await response.write(chunk([{"index": 0, "delta": {"content": word}, "finish_reason": None}]))
+        await response.write(chunk([{"index": 0, "delta": {}, "finish_reason": "stop"}]))
+        if (body.get("stream_options") or {}).get("include_usage"):
+            await response.write(chunk([], usage=usage))
+        await response.write(b"data: [DONE]\n\n")
+        await response.write_eof()
+        return response
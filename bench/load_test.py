@@ -0,0 +1,291 @@
+"""離線壓力測試：以假的 Discord 訊息驅動 ChatGPTCog.on_message，上游改接本地的假 OpenAI 伺服器
+
+不需要網路、Discord Token 或 OpenAI API Key；資料庫使用暫存目錄中的 SQLite。
+報告每秒處理訊息數、端到端延遲的 p50/p95/p99、事件迴圈延遲與資料庫寫入次數，
+並可用 --max-p95-ms / --min-throughput 作為部署前的回歸門檻 (未達標時以結束碼 1 離開)。
+
+用法 (於專案根目錄)：
+    python bench/load_test.py --messages 2000 --users 300 --channels 20 --rate 100
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Optional
+from unittest.mock import AsyncMock, MagicMock
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+import discord  # noqa: E402
+
+from bench.fake_openai import FakeOpenAIServer  # noqa: E402
+from cogs.utils import db_manager, metrics  # noqa: E402
+
+GUILD_ID = 900000000000000000
+CHANNEL_ID_BASE = 910000000000000000
+USER_ID_BASE = 920000000000000000
+
+
+class LoopLagMonitor:
+    """週期性地睡眠固定時間，量測實際醒來比預期晚了多久 (事件迴圈被阻塞的程度)"""
+
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.samples: list = []
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - expected))
+
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class FakeDiscord:
+    """產生通過 on_message 篩選所需的最小 discord.Message 替身，並可模擬 Discord API 的延遲"""
+
+    def __init__(self, api_latency: float = 0.0):
+        self.api_latency = api_latency
+        self.bot_user = MagicMock(spec=discord.ClientUser)
+        self.guild = MagicMock(spec=discord.Guild)
+        self.guild.id = GUILD_ID
+        self.api_calls = 0
+        self._message_ids = iter(range(930000000000000000, 10 ** 19))
+
+    async def _api_call(self, *args, **kwargs):
+        self.api_calls += 1
+        if self.api_latency:
+            await asyncio.sleep(self.api_latency)
+        return self._sent_message()
+
+    def _sent_message(self):
+        sent = MagicMock(spec=discord.Message)
+        sent.edit = AsyncMock(side_effect=self._api_call)
+        return sent
+
+    def channel(self, index: Optional[int]):
+        """index 為 None 時產生私訊頻道，否則為伺服器中的文字頻道"""
+        if index is None:
+            channel = MagicMock(spec=discord.DMChannel)
+            channel.id = next(self._message_ids)
+        else:
+            channel = MagicMock(spec=discord.TextChannel)
+            channel.id = CHANNEL_ID_BASE + index
+            channel.guild = self.guild
+        channel.send = AsyncMock(side_effect=self._api_call)
+        return channel
+
+    def author(self, index: int):
+        author = MagicMock(spec=discord.User)
+        author.id = USER_ID_BASE + index
+        author.bot = False
+        return author
+
+    def message(self, author, channel, content: str):
+        message = MagicMock(spec=discord.Message)
+        message.id = next(self._message_ids)
+        message.author = author
+        message.channel = channel
+        message.guild = None if isinstance(channel, discord.DMChannel) else self.guild
+        message.content = content
+        message.attachments = []
+        message.reply = AsyncMock(side_effect=self._api_call)
+        message.add_reaction = AsyncMock(side_effect=self._api_call)
+        message.remove_reaction = AsyncMock(side_effect=self._api_call)
+        return message
+
+
+def build_config(args, base_url: str) -> dict:
+    with open(ROOT / "config.json", "r", encoding="utf-8") as f:
+        config = json.load(f)
+    config["openai"] = {**config.get("openai", {}), "base_url": base_url}
+    config["streaming"] = {**config.get("streaming", {}), "enabled": not args.no_stream}
+    config["summarization"] = {**config.get("summarization", {}), "enabled": not args.no_summary}
+    config["metrics"] = {**config.get("metrics", {}), "http_enabled": False}
+    if args.no_coalesce:
+        config["coalesce"] = {**config.get("coalesce", {}), "window_ms": 0}
+    if not args.keep_limits:
+        # 壓測的目的是量測處理能力，預設放寬每位使用者/伺服器的速率限制
+        config["scheduler"] = {**config.get("scheduler", {}), "user_rate": 1000, "user_burst": 1000,
+                               "guild_rate": 100000, "guild_burst": 100000, "max_queue_dm": 100000,
+                               "max_queue_channel": 100000, "max_queue_per_flow": 100000, "max_wait": 0}
+    return config
+
+
+async def run(args) -> dict:
+    from cogs.chatgpt import ChatGPTCog
+
+    server = await FakeOpenAIServer(args.latency_ms, args.token_rate, args.reply_tokens,
+                                    args.error_rate, seed=args.seed).start()
+    os.environ.setdefault("OPENAI_API_KEY", "sk-bench")
+    fake = FakeDiscord(args.discord_latency_ms / 1000)
+    bot = SimpleNamespace(config=build_config(args, server.base_url), user=fake.bot_user, command_prefix="!")
+    bot.get_cog = lambda name: None
+    cog = ChatGPTCog(bot)
+    await cog.cog_load()
+    cog.listened_channel_ids_cache.update(CHANNEL_ID_BASE + index for index in range(args.channels))
+
+    # 以合併後送出的批次為單位量測：批次完成時，其中每則訊息的延遲 = 完成時間 - 該訊息送達時間
+    arrived: dict = {}
+    latencies: list = []
+    completed = asyncio.Event()
+    finished_at = [0.0]
+    dispatch = cog._dispatch_messages
+
+    async def timed_dispatch(messages: list):
+        done = await dispatch(messages)
+
+        def record(_):
+            now = time.perf_counter()
+            for message in messages:
+                latencies.append(now - arrived.pop(message.id))
+            finished_at[0] = now
+            if len(latencies) >= args.messages:
+                completed.set()
+        done.add_done_callback(record)
+        return done
+    cog._dispatch_messages = timed_dispatch
+
+    rng = random.Random(args.seed)
+    authors = [fake.author(index) for index in range(args.users)]
+    dm_channels = {}
+    guild_channels = [fake.channel(index) for index in range(args.channels)]
+    lag = LoopLagMonitor()
+    lag.start()
+    commits_before = db_manager.write_stats["commits"]
+    rows_before = db_manager.write_stats["history_rows_flushed"]
+
+    started = time.perf_counter()
+    for sequence in range(args.messages):
+        user_index = rng.randrange(args.users)
+        if rng.random() < args.dm_ratio or not guild_channels:
+            channel = dm_channels.get(user_index) or dm_channels.setdefault(user_index, fake.channel(None))
+        else:
+            channel = rng.choice(guild_channels)
+        message = fake.message(authors[user_index], channel, f"壓測訊息 #{sequence}：請簡短回答第 {rng.randrange(10 ** 6)} 個問題。")
+        arrived[message.id] = time.perf_counter()
+        await cog.on_message(message)
+        if args.rate > 0:
+            await asyncio.sleep(rng.expovariate(args.rate))
+
+    try:
+        await asyncio.wait_for(completed.wait(), timeout=args.timeout)
+    except asyncio.TimeoutError:
+        print(f"⚠️ 等待逾時：{len(arrived)} 則訊息在 {args.timeout}s 內沒有完成", file=sys.stderr)
+    await db_manager.flush_history()
+    elapsed = (finished_at[0] or time.perf_counter()) - started
+    await lag.stop()
+
+    result = {
+        "messages": args.messages,
+        "completed": len(latencies),
+        "elapsed_s": elapsed,
+        "throughput_msgs_per_s": len(latencies) / elapsed if elapsed > 0 else 0.0,
+        "latency_ms": {name: percentile(latencies, q) * 1000 for name, q in (("p50", 0.5), ("p95", 0.95), ("p99", 0.99))},
+        "loop_lag_ms": {"p99": percentile(lag.samples, 0.99) * 1000, "max": max(lag.samples, default=0.0) * 1000},
+        "db": {"commits": db_manager.write_stats["commits"] - commits_before,
+               "history_rows_flushed": db_manager.write_stats["history_rows_flushed"] - rows_before},
+        "scheduler": dict(cog.scheduler.stats),
+        "upstream": {"requests": server.requests, "injected_errors": server.errors},
+        "discord_api_calls": fake.api_calls,
+        "requests": {dict(key).get("outcome"): int(value) for key, value in metrics.REQUESTS.values.items()},
+        "stages_p95_ms": {
+            stage: metrics.STAGE_SECONDS.quantile(0.95, stage=stage) * 1000
+            for stage in metrics.STAGE_SECONDS.label_values("stage")
+        }
+    }
+
+    await cog.cog_unload()
+    await server.stop()
+    return result
+
+
+def print_report(result: dict):
+    latency, lag = result["latency_ms"], result["loop_lag_ms"]
+    print(f"完成訊息     {result['completed']}/{result['messages']} ({result['elapsed_s']:.2f}s)")
+    print(f"吞吐量       {result['throughput_msgs_per_s']:.1f} msgs/s")
+    print(f"端到端延遲   p50 {latency['p50']:.0f}ms  p95 {latency['p95']:.0f}ms  p99 {latency['p99']:.0f}ms")
+    print(f"事件迴圈延遲 p99 {lag['p99']:.1f}ms  max {lag['max']:.1f}ms")
+    print(f"資料庫       {result['db']['commits']} 次提交，寫入 {result['db']['history_rows_flushed']} 筆聊天紀錄")
+    print(f"上游請求     {result['upstream']['requests']} 次 (注入錯誤 {result['upstream']['injected_errors']})")
+    print(f"Discord API  {result['discord_api_calls']} 次呼叫")
+    print(f"請求結果     {result['requests']}")
+    print(f"排程器       {result['scheduler']}")
+    for stage, value in sorted(result["stages_p95_ms"].items()):
+        print(f"  {stage:<20} p95 {value:.0f}ms")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="ChatGPTCog 離線壓力測試")
+    parser.add_argument("--messages", type=int, default=1000, help="總訊息數")
+    parser.add_argument("--users", type=int, default=200, help="模擬的使用者數")
+    parser.add_argument("--channels", type=int, default=10, help="模擬的監聽頻道數")
+    parser.add_argument("--dm-ratio", type=float, default=0.3, help="私訊所占比例 (0~1)")
+    parser.add_argument("--rate", type=float, default=50.0, help="平均每秒送達的訊息數 (Poisson)；0 表示一次全部送出")
+    parser.add_argument("--latency-ms", type=float, default=300.0, help="假 OpenAI 首個 token 前的延遲")
+    parser.add_argument("--token-rate", type=float, default=80.0, help="假 OpenAI 每秒產生的 token 數；0 表示不限速")
+    parser.add_argument("--reply-tokens", type=int, default=120, help="每則回應的 token 數")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="上游回傳 500 的機率")
+    parser.add_argument("--discord-latency-ms", type=float, default=0.0, help="每次 Discord API 呼叫的模擬延遲")
+    parser.add_argument("--no-stream", action="store_true", help="停用串流回覆")
+    parser.add_argument("--no-coalesce", action="store_true", help="停用訊息合併")
+    parser.add_argument("--no-summary", action="store_true", help="停用背景摘要")
+    parser.add_argument("--keep-limits", action="store_true", help="保留 config.json 的速率限制 (預設放寬)")
+    parser.add_argument("--timeout", type=float, default=600.0, help="等待全部訊息完成的上限秒數")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="以 JSON 輸出結果")
+    parser.add_argument("--max-p95-ms", type=float, default=None, help="p95 延遲門檻，超過時結束碼為 1")
+    parser.add_argument("--min-throughput", type=float, default=None, help="吞吐量門檻 (msgs/s)，低於時結束碼為 1")
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    with tempfile.TemporaryDirectory(prefix="bot-bench-") as data_dir:
+        # 使用暫存資料庫，不影響 data/ 中的正式資料
+        db_manager.DATA_DIR = Path(data_dir)
+        db_manager.DB_PATH = Path(data_dir) / "bench.db"
+        result = asyncio.run(run(args))
+
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+    else:
+        print_report(result)
+
+    failed = False
+    if args.max_p95_ms is not None and result["latency_ms"]["p95"] > args.max_p95_ms:
+        print(f"❌ p95 延遲 {result['latency_ms']['p95']:.0f}ms 超過門檻 {args.max_p95_ms:.0f}ms", file=sys.stderr)
+        failed = True
+    if args.min_throughput is not None and result["throughput_msgs_per_s"] < args.min_throughput:
+        print(f"❌ 吞吐量 {result['throughput_msgs_per_s']:.1f} msgs/s 低於門檻 {args.min_throughput}", file=sys.stderr)
+        failed = True
+    if result["completed"] < result["messages"]:
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,133 @@
+"""比較舊版 (版本 0) 與新版資料表結構下，對話熱路徑查詢的執行計畫與耗時
+
+建立一個舊版結構的暫存資料庫並填入模擬資料，量測後以 db_manager.init_db() 進行線上遷移，再量測一次。
+
+用法 (於專案根目錄)：
+    python bench/query_plans.py --users 2000 --turns 200
+"""
+import argparse
+import asyncio
+import datetime
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT))
+
+from cogs.utils import db_manager  # noqa: E402
+
+USER_ID_BASE = 920000000000000000
+
+# 版本 0 的結構 (遷移前)
+LEGACY_SCHEMA = """
+    CREATE TABLE chat_history (
+        id INTEGER PRIMARY KEY AUTOINCREMENT, user_id TEXT NOT NULL, role TEXT NOT NULL,
+        content TEXT NOT NULL, model_used TEXT, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP, token_count INTEGER
+    );
+    CREATE INDEX idx_user_id_timestamp ON chat_history (user_id, timestamp);
+    CREATE TABLE user_settings (user_id TEXT PRIMARY KEY, model TEXT, remember_context INTEGER, system_prompt TEXT);
+    CREATE TABLE listened_channels (
+        channel_id TEXT PRIMARY KEY, guild_id TEXT NOT NULL, added_by_id TEXT NOT NULL,
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+    );
+"""
+
+# (名稱, 舊版查詢, 新版查詢)；參數中的 {user} 會代入一位隨機使用者
+QUERIES = (
+    ("system prompt probe",
+     "SELECT 1 FROM chat_history WHERE user_id = '{user}' AND role = 'system'",
+     None),
+    ("context window",
+     "SELECT id, role, content, token_count FROM chat_history WHERE user_id = '{user}' "
+     "AND role IN ('user', 'assistant') ORDER BY timestamp DESC LIMIT 50",
+     "SELECT id, role, content, token_count FROM chat_history WHERE user_id = {user} ORDER BY id DESC LIMIT 50"),
+    ("compaction offset",
+     "SELECT id FROM chat_history WHERE user_id = '{user}' AND role IN ('user', 'assistant') "
+     "ORDER BY id DESC LIMIT 1 OFFSET 20",
+     "SELECT id FROM chat_history WHERE user_id = {user} ORDER BY id DESC LIMIT 1 OFFSET 20"),
+    ("token budget scan",
+     "SELECT id, token_count FROM chat_history WHERE user_id = '{user}' AND role IN ('user', 'assistant') "
+     "ORDER BY timestamp DESC",
+     "SELECT id, token_count FROM chat_history WHERE user_id = {user} ORDER BY id DESC"),
+    ("turns per user",
+     "SELECT user_id, COUNT(*) FROM chat_history WHERE role IN ('user', 'assistant') GROUP BY user_id",
+     "SELECT user_id, COUNT(*) FROM chat_history GROUP BY user_id"),
+)
+
+
+def populate_legacy(path: Path, users: int, turns: int, seed: int):
+    rng = random.Random(seed)
+    conn = sqlite3.connect(path)
+    conn.executescript(LEGACY_SCHEMA)
+    start = datetime.datetime.now() - datetime.timedelta(days=30)
+    rows = []
+    for user in range(users):
+        user_id = str(USER_ID_BASE + user)
+        rows.append((user_id, "system", "請你之後的回應一律使用繁體中文。", None, start, 20))
+    # 交錯寫入各使用者的對話，模擬真實的寫入順序
+    for turn in range(turns):
+        for user in rng.sample(range(users), users):
+            content = "測試內容 " * rng.randint(5, 60)
+            rows.append((str(USER_ID_BASE + user), "user" if turn % 2 == 0 else "assistant", content,
+                         None if turn % 2 == 0 else "gpt-4o", start + datetime.timedelta(seconds=turn * users + user),
+                         len(content) // 2))
+    conn.executemany(
+        "INSERT INTO chat_history (user_id, role, content, model_used, timestamp, token_count) VALUES (?, ?, ?, ?, ?, ?)",
+        rows
+    )
+    conn.commit()
+    conn.close()
+
+
+def measure(path: Path, legacy: bool, users: int, repeat: int, seed: int):
+    rng = random.Random(seed)
+    conn = sqlite3.connect(path)
+    print(f"\n=== {'舊版結構 (版本 0)' if legacy else f'新版結構 (版本 {db_manager.SCHEMA_VERSION})'} ===")
+    for name, legacy_sql, new_sql in QUERIES:
+        sql = legacy_sql if legacy else new_sql
+        if sql is None:
+            print(f"\n[{name}] 已不需要")
+            continue
+        plan = conn.execute("EXPLAIN QUERY PLAN " + sql.format(user=USER_ID_BASE)).fetchall()
+        per_user = "{user}" in sql
+        runs = repeat if per_user else max(1, repeat // 100)
+        started = time.perf_counter()
+        for _ in range(runs):
+            conn.execute(sql.format(user=USER_ID_BASE + rng.randrange(users))).fetchall()
+        elapsed = (time.perf_counter() - started) / runs
+        print(f"\n[{name}] 平均 {elapsed * 1e6:.0f}µs ({runs} 次)")
+        for row in plan:
+            print(f"  {row[-1]}")
+    conn.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="資料表結構遷移前後的查詢計畫比較")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--turns", type=int, default=100, help="每位使用者的對話則數")
+    parser.add_argument("--repeat", type=int, default=2000, help="每個查詢的量測次數")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory(prefix="bot-schema-") as data_dir:
+        db_manager.DATA_DIR = Path(data_dir)
+        db_manager.DB_PATH = Path(data_dir) / "bench.db"
+        print(f"建立 {args.users} 位使用者 × {args.turns} 則對話的舊版資料庫...")
+        populate_legacy(db_manager.DB_PATH, args.users, args.turns, args.seed)
+        measure(db_manager.DB_PATH, True, args.users, args.repeat, args.seed)
+
+        async def migrate():
+            started = time.perf_counter()
+            await db_manager.init_db()
+            print(f"\n遷移完成，耗時 {time.perf_counter() - started:.2f}s")
+            await db_manager.close_db()
+        asyncio.run(migrate())
+        measure(db_manager.DB_PATH, False, args.users, args.repeat, args.seed)
+
+
+if __name__ == "__main__":
+    main()
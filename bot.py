@@ -6,7 +6,12 @@ from discord.ext import commands
 from dotenv import load_dotenv
 import signal
 import json
+import time
 import logging  
+from typing import Optional
+
+from cogs.utils import db_manager
+from cogs.utils.startup import StartupTimer, sync_command_tree
 
 
 # 設定日誌記錄器
@@ -26,21 +31,154 @@ if not TOKEN:
     logger.critical("❌ 致命錯誤：環境變數中未找到 DISCORD_BOT_TOKEN！")
     sys.exit(1)
 
-# 設定 Intents
-intents = discord.Intents.all()
+# 預設閘道設定值 (可由 config.json 的 "gateway" 區塊覆寫)
+DEFAULT_GATEWAY_SETTINGS = {
+    "shard_mode": "none",
+    "shard_count": None,
+    "shard_ids": None,
+    "intents": "minimal",
+    "member_cache": False,
+    "chunk_guilds_at_startup": False,
+    "max_messages": 1000
+}
+
+# 預設排空設定值 (可由 config.json 的 "lifecycle" 區塊覆寫)：停止接受新訊息後等待進行中工作的秒數上限
+DEFAULT_LIFECYCLE_SETTINGS = {
+    "drain_timeout": 25,
+    "reload_drain_timeout": 10
+}
+
+
+# --- 載入設定檔 (建立 Bot 前就需要閘道設定) ---
+def load_config() -> dict:
+    try:
+        with open('config.json', 'r', encoding='utf8') as jfile:
+            config = json.load(jfile)
+            logger.info("✅ config.json 載入成功。")
+            return config
+    except FileNotFoundError:
+        logger.warning("⚠️ config.json 未找到，將使用空設定。")
+    except json.JSONDecodeError:
+        logger.error("❌ 解讀 config.json 失敗，將使用空設定。")
+    return {}
+
 
+def parse_shard_ids(value) -> Optional[list]:
+    """解析分片編號：接受列表或 "0-3,8" 格式的字串"""
+    if not value:
+        return None
+    if isinstance(value, list):
+        return [int(shard_id) for shard_id in value]
+    shard_ids = []
+    for part in str(value).split(","):
+        start, _, end = part.strip().partition("-")
+        shard_ids.extend(range(int(start), int(end or start) + 1))
+    return shard_ids
 
-bot = commands.Bot(command_prefix="!", intents=intents)
+
+def build_intents(options: dict) -> discord.Intents:
+    """對話功能只需要伺服器、訊息、私訊與訊息內容；不訂閱成員與狀態事件以降低閘道流量"""
+    if options["intents"] == "all":
+        return discord.Intents.all()
+    intents = discord.Intents.none()
+    intents.guilds = True
+    intents.guild_messages = True
+    intents.dm_messages = True
+    intents.message_content = True
+    intents.members = bool(options["member_cache"])
+    return intents
+
+
+def create_bot(config: dict) -> commands.Bot:
+    """依 "gateway" 設定建立單一連線或分片的 Bot
+
+    shard_mode："none" 為單一連線；"auto" 由 discord.py 在同一行程中管理所有分片；
+    "range" 只執行 shard_ids 指定的分片 (搭配 shard_count，可將分片分散到多個行程)。
+    環境變數 SHARD_IDS / SHARD_COUNT 會覆寫設定檔，方便以同一份設定啟動多個行程。
+    """
+    options = {**DEFAULT_GATEWAY_SETTINGS, **config.get("gateway", {})}
+    shard_ids = parse_shard_ids(os.getenv("SHARD_IDS") or options["shard_ids"])
+    shard_count = int(os.getenv("SHARD_COUNT") or options["shard_count"] or 0) or None
+    intents = build_intents(options)
+    bot_options = {
+        "command_prefix": "!",
+        "intents": intents,
+        "member_cache_flags": discord.MemberCacheFlags.from_intents(intents) if options["member_cache"] else discord.MemberCacheFlags.none(),
+        "chunk_guilds_at_startup": bool(options["chunk_guilds_at_startup"]),
+        "max_messages": options["max_messages"]
+    }
+
+    mode = "range" if shard_ids else options["shard_mode"]
+    if mode == "none":
+        new_bot = commands.Bot(**bot_options)
+    elif mode == "auto":
+        new_bot = commands.AutoShardedBot(shard_count=shard_count, **bot_options)
+    elif mode == "range":
+        if not shard_ids or not shard_count:
+            logger.critical("❌ 分片範圍模式需要同時設定 shard_ids 與 shard_count。")
+            sys.exit(1)
+        new_bot = commands.AutoShardedBot(shard_ids=shard_ids, shard_count=shard_count, **bot_options)
+    else:
+        logger.critical(f"❌ 未知的 shard_mode：{mode}")
+        sys.exit(1)
+    logger.info(f"閘道模式：{mode}，分片 {shard_ids or '全部'} / {shard_count or '自動'}，Intents 值 {intents.value}")
+    return new_bot
+
+def serves_partial_shards(bot: commands.Bot) -> bool:
+    """範圍模式且只執行部分分片：同一位使用者的私訊與伺服器訊息可能由不同行程處理"""
+    shard_ids = getattr(bot, "shard_ids", None)
+    return shard_ids is not None and len(shard_ids) < (bot.shard_count or 0)
+
+
+startup = StartupTimer()
+with startup.phase("config"):
+    config = load_config()
+    bot = create_bot(config)
+bot.config = config
+# 重新載入 cog 時由舊 cog 放入、新 cog 取出的交接狀態
+bot.cog_handoff = {}
+lifecycle = {**DEFAULT_LIFECYCLE_SETTINGS, **config.get("lifecycle", {})}
+
+
+# --- 啟動：登入後、連上閘道前載入 cogs 並視需要同步斜線指令 ---
+async def setup_hook():
+    with startup.phase("extensions"):
+        await load_extensions()
+    with startup.phase("command_sync"):
+        try:
+            await sync_command_tree(bot.tree, bot.application_id)
+        except Exception as e:
+            logger.error(f"同步斜線指令時發生錯誤：{e}")
+
+bot.setup_hook = setup_hook
+
+# --- 事件：分片連線 ---
+@bot.event
+async def on_shard_ready(shard_id):
+    logger.info(f"分片 {shard_id} 已就緒。")
+
+@bot.event
+async def on_shard_disconnect(shard_id):
+    logger.warning(f"分片 {shard_id} 已斷線，等待重新連線。")
 
 # --- 事件：機器人準備就緒 ---
 @bot.event
 async def on_ready():
+    # 斜線指令已在 setup_hook 中同步；on_ready 在每次重新連線時都會觸發，這裡不再同步
     logger.info(f"目前登入身份 --> {bot.user} (ID: {bot.user.id})")
-    try:
-        slash = await bot.tree.sync()
-        logger.info(f"載入 {len(slash)} 個斜線指令")
-    except Exception as e:
-        logger.error(f"同步斜線指令時發生錯誤：{e}")
+    startup.ready()
+
+
+# --- 排空：停止接受新訊息並等待進行中的工作完成 ---
+async def drain_cogs(timeout: float, extension: Optional[str] = None, handoff: bool = False) -> bool:
+    """排空所有 (或指定擴充模組中的) 提供 drain() 的 cog；返回是否全部在期限內排空"""
+    cogs = [cog for cog in bot.cogs.values()
+            if hasattr(cog, "drain") and (extension is None or type(cog).__module__ == extension)]
+    results = await asyncio.gather(*(cog.drain(timeout, handoff=handoff) for cog in cogs), return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            logger.error(f"排空 cog 時發生錯誤：{result}", exc_info=result)
+    return all(result is True for result in results)
 
 
 # --- 指令：載入/卸載/重載 Cog ---
@@ -59,6 +197,7 @@ async def load(ctx, extension):
 @commands.is_owner()
 async def unload(ctx, extension):
     try:
+        await drain_cogs(lifecycle["reload_drain_timeout"], f"cogs.{extension}")
         await bot.unload_extension(f"cogs.{extension}")
         await ctx.send(f"✅ 已卸載 `{extension}` cog。")
         logger.info(f"Cog '{extension}' unloaded by {ctx.author}.")
@@ -71,9 +210,15 @@ async def unload(ctx, extension):
 @commands.is_owner()
 async def reload(ctx, extension):
     try:
+        started = time.perf_counter()
+        # 等進行中的對話完成，新 cog 接手快取、佇列與排空期間收到的訊息
+        await drain_cogs(lifecycle["reload_drain_timeout"], f"cogs.{extension}", handoff=True)
         await bot.reload_extension(f"cogs.{extension}")
-        await ctx.send(f"✅ 已重新載入 `{extension}` cog。")
-        logger.info(f"Cog '{extension}' reloaded by {ctx.author}.")
+        # 指令定義有變更時才會真的同步
+        await sync_command_tree(bot.tree, bot.application_id)
+        elapsed = time.perf_counter() - started
+        await ctx.send(f"✅ 已重新載入 `{extension}` cog ({elapsed * 1000:.0f}ms)。")
+        logger.info(f"Cog '{extension}' reloaded by {ctx.author} in {elapsed * 1000:.0f}ms.")
     except Exception as e:
         await ctx.send(f"❌ 重新載入 `{extension}` cog 失敗：{e}")
         logger.error(f"Failed to reload cog '{extension}': {e}")
@@ -86,8 +231,9 @@ async def load_extensions():
         if filename.endswith(".py"):
             cog_name = f"cogs.{filename[:-3]}"
             try:
+                started = time.perf_counter()
                 await bot.load_extension(cog_name)
-                logger.info(f"成功載入 {cog_name}")
+                logger.info(f"成功載入 {cog_name} ({(time.perf_counter() - started) * 1000:.0f}ms)")
             except Exception as e:
                 logger.error(f"載入 {cog_name} 失敗. 錯誤: {e}", exc_info=True)
     logger.info("所有 cogs 載入完畢。")
@@ -95,11 +241,36 @@ async def load_extensions():
 # --- 擁有者指令 ---
 @bot.command()
 @commands.is_owner()
-async def restart(ctx):
-    """重啟機器人"""
+async def restart(ctx, mode: Optional[str] = None):
+    """重啟機器人：預設重新執行整個行程；!restart soft 只重新載入所有 cogs (保留閘道連線與資料庫)"""
+    if mode is not None and mode != "soft":
+        await ctx.send("❓ 用法：`!restart` 重新啟動行程，`!restart soft` 只重新載入所有 cogs。")
+        return
+    if mode == "soft":
+        await ctx.send("🔄 正在重新載入所有 cogs...")
+        logger.warning(f"Soft restart initiated by {ctx.author}.")
+        started = time.perf_counter()
+        failed = []
+        await drain_cogs(lifecycle["reload_drain_timeout"], handoff=True)
+        for name in list(bot.extensions):
+            try:
+                await bot.reload_extension(name)
+            except Exception as e:
+                failed.append(name)
+                logger.error(f"重新載入 {name} 失敗. 錯誤: {e}", exc_info=True)
+        await sync_command_tree(bot.tree, bot.application_id)
+        elapsed = time.perf_counter() - started
+        if failed:
+            await ctx.send(f"⚠️ 已重新載入，但以下 cogs 失敗：{'、'.join(failed)} ({elapsed * 1000:.0f}ms)")
+        else:
+            await ctx.send(f"✅ 已重新載入所有 cogs ({elapsed * 1000:.0f}ms)。")
+        return
+
     await ctx.send("🔄 機器人正在重新啟動...")
     logger.warning(f"Bot restart initiated by {ctx.author}.")
+    await drain_cogs(lifecycle["drain_timeout"])
     await bot.close()
+    await db_manager.close_db()
     os.execv(sys.executable, ['python'] + sys.argv)
 
 @bot.command()
@@ -108,35 +279,37 @@ async def stop(ctx):
     """關閉機器人"""
     await ctx.send("⚠️ 機器人即將關閉...")
     logger.warning(f"Bot stop initiated by {ctx.author}.")
+    await drain_cogs(lifecycle["drain_timeout"])
     await bot.close()
 
 # --- 關機 ---
+_shutting_down = False
+
 async def graceful_shutdown(signal_type):
-    logger.warning(f"收到關機訊號 {signal_type}，正在關閉機器人...")
+    """停止接受新訊息，在 drain_timeout 內讓進行中的回覆完成並寫出資料後才關閉 (重複的訊號會被忽略)"""
+    global _shutting_down
+    if _shutting_down:
+        return
+    _shutting_down = True
+    logger.warning(f"收到關機訊號 {signal_type}，正在排空並關閉機器人...")
+    drained = await drain_cogs(lifecycle["drain_timeout"])
     await bot.close()
-    logger.info("機器人已成功關閉。")
+    logger.info("機器人已成功關閉。" if drained else "機器人已關閉 (排空逾時，部分工作未完成)。")
 
 def signal_handler(sig, frame):
     asyncio.create_task(graceful_shutdown(signal.Signals(sig).name))
 
 # --- 主程式進入點 ---
 async def main():
-    # 載入設定檔
+    # 資料庫與遷移在連上閘道前完成一次；cogs 重新載入時沿用同一個儲存引擎與快取
+    with startup.phase("database"):
+        await db_manager.init_db(config.get("database", {}), shared_process=serves_partial_shards(bot))
     try:
-        with open('config.json', 'r', encoding='utf8') as jfile:
-            bot.config = json.load(jfile)
-            logger.info("✅ config.json 載入成功。")
-    except FileNotFoundError:
-        logger.warning("⚠️ config.json 未找到，將使用空設定。")
-        bot.config = {}
-    except json.JSONDecodeError:
-        logger.error("❌ 解讀 config.json 失敗，將使用空設定。")
-        bot.config = {}
-
-    # 啟動機器人
-    async with bot:
-        await load_extensions()
-        await bot.start(TOKEN)
+        # 啟動機器人 (cogs 在登入後的 setup_hook 中載入)
+        async with bot:
+            await bot.start(TOKEN)
+    finally:
+        await db_manager.close_db()
 
 if __name__ == "__main__":
     # 設定訊號處理
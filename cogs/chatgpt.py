@@ -1,12 +1,29 @@
 import discord
-import os
+import asyncio
+import math
+import time
+from functools import partial
 from discord.ext import commands
 from discord import app_commands
-from openai import OpenAI
 from typing import Optional, Literal
 import logging
 
 from .utils import db_manager
+from .utils import metrics
+from .utils.completion import CompletionExecutor
+from .utils.summarizer import ConversationSummarizer
+from .utils.message_splitter import split_message
+from .utils.streaming import StreamingReply
+from .utils.cache import LRUCache
+from .utils import scheduler as sched
+from .utils.coalescer import MessageCoalescer
+from .utils.response_cache import ResponseCache
+from .utils.retention import RetentionManager
+from .utils.conversation import ConversationEngine
+from .utils.channel_context import ChannelContextStore
+from .utils.job_queue import JobClient
+from .utils.images import DEFAULT_IMAGE_PROMPT, ImagePipeline
+from .utils.usage import UsageLedger
 
 # 獲取日誌記錄器
 logger = logging.getLogger("discord_bot")
@@ -18,42 +35,240 @@ DEFAULT_SETTINGS = {
     "system_prompt": "請你之後的回應一律使用繁體中文。"
 }
 
+# 重新載入 (reload_extension) 時交接給新 cog 的元件：它們不依賴 cog 本身，沿用可保留快取、佇列、
+# 限流狀態、斷路器統計與已建立的連線；協調器 (合併器) 綁定舊 cog 的方法，因此一律重建
+HANDOFF_KEY = "ChatGPTCog"
+HANDOFF_ATTRIBUTES = ("completions", "summarizer", "scheduler", "_rejection_notices", "response_cache", "retention",
+                      "conversation", "job_client", "channel_context", "images", "listened_channel_ids_cache",
+                      "channel_context_ids", "_owns_db", "ledger")
+
+# 排空時每隔多久檢查一次是否已無進行中的工作
+DRAIN_POLL_INTERVAL = 0.1
+
+
 class ChatGPTCog(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
-        self.client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
-        
-        # --- 啟動時直接呼叫 db_manager 來初始化和載入快取 ---
-        db_manager.init_db()
-        self.listened_channel_ids_cache = db_manager.load_listened_channels_to_cache()
+        config = getattr(bot, "config", {})
+        # 上一個 cog 排空後交接的狀態 (一般載入時為空)
+        state = getattr(bot, "cog_handoff", {}).pop(HANDOFF_KEY, None) or {}
+        self._resumed = bool(state)
+        # 非同步補全執行器：限制同時請求數量並套用逾時
+        self.completions = state["completions"] if state else CompletionExecutor.from_config(config.get("openai", {}))
+        # 背景滾動摘要 (可在 config.json 停用)
+        self.summarizer = state["summarizer"] if state else \
+            ConversationSummarizer.from_config(config.get("summarization", {}), self.completions)
+        # 准入控制與公平排程：限制每位使用者/伺服器的請求速率並跨伺服器公平分配
+        scheduler_config = config.get("scheduler", {})
+        self.scheduler = state["scheduler"] if state else sched.FairScheduler.from_config(scheduler_config)
+        # 同一位使用者在冷卻時間內只會收到一次「被限流」的通知，避免洗版
+        self._rejection_notices = state["_rejection_notices"] if state else \
+            LRUCache(maxsize=10000, ttl=scheduler_config.get("notice_cooldown", 10))
+        # 合併同一使用者在同一頻道快速連續送出的訊息 (window_ms 為 0 時停用)
+        self.coalescer = MessageCoalescer.from_config(config.get("coalesce", {}), self._dispatch_burst)
+        # 無上下文提問的回應快取 (相同的 模型/系統提示/提問 直接重用結果)
+        self.response_cache = state["response_cache"] if state else ResponseCache.from_config(config.get("response_cache", {}))
+        # 聊天紀錄保留政策的背景維護 (過期、每人則數、容量上限與空間回收)
+        self.retention = state["retention"] if state else RetentionManager.from_config(config.get("retention", {}))
+        # 單輪對話流程 (組合上下文、呼叫模型、寫回歷史)
+        self.conversation = state["conversation"] if state else ConversationEngine(config, self.completions, self.summarizer)
+        # 閘道/工作行程分離：啟用時對話工作交給 worker.py 處理 (停用時為 None)
+        self.job_client = state["job_client"] if state else JobClient.from_config(config.get("workers", {}))
+        # 頻道上下文模式的記憶體滑動視窗 (模式由 listened_channels.context_mode 逐頻道設定)
+        self.channel_context = state["channel_context"] if state else \
+            ChannelContextStore.from_config(config.get("channel_context", {}))
+        # 圖片附件的下載與縮圖 (停用時忽略附件)
+        self.images = state["images"] if state else ImagePipeline.from_config(config.get("vision", {}))
+        # token 用量帳本與每日配額 (停用時為 None)
+        self.ledger = state["ledger"] if state else UsageLedger.from_config(config.get("usage", {}))
+        self.listened_channel_ids_cache = state.get("listened_channel_ids_cache", set())
+        self.channel_context_ids = state.get("channel_context_ids", set())
+        self._owns_db = state.get("_owns_db", False)
+        # 排空期間收到的訊息：重新載入時交給新 cog 處理，關閉時告知使用者稍後再傳
+        self._held = state.get("held", [])
+        self.draining = False
+        self._handoff = False
 
-    # --- 核心對話邏輯 ---
-    async def _call_chatgpt_api(self, user_id: str, prompt: str, model: str, remember_context: bool) -> str:
-        # 組合給 API 的訊息列表
-        messages_for_api = []
-        if remember_context:
-            user_settings = db_manager.get_user_settings(user_id, {**DEFAULT_SETTINGS, "system_prompt": self.bot.config.get("default_system_prompt", DEFAULT_SETTINGS["system_prompt"])})
-            system_prompt = user_settings["system_prompt"]
-            messages_for_api = db_manager.get_user_history_from_db(user_id, system_prompt)
-            messages_for_api.append({"role": "user", "content": prompt})
+    async def cog_load(self):
+        if self._resumed:
+            # 重新載入：沿用交接的元件與快取，不重新查詢資料庫；補上排空期間收到的訊息
+            self.scheduler.start()
+            self._register_gauges()
+            held, self._held = self._held, []
+            for message in held:
+                await self._admit(message)
+            logger.info(f"已接手上一個 ChatGPTCog 的狀態 (補處理 {len(held)} 則排空期間的訊息)。")
+            return
+
+        # --- 資料庫通常已由 bot.py 在連上閘道前開啟；單獨載入 (例如壓力測試) 時才由 cog 自行開啟並負責關閉 ---
+        self._owns_db = not db_manager.is_initialized()
+        if self._owns_db:
+            await db_manager.init_db(self.bot.config.get("database", {}))
+        if self.channel_context:
+            self.listened_channel_ids_cache, self.channel_context_ids = await asyncio.gather(
+                db_manager.load_listened_channels_to_cache(), db_manager.load_channel_context_ids())
+            self.channel_context.start()
         else:
-            # 如果不使用歷史紀錄，也從db獲取個人設定，若無則使用預設
-            user_settings = db_manager.get_user_settings(user_id, DEFAULT_SETTINGS)
-            messages_for_api = [
-                {"role": "system", "content": user_settings["system_prompt"]},
-                {"role": "user", "content": prompt}
-            ]
+            self.listened_channel_ids_cache = await db_manager.load_listened_channels_to_cache()
+        if self.response_cache and self.response_cache.persist and self.response_cache.ttl:
+            await db_manager.prune_response_cache(self.response_cache.ttl)
+        if self.job_client:
+            # 歷史紀錄由工作行程寫入，摘要也由工作行程負責
+            await self.job_client.start()
+        elif self.summarizer:
+            self.summarizer.start()
+        if self.retention and not self.job_client:
+            # 工作行程模式下由工作行程清理 (快取在工作行程中)，閘道不執行
+            self.retention.start()
+        if self.ledger:
+            await self.ledger.start()
+        self.scheduler.start()
+        self._register_gauges()
 
-        # 呼叫 OpenAI API
-        response = self.client.chat.completions.create(model=model, messages=messages_for_api)
-        reply_content = response.choices[0].message.content.strip()
+    def _register_gauges(self):
+        """註冊讀取時才取值的量測值 (重新載入後會以新 cog 的回呼取代)"""
+        metrics.registry.gauge("scheduler_queue_depth", "Chat jobs waiting in the scheduler.", lambda: self.scheduler.queue_depth)
+        metrics.registry.gauge("scheduler_running", "Chat jobs currently being handled.", lambda: self.scheduler.running)
+        metrics.registry.gauge("openai_in_flight", "Completion requests waiting on the upstream API.", lambda: self.completions.in_flight)
+        metrics.registry.gauge("openai_waiting", "Completion requests waiting for a concurrency slot.", lambda: self.completions.waiting)
+        metrics.registry.gauge("coalescer_pending_messages", "Messages waiting to be coalesced.",
+                               lambda: self.coalescer.pending_count if self.coalescer else 0)
+        metrics.registry.gauge("summarizer_queue_depth", "Users waiting for summary compaction.",
+                               lambda: self.summarizer.queue_depth if self.summarizer else 0)
+        metrics.registry.gauge("db_pending_history_rows", "Chat history rows buffered for the next flush.", db_manager.pending_history_count)
+        metrics.registry.gauge("settings_cache_hit_rate", "User settings cache hit rate.", lambda: db_manager.settings_cache.hit_rate)
+        metrics.registry.gauge("history_cache_hit_rate", "Conversation window cache hit rate.",
+                               lambda: db_manager.history_cache.stats()["hit_rate"])
+        metrics.registry.gauge("model_router_open_circuits", "Models whose circuit breaker is open or half-open.",
+                               lambda: self.conversation.router.open_circuits if self.conversation.router else 0)
+        metrics.registry.gauge("channel_context_windows", "Channels with an in-memory context window.",
+                               lambda: self.channel_context.window_count if self.channel_context else 0)
+        metrics.registry.gauge("job_queue_waiting", "Jobs submitted to workers and awaiting a result.",
+                               lambda: self.job_client.waiting if self.job_client else 0)
+        metrics.registry.gauge("response_cache_hit_rate", "Response cache hit rate.",
+                               lambda: self.response_cache.hit_rate if self.response_cache else 0)
+        metrics.registry.gauge("usage_pending_rows", "Usage rollup rows waiting for the next batched upsert.",
+                               lambda: self.ledger.pending_count if self.ledger else 0)
+
+    async def cog_unload(self):
+        if self.coalescer:
+            await self.coalescer.close()
+        if self._handoff:
+            # 重新載入：元件原封不動交給新 cog，只寫出緩衝中的紀錄
+            self.bot.cog_handoff[HANDOFF_KEY] = {
+                **{name: getattr(self, name) for name in HANDOFF_ATTRIBUTES}, "held": self._held}
+            await db_manager.flush_history()
+            return
+        await self.scheduler.stop()
+        if self.job_client:
+            await self.job_client.close()
+        if self.summarizer:
+            await self.summarizer.stop()
+        if self.retention:
+            await self.retention.stop()
+        if self.channel_context:
+            await self.channel_context.stop()
+        if self.ledger:
+            await self.ledger.stop()
+        await self.completions.aclose()
+        if self.images:
+            await self.images.close()
+        if self.response_cache:
+            await self.response_cache.close()
+        if self._owns_db:
+            await db_manager.close_db()
+        else:
+            # 重新載入時保留儲存引擎與快取，只寫出緩衝中的紀錄
+            await db_manager.flush_history()
+
+    def _default_settings(self) -> dict:
+        """預設設定值，系統提示以 config.json 為準"""
+        default_prompt = self.bot.config.get("default_system_prompt", DEFAULT_SETTINGS['system_prompt'])
+        return {**DEFAULT_SETTINGS, "system_prompt": default_prompt}
+
+    # --- 排空 (重新啟動、重新載入與關機前) ---
+    async def drain(self, timeout: float, handoff: bool = False) -> bool:
+        """停止接受新訊息，等待合併器與排程器中的工作在期限內完成，再寫出所有緩衝
+
+        handoff 為 True 時 (重新載入) 排空期間收到的訊息與所有元件會交給新 cog；
+        期限到時仍在排隊的工作會被取消並通知使用者，執行中的工作交由卸載流程處理。返回是否完全排空。
+        """
+        self.draining = True
+        self._handoff = handoff and hasattr(self.bot, "cog_handoff")
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout
+        started = time.perf_counter()
+        while True:
+            if self.coalescer:
+                # 不再等待合併窗口，已收到的訊息立即送出
+                self.coalescer.flush()
+            if self.scheduler.idle and (not self.coalescer or self.coalescer.idle):
+                drained = True
+                break
+            if loop.time() >= deadline:
+                drained = False
+                break
+            await asyncio.sleep(DRAIN_POLL_INTERVAL)
+
+        if not drained:
+            expired = await self.scheduler.expire_pending()
+            logger.warning(f"排空逾時 ({timeout}s)：取消 {expired} 個排隊中的工作，仍有 {self.scheduler.running} 個執行中。")
+        if self.channel_context:
+            await self.channel_context.flush()
+        if self.ledger:
+            await self.ledger.flush()
+        if self.response_cache:
+            await self.response_cache.close()
+        await db_manager.flush_history()
+        logger.info(f"ChatGPTCog 已排空 ({(time.perf_counter() - started) * 1000:.0f}ms)。")
+        return drained
+
+    # --- 核心對話邏輯 ---
+    async def _call_chatgpt_api(self, user_id: str, prompt: str, user_settings: dict,
+                                channel_context: Optional[list] = None, images: Optional[list] = None,
+                                usage: Optional[dict] = None) -> str:
+        if self.job_client:
+            # 閘道模式：交給工作行程處理，這裡只等待結果
+            return await self.job_client.chat(user_id, prompt, user_settings, channel_context, images, usage)
+        return await self.conversation.complete(user_id, prompt, user_settings, channel_context, images, usage)
 
-        # 如果啟用歷史紀錄，則儲存對話
-        if remember_context:
-            db_manager.add_message_to_db(user_id, "user", prompt)
-            db_manager.add_message_to_db(user_id, "assistant", reply_content, model_used=model)
+    async def _stream_chatgpt_api(self, user_id: str, prompt: str, user_settings: dict, reply: StreamingReply,
+                                  channel_context: Optional[list] = None, images: Optional[list] = None,
+                                  usage: Optional[dict] = None) -> str:
+        # 以串流呼叫 OpenAI API，邊產生邊更新 Discord 訊息
+        return await self.conversation.stream(user_id, prompt, user_settings, reply, channel_context, images, usage)
 
-        return reply_content
+    # --- 頻道上下文 ---
+    def _uses_channel_context(self, channel) -> bool:
+        return self.channel_context is not None and getattr(channel, "id", None) in self.channel_context_ids
+
+    def _addresses_bot(self, message: discord.Message) -> bool:
+        """訊息是否提及機器人或回覆機器人的訊息"""
+        if self.bot.user in message.mentions:
+            return True
+        reference = message.reference
+        return reference is not None and isinstance(reference.resolved, discord.Message) \
+            and reference.resolved.author == self.bot.user
+
+    def _clean_prompt(self, content: str) -> str:
+        """移除提問中對機器人的提及標記"""
+        if self.bot.user is not None:
+            content = content.replace(f"<@{self.bot.user.id}>", "").replace(f"<@!{self.bot.user.id}>", "")
+        return content.strip()
+
+    def _image_attachments(self, messages: list) -> list:
+        """訊息中要交給模型的圖片附件 (停用圖片處理時為空)"""
+        if not self.images:
+            return []
+        return self.images.select([attachment for m in messages for attachment in m.attachments])
+
+    async def _send_reply(self, message: discord.Message, content: str):
+        """回覆訊息；超過 Discord 字數上限時於安全切點分成多則"""
+        chunks = split_message(content)
+        with metrics.timed("discord_reply"):
+            await message.reply(chunks[0])
+            for chunk in chunks[1:]:
+                await message.channel.send(chunk)
 
     # --- 事件監聽器 ---
     @commands.Cog.listener()
@@ -69,29 +284,246 @@ class ChatGPTCog(commands.Cog):
         
         if message.content.startswith(self.bot.command_prefix):
             return
-            
-        prompt = message.content.strip()
-        if not prompt:
+
+        if self._uses_channel_context(message.channel):
+            # 頻道上下文模式：所有成員的發言都進入滑動視窗，只有提及或回覆機器人的訊息才會觸發回應
+            # (記錄移除提及後的內容，與寫入使用者歷史的提問一致，去除重複時才比對得到)
+            self.channel_context.record(message.channel.id, message.author.id, message.author.display_name, "user",
+                                        self._clean_prompt(message.content), message_id=message.id)
+            if self.channel_context.require_mention and not self._addresses_bot(message):
+                return
+
+        prompt = self._clean_prompt(message.content)
+        if not prompt and not self._image_attachments([message]):
+            return
+
+        await self._admit(message)
+
+    async def _admit(self, message: discord.Message):
+        """將通過篩選的訊息交給合併器或排程器；排空期間改為暫存或告知使用者"""
+        if self.draining:
+            if self._handoff:
+                self._held.append(message)
+            elif self._rejection_notices.get(("draining", message.author.id)) is None:
+                self._rejection_notices.set(("draining", message.author.id), True)
+                await message.reply("🔄 機器人正在重新啟動，請稍後再傳送一次。")
             return
 
+        if self.coalescer:
+            self.coalescer.add((message.author.id, message.channel.id), message)
+        else:
+            await self._dispatch_messages([message])
+
+    async def _dispatch_burst(self, messages: list):
+        """合併器送出的一批訊息：等到這次請求處理完畢才返回，期間的新訊息由合併器排隊"""
+        done = await self._dispatch_messages(messages)
+        await done
+
+    async def _dispatch_messages(self, messages: list) -> asyncio.Future:
+        """將一則 (或合併後的多則) 訊息交給排程器；返回在處理結束時完成的 Future"""
+        message = messages[-1]
+        prompt = "\n".join(filter(None, (self._clean_prompt(m.content) for m in messages)))
+        attachments = self._image_attachments(messages)
         user_id_str = str(message.author.id)
-        
-        # 從資料庫獲取使用者設定
-        default_prompt = self.bot.config.get("default_system_prompt", DEFAULT_SETTINGS['system_prompt'])
-        user_settings = db_manager.get_user_settings(user_id_str, {**DEFAULT_SETTINGS, "system_prompt": default_prompt})
-        
+        done = asyncio.get_running_loop().create_future()
+
+        # 獲取使用者設定 (使用者已在快取中時不需查詢資料庫)
+        with metrics.timed("settings"):
+            user_settings = await db_manager.get_user_settings(user_id_str, self._default_settings())
+
+        # 每日配額只查記憶體中的計數；超過時不進入排程。附上圖片時以實際回答的 (支援圖片的) 模型計算
+        guild_id = None if message.guild is None else str(message.guild.id)
+        model = self.images.model_for(user_settings["model"]) if attachments else user_settings["model"]
+        scope = self.ledger.check(user_id_str, guild_id, model) if self.ledger else None
+        if scope is not None:
+            done.set_result(None)
+            metrics.REQUESTS.inc(outcome="quota_exceeded")
+            await self._notify_quota(message, scope, model)
+            return done
+
+        # 交給排程器：超過速率或佇列已滿時直接告知使用者，需排隊時加上 ⏳ 反應
+        job = sched.ChatJob(
+            user_id=user_id_str,
+            guild_id=guild_id,
+            handler=partial(self._run_and_resolve, done, partial(self._handle_chat, message, user_id_str, prompt, user_settings,
+                                                                 tuple(m.id for m in messages), attachments)),
+            on_start=partial(self._clear_queued_marker, message),
+            on_expired=partial(self._run_and_resolve, done, partial(self._notify_expired, message))
+        )
+        admission = self.scheduler.submit(job)
+        if not admission.accepted:
+            done.set_result(None)
+            metrics.REQUESTS.inc(outcome=admission.status)
+            await self._notify_rejection(message, admission)
+        elif admission.status == sched.QUEUED:
+            await self._mark_queued(message, admission)
+        return done
+
+    async def _run_and_resolve(self, done: asyncio.Future, func):
         try:
-            async with message.channel.typing():
-                reply_content = await self._call_chatgpt_api(
+            await func()
+        finally:
+            if not done.done():
+                done.set_result(None)
+
+    async def _handle_chat(self, message: discord.Message, user_id_str: str, prompt: str, user_settings: dict,
+                           message_ids: tuple = (), attachments: list = ()):
+        streaming = self.bot.config.get("streaming", {})
+        stream_reply = None
+        cache_key = None
+        channel_context = None
+        images = None
+        usage = {}
+        started = time.perf_counter()
+        outcome = "ok"
+        try:
+            if self._uses_channel_context(message.channel):
+                # 開始處理時才取視窗，包含排隊期間的新發言；提問本身不重複放入
+                channel_context = await self.channel_context.window(message.channel.id, exclude_message_ids=message_ids)
+
+            if attachments:
+                # 下載與縮圖在排程器領到工作後才進行，不佔用准入流程；無法處理的圖片略過並告知使用者
+                images, image_errors = await self.images.prepare(attachments)
+                if image_errors:
+                    await message.reply("⚠️ 略過無法處理的圖片：" + "；".join(image_errors))
+                if not images and not prompt:
+                    outcome = "rejected"
+                    return
+                if not images and self.ledger and self.images.model_for(user_settings["model"]) != user_settings["model"]:
+                    # 圖片全部失敗，改以原本的模型回答純文字；准入時檢查的是圖片模型，這裡補查原模型的配額
+                    guild_id = None if message.guild is None else str(message.guild.id)
+                    scope = self.ledger.check(user_id_str, guild_id, user_settings["model"])
+                    if scope is not None:
+                        outcome = "quota_exceeded"
+                        await self._notify_quota(message, scope, user_settings["model"])
+                        return
+                if images:
+                    prompt = prompt or DEFAULT_IMAGE_PROMPT
+                    user_settings = {**user_settings, "model": self.images.model_for(user_settings["model"])}
+
+            # 不記憶上下文時，結果只取決於 (模型, 系統提示, 提問)，可以直接重用快取
+            if self.response_cache and not user_settings["remember_context"] and channel_context is None and not images:
+                cache_key = ResponseCache.make_key(user_settings["model"], user_settings["system_prompt"], prompt)
+                cached_reply = await self.response_cache.fetch(cache_key)
+                if cached_reply is not None:
+                    cache_key = None
+                    outcome = "cached"
+                    await self._send_reply(message, cached_reply)
+                    return
+
+            if streaming.get("enabled", False) and not self.job_client:
+                stream_reply = StreamingReply(message, edit_interval=streaming.get("edit_interval", 1.0))
+                with metrics.timed("discord_reply"):
+                    await stream_reply.start()
+                reply_content = await self._stream_chatgpt_api(
                     user_id=user_id_str,
                     prompt=prompt,
-                    model=user_settings["model"],
-                    remember_context=user_settings["remember_context"]
+                    user_settings=user_settings,
+                    reply=stream_reply,
+                    channel_context=channel_context,
+                    images=images,
+                    usage=usage
                 )
-            await message.reply(reply_content)
+            else:
+                async with message.channel.typing():
+                    reply_content = await self._call_chatgpt_api(
+                        user_id=user_id_str,
+                        prompt=prompt,
+                        user_settings=user_settings,
+                        channel_context=channel_context,
+                        images=images,
+                        usage=usage
+                    )
+                await self._send_reply(message, reply_content)
+
+            if self.ledger and usage:
+                self.ledger.record(user_id_str, None if message.guild is None else str(message.guild.id), usage["model"],
+                                   usage["prompt_tokens"], usage["completion_tokens"])
+
+            if channel_context is not None:
+                self.channel_context.record(message.channel.id, self.bot.user.id, self.bot.user.display_name, "assistant",
+                                            reply_content)
+
+            if cache_key is not None:
+                if usage.get("model", user_settings["model"]) == user_settings["model"]:
+                    self.response_cache.store(cache_key, user_settings["model"], reply_content)
+                else:
+                    # 由備援模型回答：交給同時等待的相同提問，但不以原模型的名義快取
+                    self.response_cache.release(cache_key, reply_content)
+                cache_key = None
+        except asyncio.TimeoutError:
+            outcome = "timeout"
+            metrics.ERRORS.inc(type="TimeoutError")
+            logger.warning(f"OpenAI request for user {user_id_str} timed out after {self.completions.timeout}s.")
+            await self._report_error(message, stream_reply, "⌛ AI 回應逾時，請稍後再試一次。")
         except Exception as e:
+            outcome = "error"
+            # 工作行程回報的錯誤以原始例外類別名稱呈現
+            error_type = getattr(e, "error_type", type(e).__name__)
+            metrics.ERRORS.inc(type=error_type)
             logger.error(f"Error in on_message handler for user {user_id_str}: {e}", exc_info=True)
-            await message.reply(f"❌ 處理你的訊息時發生錯誤 ({type(e).__name__})。")
+            await self._report_error(message, stream_reply, f"❌ 處理你的訊息時發生錯誤 ({error_type})。")
+        finally:
+            if cache_key is not None:
+                self.response_cache.release(cache_key)
+            metrics.REQUESTS.inc(outcome=outcome)
+            metrics.STAGE_SECONDS.observe(time.perf_counter() - started, stage="total")
+
+    # --- 排程通知 ---
+    async def _notify_rejection(self, message: discord.Message, admission: sched.Admission):
+        user_id_str = str(message.author.id)
+        if self._rejection_notices.get(user_id_str) is not None:
+            return
+        self._rejection_notices.set(user_id_str, admission.status)
+        retry = max(1, math.ceil(admission.retry_after))
+        if admission.status == sched.USER_RATE_LIMITED:
+            text = f"⏳ 你傳送訊息的速度太快了，這則訊息不會被處理，請在 {retry} 秒後再試。"
+        elif admission.status == sched.GUILD_RATE_LIMITED:
+            text = f"⏳ 這個伺服器目前的請求量過高，這則訊息不會被處理，請在 {retry} 秒後再試。"
+        else:
+            text = "🚦 目前排隊中的請求太多，這則訊息不會被處理，請稍後再試。"
+        logger.info(f"Message from user {user_id_str} rejected by scheduler: {admission.status}")
+        await message.reply(text, delete_after=30)
+
+    async def _notify_quota(self, message: discord.Message, scope: str, model: str):
+        user_id_str = str(message.author.id)
+        if self._rejection_notices.get(user_id_str) is not None:
+            return
+        self._rejection_notices.set(user_id_str, "quota_exceeded")
+        if scope == "model":
+            text = f"📊 你今天使用 `{model}` 的額度已用完，請用 `/settings` 改用其他模型，或明天 (UTC) 再試。"
+        elif scope == "guild":
+            text = "📊 這個伺服器今天的 AI 使用額度已用完，請明天 (UTC) 再試。"
+        else:
+            text = "📊 你今天的 AI 使用額度已用完，請明天 (UTC) 再試。"
+        logger.info(f"Message from user {user_id_str} rejected by {scope} quota.")
+        await message.reply(text, delete_after=30)
+
+    async def _mark_queued(self, message: discord.Message, admission: sched.Admission):
+        try:
+            await message.add_reaction("⏳")
+            if admission.position >= 3:
+                await message.reply(f"🕒 目前請求較多，你的訊息正在排隊 (前面還有 {admission.position} 則)。", delete_after=30)
+        except discord.HTTPException:
+            pass
+
+    async def _clear_queued_marker(self, message: discord.Message):
+        try:
+            await message.remove_reaction("⏳", self.bot.user)
+        except discord.HTTPException:
+            pass
+
+    async def _notify_expired(self, message: discord.Message):
+        metrics.REQUESTS.inc(outcome="expired")
+        await self._clear_queued_marker(message)
+        await message.reply("⌛ 你的訊息排隊太久，已取消處理，請重新傳送。")
+
+    async def _report_error(self, message: discord.Message, stream_reply: Optional[StreamingReply], error_text: str):
+        """回報錯誤；串流模式下寫進已送出的佔位訊息，避免留下空白的思考中訊息"""
+        if stream_reply is not None and stream_reply.messages:
+            await stream_reply.fail(error_text)
+        else:
+            await message.reply(error_text)
 
     @commands.Cog.listener()
     async def on_app_command_error(self, interaction: discord.Interaction, error: app_commands.AppCommandError):
@@ -108,7 +540,7 @@ class ChatGPTCog(commands.Cog):
     @channel_group.command(name="register", description="將目前頻道註冊為AI對話頻道")
     @app_commands.checks.has_permissions(manage_channels=True)
     async def register(self, interaction: discord.Interaction):
-        success = db_manager.add_listened_channel(str(interaction.channel_id), str(interaction.guild_id), str(interaction.user.id))
+        success = await db_manager.add_listened_channel(str(interaction.channel_id), str(interaction.guild_id), str(interaction.user.id))
         if success:
             self.listened_channel_ids_cache.add(interaction.channel_id)
             await interaction.response.send_message(f"✅ 頻道 <#{interaction.channel_id}> 已成功註冊為AI對話頻道。")
@@ -119,10 +551,13 @@ class ChatGPTCog(commands.Cog):
     @channel_group.command(name="unregister", description="將目前頻道從AI對話頻道中移除")
     @app_commands.checks.has_permissions(manage_channels=True)
     async def unregister(self, interaction: discord.Interaction):
-        success = db_manager.remove_listened_channel(str(interaction.channel_id))
+        success = await db_manager.remove_listened_channel(str(interaction.channel_id))
         if success:
             if interaction.channel_id in self.listened_channel_ids_cache:
                 self.listened_channel_ids_cache.remove(interaction.channel_id)
+            self.channel_context_ids.discard(interaction.channel_id)
+            if self.channel_context:
+                await self.channel_context.forget(interaction.channel_id)
             await interaction.response.send_message(f"✅ 頻道 <#{interaction.channel_id}> 已成功從監聽列表中移除。")
             logger.info(f"頻道 {interaction.channel_id} 已由 {interaction.user.id} 移除。")
         else:
@@ -134,16 +569,37 @@ class ChatGPTCog(commands.Cog):
             await interaction.response.send_message("❌ 此指令只能在伺服器中使用。", ephemeral=True)
             return
             
-        channels = db_manager.get_listened_channels_for_guild(str(interaction.guild_id))
+        channels = await db_manager.get_listened_channels_for_guild(str(interaction.guild_id))
         
         if not channels:
             description = "目前沒有任何頻道被設定為AI對話頻道。"
         else:
-            description = "以下是本伺服器中，我會進行對話的頻道：\n" + "\n".join([f"- <#{channel[0]}>" for channel in channels])
+            description = "以下是本伺服器中，我會進行對話的頻道：\n" + "\n".join(
+                [f"- <#{channel[0]}>" + (" (頻道上下文)" if channel[1] == "channel" else "") for channel in channels])
             
         embed = discord.Embed(title=f"“{interaction.guild.name}” 的AI監聽頻道列表", description=description, color=discord.Color.blue())
         await interaction.response.send_message(embed=embed, ephemeral=True)
 
+    @channel_group.command(name="context", description="設定目前頻道的對話上下文模式")
+    @app_commands.describe(mode="user：每位使用者各自的對話歷史；channel：共享頻道中所有人最近的發言 (需提及機器人才會回應)")
+    @app_commands.checks.has_permissions(manage_channels=True)
+    async def context_mode(self, interaction: discord.Interaction, mode: Literal["user", "channel"]):
+        if mode == "channel" and not self.channel_context:
+            await interaction.response.send_message("❌ 頻道上下文功能已在設定檔中停用。", ephemeral=True)
+            return
+        if not await db_manager.set_channel_context_mode(str(interaction.channel_id), mode):
+            await interaction.response.send_message(f"ℹ️ 頻道 <#{interaction.channel_id}> 並不在監聽列表中，請先註冊。", ephemeral=True)
+            return
+        if mode == "channel":
+            self.channel_context_ids.add(interaction.channel_id)
+            await interaction.response.send_message(f"✅ 頻道 <#{interaction.channel_id}> 已切換為頻道上下文模式，我會參考頻道中最近的對話。")
+        else:
+            self.channel_context_ids.discard(interaction.channel_id)
+            if self.channel_context:
+                await self.channel_context.forget(interaction.channel_id)
+            await interaction.response.send_message(f"✅ 頻道 <#{interaction.channel_id}> 已切換為個人上下文模式。")
+        logger.info(f"頻道 {interaction.channel_id} 的上下文模式已由 {interaction.user.id} 設為 {mode}。")
+
     # --- 其他指令 ---
     @app_commands.command(name="settings", description="設定你個人的對話偏好")
     @app_commands.describe(model="【可選】設定你偏好的對話模型", remember_context="【可選】設定是否要啟用對話歷史紀錄", system_prompt="【可選】設定你對AI的個人化指示")
@@ -152,14 +608,13 @@ class ChatGPTCog(commands.Cog):
         user_id_str = str(interaction.user.id)
 
         if model is not None:
-            db_manager.update_user_setting(user_id_str, "model", model)
+            await db_manager.update_user_setting(user_id_str, "model", model)
         if remember_context is not None:
-            db_manager.update_user_setting(user_id_str, "remember_context", remember_context)
+            await db_manager.update_user_setting(user_id_str, "remember_context", remember_context)
         if system_prompt is not None:
-            db_manager.update_user_setting(user_id_str, "system_prompt", system_prompt)
+            await db_manager.update_user_setting(user_id_str, "system_prompt", system_prompt)
 
-        default_prompt = self.bot.config.get("default_system_prompt", DEFAULT_SETTINGS['system_prompt'])
-        current_settings = db_manager.get_user_settings(user_id_str, {**DEFAULT_SETTINGS, "system_prompt": default_prompt})
+        current_settings = await db_manager.get_user_settings(user_id_str, self._default_settings())
         
         embed = discord.Embed(title=f"{interaction.user.display_name} 的個人化設定", description="當您在監聽頻道或私訊中與我對話時，將會套用以下設定。", color=discord.Color.blue())
         embed.add_field(name="🧠 使用模型 (model)", value=f"`{current_settings['model']}`", inline=False)
@@ -172,11 +627,19 @@ class ChatGPTCog(commands.Cog):
     @app_commands.command(name="clear_my_chat_history", description="清除你個人所有與 ChatGPT 的對話歷史")
     async def clear_my_chat_history(self, interaction: discord.Interaction):
         try:
-            db_manager.clear_user_history_in_db(str(interaction.user.id))
-            await interaction.response.send_message("🧹 你個人的 ChatGPT 對話歷史已清除。下次對話將從新的系統提示開始。")
+            if self.job_client:
+                # 由負責該使用者的工作行程清除，才能一併丟棄它尚未寫入的緩衝與快取
+                await interaction.response.defer()
+                await self.job_client.clear_history(str(interaction.user.id))
+                await interaction.followup.send("🧹 你個人的 ChatGPT 對話歷史已清除。下次對話將從新的系統提示開始。")
+            else:
+                await db_manager.clear_user_history_in_db(str(interaction.user.id))
+                await interaction.response.send_message("🧹 你個人的 ChatGPT 對話歷史已清除。下次對話將從新的系統提示開始。")
         except Exception as e:
             logger.error(f"清除使用者 {interaction.user.id} 的歷史紀錄時發生錯誤: {e}", exc_info=True)
-            await interaction.response.send_message(f"❌ 清除歷史時發生錯誤 ({type(e).__name__})。", ephemeral=True)
+            error_type = getattr(e, "error_type", type(e).__name__)
+            send = interaction.followup.send if interaction.response.is_done() else interaction.response.send_message
+            await send(f"❌ 清除歷史時發生錯誤 ({error_type})。", ephemeral=True)
 
     @app_commands.command(name="view_user_history", description="查看特定使用者的 ChatGPT 對話歷史紀錄 (僅限擁有者)")
     @app_commands.describe(user="要查看紀錄的 Discord 使用者", count="要顯示的最近訊息數量 (預設 10，最多 50)")
@@ -186,7 +649,7 @@ class ChatGPTCog(commands.Cog):
         user_id_to_view = str(user.id)
         
         
-        history_records = db_manager.get_raw_user_history_for_viewing(user_id_to_view, limit=count)
+        history_records = await db_manager.get_raw_user_history_for_viewing(user_id_to_view, limit=count)
 
         if not history_records:
             await interaction.followup.send(f"🤷 找不到使用者 {user.mention} (ID: {user_id_to_view}) 的對話紀錄。", ephemeral=True)
@@ -2,18 +2,73 @@ import discord
 from discord.ext import commands
 from discord import app_commands
 import time
+import math
 import platform
+import logging
+from collections import Counter
+from typing import Optional
+
+from .utils import metrics
+from .utils import db_manager
+from .utils.startup import sync_command_tree
+from .utils.usage import today
+
+logger = logging.getLogger("discord_bot")
+
+# /status 中顯示延遲分位數的階段 (依對話處理順序)
+STATUS_STAGES = ("queue_wait", "settings", "history", "openai_first_token", "openai", "job_roundtrip", "discord_reply", "db_write", "db_flush", "total")
+
+
+# /status 中逐一列出的分片數量上限，超過時改為摘要
+MAX_LISTED_SHARDS = 16
+
+
+def _format_latency(latency: float) -> str:
+    return "未連線" if latency is None or not math.isfinite(latency) else f"{round(latency * 1000)}ms"
+
+
+def _format_usage(row: dict) -> str:
+    tokens = row["prompt_tokens"] + row["completion_tokens"]
+    return f"{tokens:,} tokens (輸入 {row['prompt_tokens']:,} / 輸出 {row['completion_tokens']:,}，{row['requests']} 次)"
+
+
+def _format_seconds(value) -> str:
+    if value is None:
+        return "-"
+    if value == float("inf"):
+        return ">60s"
+    return f"{value * 1000:.0f}ms" if value < 1 else f"{value:.1f}s"
+
 
 class Main(commands.Cog):
     def __init__(self, bot: commands.Bot):
         self.bot = bot
         # 紀錄機器人啟動時間
         self.start_time = time.time()
+        self._metrics_runner = None
+
+    async def cog_load(self):
+        # 可選的 Prometheus 文字格式端點 (config.json 的 "metrics" 區塊)
+        options = getattr(self.bot, "config", {}).get("metrics", {})
+        if options.get("http_enabled", False):
+            try:
+                self._metrics_runner = await metrics.start_http_server(options.get("host", "127.0.0.1"), options.get("port", 9108))
+            except OSError as e:
+                logger.error(f"無法啟動指標端點：{e}")
+
+    async def cog_unload(self):
+        if self._metrics_runner is not None:
+            await self._metrics_runner.cleanup()
+            self._metrics_runner = None
 
     @app_commands.command(name="ping", description="顯示機器人的延遲時間")
     async def ping(self, interaction: discord.Interaction):
         latency = round(self.bot.latency * 1000)  # 轉換為毫秒
-        await interaction.response.send_message(f"Pong! 目前延遲：{latency}ms")
+        shard = self.bot.get_shard(interaction.guild.shard_id) if interaction.guild and isinstance(self.bot, commands.AutoShardedBot) else None
+        if shard is not None:
+            await interaction.response.send_message(f"Pong! 目前延遲：{latency}ms (分片 {shard.id}：{_format_latency(shard.latency)})")
+        else:
+            await interaction.response.send_message(f"Pong! 目前延遲：{latency}ms")
 
     @app_commands.command(name="status", description="顯示機器人的目前狀態")
     async def status(self, interaction: discord.Interaction):
@@ -36,22 +91,175 @@ class Main(commands.Cog):
         embed.add_field(name="🏓 延遲 (Latency)", value=f"{latency}ms", inline=True)
         embed.add_field(name="⏳ 運行時間 (Uptime)", value=uptime_str, inline=True)
         embed.add_field(name="📡 所在伺服器 (Guilds)", value=f"{guild_count} 個", inline=True)
+        if isinstance(self.bot, commands.AutoShardedBot):
+            embed.add_field(name=f"🧩 分片 (Shards，共 {self.bot.shard_count})", value=self._shard_summary(), inline=False)
+        chat_cog = self.bot.get_cog("ChatGPTCog")
+        response_cache = getattr(chat_cog, "response_cache", None)
+        if response_cache:
+            cache_stats = response_cache.stats()
+            embed.add_field(
+                name="🗃️ 回應快取 (Response Cache)",
+                value=f"命中率 {cache_stats['hit_rate']:.1%} ({cache_stats['lookups']} 次查詢，{cache_stats['size']} 筆)",
+                inline=False
+            )
+        self._add_metrics_fields(embed, chat_cog)
+        job_client = getattr(chat_cog, "job_client", None)
+        if job_client:
+            embed.add_field(name="🛠️ 工作行程 (Workers)", value=await self._worker_summary(job_client), inline=False)
         embed.add_field(name="🐍 Python 版本", value=python_version, inline=False)
         embed.add_field(name="🤖 Discord.py 版本", value=discord_py_version, inline=False)
         embed.set_footer(text=f"報告生成時間：{discord.utils.utcnow().strftime('%Y-%m-%d %H:%M:%S')} UTC")
 
         await interaction.response.send_message(embed=embed)
 
+    def _shard_summary(self) -> str:
+        """本行程負責的各分片延遲與伺服器數量；分片過多時只列出延遲最高的幾個"""
+        guilds_per_shard = Counter(guild.shard_id for guild in self.bot.guilds)
+        latencies = sorted(self.bot.latencies)
+        if len(latencies) <= MAX_LISTED_SHARDS:
+            return "\n".join(f"`#{shard_id}` {_format_latency(latency)}，{guilds_per_shard[shard_id]} 個伺服器"
+                             for shard_id, latency in latencies)
+        connected = [latency for _, latency in latencies if math.isfinite(latency)]
+        worst = sorted(latencies, key=lambda item: item[1] if math.isfinite(item[1]) else float("inf"), reverse=True)[:5]
+        lines = [f"本行程 {len(latencies)} 個分片，已連線 {len(connected)} 個"]
+        if connected:
+            lines.append(f"延遲 最低 {_format_latency(min(connected))} / 平均 {_format_latency(sum(connected) / len(connected))} / 最高 {_format_latency(max(connected))}")
+        lines += [f"`#{shard_id}` {_format_latency(latency)}，{guilds_per_shard[shard_id]} 個伺服器" for shard_id, latency in worst]
+        return "\n".join(lines)
+
+    async def _worker_summary(self, job_client) -> str:
+        """佇列深度與各工作行程的心跳狀態"""
+        try:
+            stats = await job_client.stats()
+        except Exception as e:
+            logger.error(f"讀取工作佇列狀態時發生錯誤：{e}", exc_info=True)
+            return f"無法讀取佇列狀態 ({type(e).__name__})"
+        lines = [f"佇列中 {stats['queued']}，處理中 {stats['running']}，等待結果 {job_client.waiting}"]
+        lines += [f"`{worker['worker_id']}` {'🟢' if worker['alive'] else '🔴'} 分區 {worker['partitions']}，"
+                  f"已完成 {worker['jobs_done']} 筆" for worker in stats["workers"][:MAX_LISTED_SHARDS]]
+        if not stats["workers"]:
+            lines.append("⚠️ 沒有已註冊的工作行程")
+        return "\n".join(lines)
+
+    def _add_metrics_fields(self, embed: discord.Embed, chat_cog):
+        """把對話處理的指標摘要加入狀態報告"""
+        stage_lines = []
+        for stage in STATUS_STAGES:
+            p50 = metrics.STAGE_SECONDS.quantile(0.5, stage=stage)
+            if p50 is None:
+                continue
+            p95 = metrics.STAGE_SECONDS.quantile(0.95, stage=stage)
+            stage_lines.append(f"`{stage:<18}` p50 {_format_seconds(p50)} / p95 {_format_seconds(p95)}")
+        if stage_lines:
+            embed.add_field(name="⏱️ 各階段延遲 (Stage Latency)", value="\n".join(stage_lines), inline=False)
+
+        requests = {dict(key).get("outcome"): int(value) for key, value in metrics.REQUESTS.values.items()}
+        errors = sorted(((dict(key).get("type"), int(value)) for key, value in metrics.ERRORS.values.items()),
+                        key=lambda item: item[1], reverse=True)
+        request_text = "、".join(f"{outcome} {count}" for outcome, count in requests.items()) or "尚無請求"
+        if errors:
+            request_text += "\n錯誤：" + "、".join(f"{name} {count}" for name, count in errors[:5])
+        embed.add_field(name="📨 請求 (Requests)", value=request_text, inline=False)
+
+        tokens = {}
+        for key, value in metrics.TOKENS.values.items():
+            labels = dict(key)
+            tokens.setdefault(labels.get("model"), {})[labels.get("kind")] = int(value)
+        if tokens:
+            embed.add_field(
+                name="🧮 Token 用量",
+                value="\n".join(f"`{model}` 輸入 {usage.get('prompt', 0):,} / 輸出 {usage.get('completion', 0):,}" for model, usage in tokens.items()),
+                inline=False
+            )
+
+        router = getattr(getattr(chat_cog, "conversation", None), "router", None)
+        if router is not None and router.snapshot():
+            router_lines = []
+            for model, health in sorted(router.snapshot().items()):
+                state = {"closed": "🟢", "half_open": "🟡", "open": "🔴"}[health["state"]]
+                latency = health["p95"] if health["p95"] is not None else health["ttft_p95"]
+                router_lines.append(f"{state} `{model}` 錯誤率 {health['error_rate']:.0%} ({health['requests']} 次)"
+                                    + (f"，p95 {_format_seconds(latency)}" if latency is not None else ""))
+            events = Counter()
+            for key, value in getattr(metrics.registry.get("model_router_events_total"), "values", {}).items():
+                events[dict(key).get("event")] += int(value)
+            if events:
+                router_lines.append(f"備援 {events['fallback']} 次，對沖 {events['hedge']} 次 (勝出 {events['hedge_won']} 次)")
+            embed.add_field(name="🔀 模型路由 (Model Router)", value="\n".join(router_lines), inline=False)
+
+        if chat_cog is not None:
+            depths = chat_cog.scheduler.queue_depths()
+            embed.add_field(
+                name="📥 佇列 (Queues)",
+                value=f"排程 私訊 {depths.get('dm', 0)} / 頻道 {depths.get('channel', 0)}，處理中 {chat_cog.scheduler.running}\n"
+                      f"API 進行中 {chat_cog.completions.in_flight}，等待中 {chat_cog.completions.waiting}\n"
+                      f"寫入緩衝 {db_manager.pending_history_count()} 筆",
+                inline=False
+            )
+        embed.add_field(
+            name="🎯 快取命中率 (Cache Hit Rate)",
+            value=f"設定 {db_manager.settings_cache.hit_rate:.1%}，對話視窗 {db_manager.history_cache.stats()['hit_rate']:.1%}",
+            inline=False
+        )
+        report = getattr(getattr(chat_cog, "retention", None), "last_report", None)
+        if report:
+            deleted = report["expired"] + report["over_turn_limit"] + report["over_size_cap"]
+            embed.add_field(
+                name="🧹 資料保留 (Retention)",
+                value=f"上次清理 {deleted} 筆紀錄，回收 {report['reclaimed_bytes'] / 1024 / 1024:.1f}MB，"
+                      f"資料庫 {report['file_bytes'] / 1024 / 1024:.1f}MB",
+                inline=False
+            )
+
     @commands.is_owner()
     @app_commands.command(name="sync_commands", description="同步斜線指令 (僅限擁有者)")
     async def sync_commands(self, interaction: discord.Interaction):
         await interaction.response.defer(ephemeral=True)
         try:
-            synced = await self.bot.tree.sync()
+            # 手動同步一律送出，並更新記錄的指令樹雜湊值
+            synced = await sync_command_tree(self.bot.tree, self.bot.application_id, force=True)
             await interaction.followup.send(f"✅ 成功同步 {len(synced)} 個斜線指令。")
         except Exception as e:
             await interaction.followup.send(f"❌ 同步失敗：{e}")
 
+    @app_commands.command(name="usage", description="查看 token 用量統計 (僅限擁有者)")
+    @app_commands.describe(days="統計最近幾天 (UTC，含今天)", user="【可選】只看這位使用者")
+    async def usage(self, interaction: discord.Interaction, days: app_commands.Range[int, 1, 90] = 7,
+                    user: Optional[discord.User] = None):
+        # commands.is_owner() 只對前綴指令有效，斜線指令需在這裡自行檢查
+        if not await self.bot.is_owner(interaction.user):
+            await interaction.response.send_message("❌ 只有機器人擁有者可以查看用量統計。", ephemeral=True)
+            return
+        await interaction.response.defer(ephemeral=True)
+        chat_cog = self.bot.get_cog("ChatGPTCog")
+        ledger = getattr(chat_cog, "ledger", None)
+        if ledger is None:
+            await interaction.followup.send("⚠️ 用量帳本未啟用 (config.json 的 usage.enabled)。")
+            return
+        # 先寫出記憶體中尚未彙總的用量，報表讀取的是每日彙總表
+        await ledger.flush()
+        report = await db_manager.get_usage_report(today() - days + 1, user_id=None if user is None else str(user.id))
+
+        title = f"📊 最近 {days} 天的用量" + (f"：{user.display_name}" if user else "")
+        embed = discord.Embed(title=title, color=discord.Color.blue())
+        if not report["models"]:
+            embed.description = "這段期間沒有用量紀錄。"
+        else:
+            embed.add_field(name="依模型", value="\n".join(f"`{row['model']}` {_format_usage(row)}" for row in report["models"]),
+                            inline=False)
+            if user is None:
+                embed.add_field(name="使用者排行", value="\n".join(f"<@{row['user_id']}> {_format_usage(row)}"
+                                                                    for row in report["users"]), inline=False)
+            guild_lines = []
+            for row in report["guilds"]:
+                guild = self.bot.get_guild(row["guild_id"]) if row["guild_id"] else None
+                name = "私訊" if not row["guild_id"] else (guild.name if guild else f"伺服器 {row['guild_id']}")
+                guild_lines.append(f"{name} {_format_usage(row)}")
+            embed.add_field(name="伺服器排行", value="\n".join(guild_lines), inline=False)
+        if user is not None:
+            embed.set_footer(text=f"今天已使用 {ledger.used_today(str(user.id)):,} tokens")
+        await interaction.followup.send(embed=embed)
+
 
 async def setup(bot: commands.Bot):
     await bot.add_cog(Main(bot))
\ No newline at end of file
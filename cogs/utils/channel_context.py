@@ -0,0 +1,161 @@
+import time
+import asyncio
+import logging
+from collections import OrderedDict, deque
+from typing import Optional
+
+from . import db_manager
+from .tokens import message_tokens
+
+logger = logging.getLogger("discord_bot")
+
+# 預設頻道上下文設定值 (可由 config.json 的 "channel_context" 區塊覆寫)
+DEFAULT_CHANNEL_CONTEXT_SETTINGS = {
+    "enabled": True,
+    "window_messages": 30,
+    "max_message_chars": 1000,
+    "budget_share": 0.4,
+    "flush_interval": 5.0,
+    "max_channels": 2000,
+    "keep_per_channel": 200,
+    "require_mention": True
+}
+
+CHANNEL_CONTEXT_HEADER = "以下是這個頻道中最近的對話 (使用者發言以「[名稱] 內容」表示)，回答時請參考其中的脈絡："
+
+
+def format_channel_turn(turn: dict) -> dict:
+    """將頻道紀錄轉為 API 訊息；其他成員的發言加上名稱，讓模型分辨是誰說的"""
+    if turn["role"] == "assistant":
+        return {"role": "assistant", "content": turn["content"]}
+    return {"role": "user", "content": f"[{turn['author_name']}] {turn['content']}"}
+
+
+class _ChannelWindow:
+    __slots__ = ("turns", "loaded")
+
+    def __init__(self, max_turns: int):
+        self.turns = deque(maxlen=max_turns)
+        self.loaded = False
+
+
+class ChannelContextStore:
+    """頻道上下文模式的記憶體滑動視窗
+
+    每個頻道保留最近 window_messages 則發言 (包含沒有向機器人提問的成員)，由 on_message 直接餵入，
+    組合提示時不需查詢資料庫。新發言先放進寫入緩衝，每 flush_interval 秒批次寫入 channel_messages，
+    重新啟動後第一次用到某個頻道時再從資料庫補回視窗。
+    """
+
+    def __init__(self, window_messages: int = 30, max_message_chars: int = 1000, budget_share: float = 0.4,
+                 flush_interval: float = 5.0, max_channels: int = 2000, keep_per_channel: int = 200,
+                 require_mention: bool = True):
+        self.window_messages = max(1, int(window_messages))
+        self.max_message_chars = int(max_message_chars)
+        self.budget_share = budget_share
+        self.flush_interval = flush_interval
+        self.max_channels = max(1, int(max_channels))
+        self.keep_per_channel = max(self.window_messages, int(keep_per_channel))
+        self.require_mention = require_mention
+        self._windows: "OrderedDict[int, _ChannelWindow]" = OrderedDict()
+        self._pending: list = []
+        self._worker: Optional[asyncio.Task] = None
+
+    @classmethod
+    def from_config(cls, config: dict) -> Optional["ChannelContextStore"]:
+        """依照 config.json 的 "channel_context" 區塊建立視窗；停用時返回 None"""
+        options = {**DEFAULT_CHANNEL_CONTEXT_SETTINGS, **(config or {})}
+        if not options["enabled"]:
+            return None
+        return cls(**{key: options[key] for key in DEFAULT_CHANNEL_CONTEXT_SETTINGS if key != "enabled"})
+
+    @property
+    def pending_count(self) -> int:
+        return len(self._pending)
+
+    @property
+    def window_count(self) -> int:
+        return len(self._windows)
+
+    def start(self):
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"寫入頻道上下文紀錄時發生錯誤：{e}", exc_info=True)
+
+    async def flush(self) -> int:
+        if not self._pending:
+            return 0
+        rows, self._pending = self._pending, []
+        try:
+            await db_manager.add_channel_messages(rows, self.keep_per_channel)
+        except Exception:
+            self._pending = rows + self._pending
+            raise
+        return len(rows)
+
+    def _window(self, channel_id: int) -> _ChannelWindow:
+        window = self._windows.get(channel_id)
+        if window is None:
+            window = self._windows[channel_id] = _ChannelWindow(self.window_messages)
+            while len(self._windows) > self.max_channels:
+                # 被淘汰的頻道之後會再從資料庫補回
+                self._windows.popitem(last=False)
+        else:
+            self._windows.move_to_end(channel_id)
+        return window
+
+    def record(self, channel_id: int, author_id: int, author_name: str, role: str, content: str,
+               message_id: Optional[int] = None):
+        """記錄一則頻道發言 (O(1)，不等待資料庫)"""
+        content = content.strip()
+        if not content:
+            return
+        if len(content) > self.max_message_chars:
+            content = content[:self.max_message_chars] + "…"
+        turn = {"message_id": message_id, "author_id": author_id, "author_name": author_name, "role": role,
+                "content": content, "created_at": int(time.time() * 1000)}
+        turn["token_count"] = message_tokens(format_channel_turn(turn)["content"])
+        self._window(channel_id).turns.append(turn)
+        self._pending.append({**turn, "channel_id": channel_id})
+
+    async def window(self, channel_id: int, exclude_message_ids=()) -> list:
+        """頻道最近的發言 (由舊到新)；exclude_message_ids 用來排除這次提問本身"""
+        window = self._window(channel_id)
+        if not window.loaded:
+            window.loaded = True
+            oldest = window.turns[0]["created_at"] if window.turns else None
+            stored = await db_manager.get_recent_channel_messages(channel_id, self.window_messages)
+            # 只補回比記憶體中最舊一則更早的紀錄，避免與尚在視窗內的發言重複
+            older = [turn for turn in stored if oldest is None or turn["created_at"] < oldest]
+            room = self.window_messages - len(window.turns)
+            if room > 0:
+                for turn in reversed(older[-room:]):
+                    window.turns.appendleft(turn)
+        excluded = set(exclude_message_ids)
+        return [{key: turn[key] for key in ("author_id", "author_name", "role", "content", "token_count")}
+                for turn in window.turns if turn.get("message_id") is None or turn["message_id"] not in excluded]
+
+    async def forget(self, channel_id: int):
+        """停用頻道上下文時丟棄該頻道的視窗、緩衝與已保存的紀錄"""
+        self._windows.pop(channel_id, None)
+        self._pending = [row for row in self._pending if row["channel_id"] != channel_id]
+        await db_manager.clear_channel_messages(channel_id)
@@ -0,0 +1,129 @@
+import asyncio
+import time
+import logging
+from typing import Awaitable, Callable, Hashable, Optional
+
+logger = logging.getLogger("discord_bot")
+
+# 預設合併設定值 (可由 config.json 的 "coalesce" 區塊覆寫；window_ms 為 0 表示停用)
+DEFAULT_COALESCE_SETTINGS = {
+    "window_ms": 0,
+    "max_wait_ms": 5000,
+    "max_messages": 8
+}
+
+
+class _Burst:
+    __slots__ = ("messages", "timer", "in_flight", "first_at")
+
+    def __init__(self):
+        self.messages: list = []
+        self.timer: Optional[asyncio.TimerHandle] = None
+        self.in_flight = False
+        self.first_at = 0.0
+
+
+class MessageCoalescer:
+    """把同一位使用者在同一頻道連續快速送出的訊息合併成一次請求 (debounce)
+
+    - 每則新訊息都會重設等待窗口，但從第一則算起最多等待 max_wait_ms，或累積 max_messages 則立即送出。
+    - 同一個鍵已有請求處理中時，新訊息會先累積，等處理完成後再以一次請求送出 (排隊，不會取代進行中的請求)。
+    """
+
+    def __init__(self, dispatch: Callable[[list], Awaitable], window_ms: float = 1500,
+                 max_wait_ms: float = 5000, max_messages: int = 8):
+        self._dispatch = dispatch
+        self.window = window_ms / 1000
+        self.max_wait = max(window_ms, max_wait_ms) / 1000
+        self.max_messages = max(1, int(max_messages))
+        self._bursts: dict = {}
+        self._tasks: set = set()
+        self.messages_received = 0
+        self.batches_dispatched = 0
+
+    @classmethod
+    def from_config(cls, config: dict, dispatch: Callable[[list], Awaitable]) -> Optional["MessageCoalescer"]:
+        """依照 config.json 的 "coalesce" 區塊建立合併器；停用時返回 None"""
+        options = {**DEFAULT_COALESCE_SETTINGS, **(config or {})}
+        if not options["window_ms"]:
+            return None
+        return cls(dispatch, options["window_ms"], options["max_wait_ms"], options["max_messages"])
+
+    @property
+    def pending_count(self) -> int:
+        return sum(len(burst.messages) for burst in self._bursts.values())
+
+    @property
+    def idle(self) -> bool:
+        """沒有等待合併或處理中的訊息"""
+        return not self._bursts
+
+    def add(self, key: Hashable, message):
+        """加入一則訊息並 (重新) 開始等待窗口"""
+        self.messages_received += 1
+        burst = self._bursts.get(key)
+        if burst is None:
+            burst = self._bursts[key] = _Burst()
+        if not burst.messages:
+            burst.first_at = time.monotonic()
+        burst.messages.append(message)
+        if burst.in_flight:
+            return
+        if len(burst.messages) >= self.max_messages:
+            self._fire(key)
+        else:
+            self._schedule(key, burst)
+
+    def _schedule(self, key: Hashable, burst: _Burst):
+        if burst.timer is not None:
+            burst.timer.cancel()
+        remaining = self.max_wait - (time.monotonic() - burst.first_at)
+        burst.timer = asyncio.get_running_loop().call_later(max(0.0, min(self.window, remaining)), self._fire, key)
+
+    def _fire(self, key: Hashable):
+        burst = self._bursts.get(key)
+        if burst is None:
+            return
+        if burst.timer is not None:
+            burst.timer.cancel()
+            burst.timer = None
+        if burst.in_flight or not burst.messages:
+            return
+        batch, burst.messages = burst.messages, []
+        burst.in_flight = True
+        self.batches_dispatched += 1
+        task = asyncio.create_task(self._run(key, batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, key: Hashable, batch: list):
+        try:
+            await self._dispatch(batch)
+        except Exception as e:
+            logger.error(f"處理合併訊息時發生錯誤：{e}", exc_info=True)
+        finally:
+            burst = self._bursts.get(key)
+            if burst is None:
+                return
+            burst.in_flight = False
+            if burst.messages:
+                # 處理期間又收到的訊息：重新計時後合併送出
+                burst.first_at = time.monotonic()
+                self._schedule(key, burst)
+            else:
+                del self._bursts[key]
+
+    def flush(self):
+        """立即送出所有等待中的訊息 (不等待窗口結束)"""
+        for key in list(self._bursts):
+            self._fire(key)
+
+    async def close(self):
+        """取消所有計時器與等待中的合併請求 (卸載時使用)"""
+        for burst in self._bursts.values():
+            if burst.timer is not None:
+                burst.timer.cancel()
+        self._bursts.clear()
+        for task in list(self._tasks):
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
@@ -0,0 +1,158 @@
+import asyncio
+import logging
+import os
+from typing import Optional
+
+from openai import AsyncOpenAI
+
+logger = logging.getLogger("discord_bot")
+
+# 預設執行器設定值 (可由 config.json 的 "openai" 區塊覆寫)
+DEFAULT_EXECUTOR_SETTINGS = {
+    "max_concurrency": 8,
+    "timeout": 60.0,
+    "max_retries": 2,
+    "base_url": None
+}
+
+# 串流結束的標記 (放進片段佇列)
+_STREAM_END = object()
+
+
+class CompletionCancelled(Exception):
+    """請求被執行器取消 (cancel_all，例如關閉時)；呼叫端以一般錯誤處理，不會被當成自身被取消"""
+
+
+class CompletionExecutor:
+    """以非同步 OpenAI 用戶端執行對話補全，並限制同時進行中的請求數量"""
+
+    def __init__(self, api_key: Optional[str] = None, max_concurrency: int = 8, timeout: float = 60.0,
+                 max_retries: int = 2, base_url: Optional[str] = None):
+        self.client = AsyncOpenAI(api_key=api_key, base_url=base_url, timeout=timeout, max_retries=max_retries)
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.timeout = float(timeout)
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._active_tasks: set = set()
+        self._aborted: set = set()
+        self.waiting = 0
+
+    @classmethod
+    def from_config(cls, config: dict) -> "CompletionExecutor":
+        """依照 config.json 的 "openai" 區塊建立執行器"""
+        options = {**DEFAULT_EXECUTOR_SETTINGS, **(config or {})}
+        return cls(
+            api_key=os.getenv("OPENAI_API_KEY"),
+            max_concurrency=options["max_concurrency"],
+            timeout=options["timeout"],
+            max_retries=options["max_retries"],
+            base_url=options["base_url"] or os.getenv("OPENAI_BASE_URL")
+        )
+
+    @property
+    def in_flight(self) -> int:
+        """目前正在等待上游回應的請求數量"""
+        return len(self._active_tasks)
+
+    async def _start(self, coro) -> asyncio.Task:
+        """取得併發名額後在獨立的工作 (task) 中執行 coro；工作結束時釋放名額
+
+        每個請求都有執行器自己建立的工作，cancel_all 只會取消這些工作，不會取消呼叫端的工作
+        (例如 on_message 處理常式或排程器的工作迴圈)。
+        """
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        except BaseException:
+            coro.close()
+            raise
+        finally:
+            self.waiting -= 1
+        task = asyncio.ensure_future(self._guard(coro))
+        self._active_tasks.add(task)
+        task.add_done_callback(self._finish)
+        return task
+
+    async def _guard(self, coro):
+        try:
+            return await coro
+        except asyncio.CancelledError:
+            if asyncio.current_task() in self._aborted:
+                raise CompletionCancelled("請求已被取消") from None
+            raise
+
+    def _finish(self, task: asyncio.Task):
+        self._active_tasks.discard(task)
+        self._aborted.discard(task)
+        self._semaphore.release()
+        if not task.cancelled():
+            # 例外已由等待這個工作的呼叫端處理；呼叫端先放棄時避免 "exception was never retrieved" 警告
+            task.exception()
+
+    async def complete(self, model: str, messages: list, timeout: Optional[float] = None, **kwargs):
+        """送出一次對話補全請求；超過時限會拋出 asyncio.TimeoutError"""
+        task = await self._start(self.client.chat.completions.create(model=model, messages=messages, **kwargs))
+        # 逾時或呼叫端被取消時 wait_for 會一併取消請求工作
+        return await asyncio.wait_for(task, timeout=timeout or self.timeout)
+
+    async def _pump(self, model: str, messages: list, timeout: float, usage: Optional[dict],
+                    queue: asyncio.Queue, kwargs: dict):
+        """在請求工作中讀取上游串流，把文字片段放進 queue；結束時 (無論成功與否) 放入 _STREAM_END"""
+        try:
+            stream = await asyncio.wait_for(
+                self.client.chat.completions.create(model=model, messages=messages, stream=True, **kwargs),
+                timeout=timeout
+            )
+            try:
+                chunks = stream.__aiter__()
+                while True:
+                    try:
+                        chunk = await asyncio.wait_for(chunks.__anext__(), timeout=timeout)
+                    except StopAsyncIteration:
+                        break
+                    if usage is not None and getattr(chunk, "usage", None):
+                        usage["prompt_tokens"] = chunk.usage.prompt_tokens
+                        usage["completion_tokens"] = chunk.usage.completion_tokens
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        queue.put_nowait(chunk.choices[0].delta.content)
+            finally:
+                await stream.close()
+        finally:
+            queue.put_nowait(_STREAM_END)
+
+    async def stream(self, model: str, messages: list, timeout: Optional[float] = None,
+                     usage: Optional[dict] = None, **kwargs):
+        """以串流方式送出補全請求並逐段產生文字；等待任一段超過時限會拋出 asyncio.TimeoutError
+
+        傳入 usage 字典時會要求上游在最後一段附上用量，並填入 prompt_tokens / completion_tokens。
+        """
+        timeout = timeout or self.timeout
+        if usage is not None:
+            kwargs.setdefault("stream_options", {"include_usage": True})
+        queue: asyncio.Queue = asyncio.Queue()
+        task = await self._start(self._pump(model, messages, timeout, usage, queue, kwargs))
+        try:
+            while True:
+                content = await queue.get()
+                if content is _STREAM_END:
+                    # 重新拋出請求工作的例外 (逾時、上游錯誤或被 cancel_all 取消)
+                    await task
+                    return
+                yield content
+        finally:
+            # 呼叫端提前結束 (例如被取消或不再讀取) 時一併中止上游串流
+            task.cancel()
+
+    def cancel_all(self) -> int:
+        """取消所有進行中的請求，返回被取消的數量"""
+        tasks = list(self._active_tasks)
+        for task in tasks:
+            self._aborted.add(task)
+            task.cancel()
+        return len(tasks)
+
+    async def aclose(self):
+        """取消進行中的請求並關閉底層 HTTP 連線"""
+        cancelled = self.cancel_all()
+        if cancelled:
+            logger.warning(f"關閉補全執行器時取消了 {cancelled} 個進行中的請求。")
+        await self.client.close()
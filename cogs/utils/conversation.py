@@ -0,0 +1,153 @@
+import time
+import logging
+from typing import Optional
+
+from . import db_manager
+from . import metrics
+from .channel_context import CHANNEL_CONTEXT_HEADER, DEFAULT_CHANNEL_CONTEXT_SETTINGS, format_channel_turn
+from .images import IMAGE_HISTORY_NOTE, image_parts
+from .model_router import ModelRouter
+from .tokens import context_budget, message_tokens, select_within_budget
+
+logger = logging.getLogger("discord_bot")
+
+
+class ConversationEngine:
+    """單輪對話的核心流程：組合上下文、呼叫模型、寫回歷史紀錄
+
+    不依賴 Discord，同時供 ChatGPTCog (單一行程模式) 與 worker.py (閘道/工作行程分離模式) 使用。
+    """
+
+    def __init__(self, config: dict, completions, summarizer=None):
+        self.config = config
+        self.completions = completions
+        self.summarizer = summarizer
+        # 斷路器、備援與對沖請求 (停用時為 None，直接使用執行器)
+        self.router = ModelRouter.from_config(config, completions)
+        # 頻道上下文最多佔用的 token 預算比例，其餘留給使用者自己的歷史
+        self.channel_budget_share = config.get("channel_context", {}).get(
+            "budget_share", DEFAULT_CHANNEL_CONTEXT_SETTINGS["budget_share"])
+
+    async def build_messages(self, user_id: str, prompt: str, user_settings: dict,
+                             channel_context: Optional[list] = None, images: Optional[list] = None) -> list:
+        """組合給 API 的訊息列表 (設定已由呼叫端解析，不再重複查詢)
+
+        channel_context 為頻道上下文模式下頻道最近的發言 (由舊到新)：先在預算比例內放入最新的頻道發言，
+        剩餘預算再由新到舊放入使用者自己的歷史 (略過已出現在頻道發言中的部分)，依時間先後排在頻道發言之前。
+        images 為 ImagePipeline 處理好的圖片，與提問合併成多段內容，並先從預算中扣除它們的 token 數。
+        """
+        system_prompt = user_settings["system_prompt"]
+        # 依模型的 token 預算，扣除本次提問後由新到舊放入歷史對話
+        token_budget = context_budget(self.config, user_settings["model"]) - message_tokens(prompt)
+        if images:
+            token_budget -= sum(image["tokens"] for image in images)
+        channel_messages = []
+        exclude = None
+        if channel_context:
+            share = int(token_budget * self.channel_budget_share) - message_tokens(CHANNEL_CONTEXT_HEADER)
+            selected = select_within_budget(channel_context, share)
+            if selected:
+                token_budget -= sum(turn["token_count"] for turn in selected) + message_tokens(CHANNEL_CONTEXT_HEADER)
+                channel_messages = [{"role": "system", "content": CHANNEL_CONTEXT_HEADER}] + \
+                    [format_channel_turn(turn) for turn in selected]
+            # 只比對這位使用者自己的發言與機器人的回覆；視窗中的長訊息已被截斷，因此以開頭比對
+            exclude = {(turn["role"], turn["content"].rstrip("…")) for turn in channel_context
+                       if turn["role"] == "assistant" or str(turn.get("author_id")) == str(user_id)}
+
+        if user_settings["remember_context"]:
+            with metrics.timed("history"):
+                messages_for_api = await db_manager.get_user_history_from_db(user_id, system_prompt, token_budget=token_budget,
+                                                                             exclude=exclude)
+        else:
+            messages_for_api = [{"role": "system", "content": system_prompt}]
+        content = image_parts(prompt, images) if images else prompt
+        return messages_for_api + channel_messages + [{"role": "user", "content": content}]
+
+    async def persist_turn(self, user_id: str, prompt: str, reply_content: str, user_settings: dict,
+                           model_used: Optional[str] = None, job_id: Optional[int] = None):
+        """如果啟用歷史紀錄，則儲存對話 (model_used 為實際回答的模型，備援時可能與設定不同)
+
+        job_id 為工作行程處理的工作；同一個工作的對話已經寫入過 (工作被重新排入後再次執行) 時不重複寫入。
+        """
+        if not user_settings["remember_context"]:
+            return
+        if job_id is not None and await db_manager.get_job_reply(user_id, job_id) is not None:
+            return
+        with metrics.timed("db_write"):
+            await db_manager.add_message_to_db(user_id, "user", prompt, job_id=job_id)
+            await db_manager.add_message_to_db(user_id, "assistant", reply_content, model_used=model_used or user_settings["model"],
+                                               job_id=job_id)
+        if self.summarizer:
+            self.summarizer.notify(user_id)
+
+    @staticmethod
+    def _history_prompt(prompt: str, images: Optional[list]) -> str:
+        """寫入歷史的提問：圖片不保存，只留下註記"""
+        if not images:
+            return prompt
+        return f"{prompt}\n{IMAGE_HISTORY_NOTE.format(count=len(images))}"
+
+    async def complete(self, user_id: str, prompt: str, user_settings: dict, channel_context: Optional[list] = None,
+                       images: Optional[list] = None, usage: Optional[dict] = None, job_id: Optional[int] = None) -> str:
+        """一次取得完整回應；傳入 usage 字典時填入實際回答的模型與 token 用量 (供用量帳本記錄)
+
+        job_id 為工作行程處理的工作：工作重新排入前已寫入的回覆直接沿用，不再呼叫模型。
+        """
+        if job_id is not None and user_settings["remember_context"]:
+            stored = await db_manager.get_job_reply(user_id, job_id)
+            if stored is not None:
+                return stored
+        messages_for_api = await self.build_messages(user_id, prompt, user_settings, channel_context, images)
+
+        route = {"model": user_settings["model"]}
+        with metrics.timed("openai"):
+            if self.router:
+                response = await self.router.complete(model=user_settings["model"], messages=messages_for_api, route=route)
+            else:
+                response = await self.completions.complete(model=user_settings["model"], messages=messages_for_api)
+        reply_content = response.choices[0].message.content.strip()
+        if response.usage:
+            prompt_tokens, completion_tokens = response.usage.prompt_tokens, response.usage.completion_tokens
+            metrics.record_usage(route["model"], prompt_tokens, completion_tokens)
+        else:
+            prompt_tokens = sum(message_tokens(m["content"]) for m in messages_for_api)
+            completion_tokens = message_tokens(reply_content)
+        if usage is not None:
+            usage.update(model=route["model"], prompt_tokens=prompt_tokens, completion_tokens=completion_tokens)
+
+        await self.persist_turn(user_id, self._history_prompt(prompt, images), reply_content, user_settings,
+                                model_used=route["model"], job_id=job_id)
+        return reply_content
+
+    async def stream(self, user_id: str, prompt: str, user_settings: dict, reply,
+                     channel_context: Optional[list] = None, images: Optional[list] = None,
+                     usage: Optional[dict] = None) -> str:
+        """以串流呼叫模型，邊產生邊交給 reply (需提供 feed/finish/text/first_token_at，例如 StreamingReply)"""
+        messages_for_api = await self.build_messages(user_id, prompt, user_settings, channel_context, images)
+
+        reported = {}
+        route = {"model": user_settings["model"]}
+        if self.router:
+            deltas = self.router.stream(model=user_settings["model"], messages=messages_for_api, usage=reported, route=route)
+        else:
+            deltas = self.completions.stream(model=user_settings["model"], messages=messages_for_api, usage=reported)
+        started = time.monotonic()
+        with metrics.timed("openai"):
+            async for delta in deltas:
+                await reply.feed(delta)
+        if reply.first_token_at is not None:
+            metrics.STAGE_SECONDS.observe(reply.first_token_at - started, stage="openai_first_token")
+        with metrics.timed("discord_reply"):
+            await reply.finish()
+        reply_content = reply.text.strip()
+        if not reported:
+            # 上游未回報用量時以估算值代替
+            reported = {"prompt_tokens": sum(message_tokens(m["content"]) for m in messages_for_api),
+                        "completion_tokens": message_tokens(reply_content)}
+        metrics.record_usage(route["model"], reported["prompt_tokens"], reported["completion_tokens"])
+        if usage is not None:
+            usage.update(model=route["model"], prompt_tokens=reported["prompt_tokens"],
+                         completion_tokens=reported["completion_tokens"])
+
+        await self.persist_turn(user_id, self._history_prompt(prompt, images), reply_content, user_settings, model_used=route["model"])
+        return reply_content
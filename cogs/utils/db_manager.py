@@ -1,160 +1,1058 @@
 import sqlite3
+import asyncio
+import time
 import datetime
 import logging
-from typing import Optional
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, Callable
 from pathlib import Path
 
+from . import metrics
+from .cache import LRUCache
+from .history_cache import ConversationWindowCache
+from .tokens import message_tokens, select_within_budget
+
 logger = logging.getLogger("discord_bot")
 
 
 DATA_DIR = Path(__file__).resolve().parents[2] / "data"
 DB_PATH = DATA_DIR / "user_chat_history.db"
 
-# --- 初始化函式 ---
-def init_db():
-    """初始化所有資料庫表格"""
-    DATA_DIR.mkdir(parents=True, exist_ok=True)
+# 預設儲存引擎設定值 (可由 config.json 的 "database" 區塊覆寫)
+DEFAULT_DB_SETTINGS = {
+    "read_pool_size": 4,
+    "busy_timeout_ms": 5000,
+    "cache_size_kb": 16384,
+    "mmap_size_mb": 64
+}
 
-    with sqlite3.connect(DB_PATH) as conn:
-        cursor = conn.cursor()
-        # 聊天歷史紀錄表格
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS chat_history (
-                id INTEGER PRIMARY KEY AUTOINCREMENT, user_id TEXT NOT NULL, role TEXT NOT NULL,
-                content TEXT NOT NULL, model_used TEXT, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_user_id_timestamp ON chat_history (user_id, timestamp);")
+# 預設聊天紀錄寫入緩衝設定值：累積到指定筆數或經過指定秒數即合併成一筆交易寫入
+DEFAULT_WRITE_BEHIND_SETTINGS = {
+    "history_flush_rows": 64,
+    "history_flush_interval": 1.0
+}
 
-        # 使用者個人化設定表格
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS user_settings (
-                user_id TEXT PRIMARY KEY, model TEXT, remember_context INTEGER, system_prompt TEXT
-            )
-        """)
-        
-        # 監聽頻道列表表格
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS listened_channels (
-                channel_id TEXT PRIMARY KEY, guild_id TEXT NOT NULL,
-                added_by_id TEXT NOT NULL, timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
+# 預設使用者設定快取：容量 (人數) 與存活秒數
+DEFAULT_SETTINGS_CACHE_SETTINGS = {
+    "settings_cache_size": 4096,
+    "settings_cache_ttl": 3600
+}
+
+# 預設對話視窗快取：每人保留的則數、全域記憶體上限與閒置淘汰秒數
+DEFAULT_HISTORY_CACHE_SETTINGS = {
+    "history_window_size": 50,
+    "history_cache_max_bytes": 32 * 1024 * 1024,
+    "history_cache_idle_ttl": 1800
+}
+
+# 多個行程同時服務同一批使用者時 (分片範圍模式，同一人的私訊與伺服器訊息可能落在不同行程)，
+# 各行程的記憶體快取無法互相失效：設定與摘要快取只保留 shared_cache_ttl 秒、停用對話視窗快取，聊天紀錄不經緩衝直接寫入
+DEFAULT_SHARED_PROCESS_SETTINGS = {
+    "shared_cache_ttl": 2
+}
+
+# 寫入統計 (交易提交次數、緩衝寫入的列數)
+write_stats = {"commits": 0, "history_rows_flushed": 0}
+
+# --- 儲存引擎 ---
+class _StorageEngine:
+    """長駐的 SQLite 連線：單一寫入執行緒 + 讀取連線池，所有 I/O 都不在事件迴圈上執行"""
+
+    def __init__(self, db_path: Path, read_pool_size: int = 4, busy_timeout_ms: int = 5000,
+                 cache_size_kb: int = 16384, mmap_size_mb: int = 64):
+        self.db_path = db_path
+        self.busy_timeout_ms = int(busy_timeout_ms)
+        self.cache_size_kb = int(cache_size_kb)
+        self.mmap_size_mb = int(mmap_size_mb)
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer",
+                                          initializer=self._open_connection, initargs=(False,))
+        self._readers = ThreadPoolExecutor(max_workers=max(1, int(read_pool_size)), thread_name_prefix="db-reader",
+                                           initializer=self._open_connection, initargs=(True,))
+
+    def _open_connection(self, read_only: bool):
+        """在執行緒初始化時建立該執行緒專屬的連線並套用 pragma"""
+        conn = sqlite3.connect(self.db_path, timeout=self.busy_timeout_ms / 1000, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute(f"PRAGMA busy_timeout = {self.busy_timeout_ms}")
+        if not read_only:
+            # 新建立的資料庫使用增量式自動清理，刪除後的空頁可以分批歸還給檔案系統
+            conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        conn.execute(f"PRAGMA cache_size = -{self.cache_size_kb}")
+        conn.execute(f"PRAGMA mmap_size = {self.mmap_size_mb * 1024 * 1024}")
+        if read_only:
+            conn.execute("PRAGMA query_only = 1")
+        self._local.conn = conn
+        with self._connections_lock:
+            self._connections.append(conn)
+
+    def _run_write(self, func: Callable, args: tuple):
+        conn = self._local.conn
+        try:
+            result = func(conn, *args)
+            conn.commit()
+            write_stats["commits"] += 1
+            return result
+        except Exception:
+            conn.rollback()
+            raise
+
+    def _run_read(self, func: Callable, args: tuple):
+        return func(self._local.conn, *args)
+
+    async def write(self, func: Callable, *args):
+        """在寫入執行緒上以單一交易執行 func(conn, *args)"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._writer, self._run_write, func, args)
+
+    async def read(self, func: Callable, *args):
+        """在讀取連線池上執行 func(conn, *args)"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._readers, self._run_read, func, args)
+
+    def close(self):
+        """等待排隊中的工作完成後關閉所有連線"""
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+        with self._connections_lock:
+            for conn in self._connections:
+                conn.close()
+            self._connections.clear()
+
+
+_engine: Optional[_StorageEngine] = None
+
+# --- 聊天紀錄寫入緩衝 (write-behind) ---
+_pending_history: list = []
+_flushing_history: list = []
+_flush_lock: Optional[asyncio.Lock] = None
+_flush_task: Optional[asyncio.Task] = None
+_write_behind = dict(DEFAULT_WRITE_BEHIND_SETTINGS)
+_cache_windows = True
+
+# --- 使用者設定快取 (以 user_id 為鍵，值為資料列內容；空字典代表尚無設定) ---
+settings_cache = LRUCache(DEFAULT_SETTINGS_CACHE_SETTINGS["settings_cache_size"],
+                          DEFAULT_SETTINGS_CACHE_SETTINGS["settings_cache_ttl"])
+
+# --- 對話摘要快取 (值為摘要資料列；空字典代表尚無摘要) ---
+summary_cache = LRUCache(DEFAULT_SETTINGS_CACHE_SETTINGS["settings_cache_size"])
+
+# --- 對話視窗快取 (每位使用者最近的對話，避免每則訊息都查詢資料庫) ---
+history_cache = ConversationWindowCache(*DEFAULT_HISTORY_CACHE_SETTINGS.values())
+
+def _get_engine() -> _StorageEngine:
+    if _engine is None:
+        raise RuntimeError("資料庫尚未初始化，請先呼叫 init_db()。")
+    return _engine
+
+# --- 資料表結構與版本遷移 ---
+# 結構版本記錄於 PRAGMA user_version。版本 0 為舊版：ID 以 TEXT 保存、時間戳記為 Python 格式化字串、
+# 系統提示以 chat_history 中的佔位列表示。新版一律以整數保存 Discord snowflake ID 與毫秒時間戳記。
+SCHEMA_VERSION = 5
+MIGRATION_CHUNK_ROWS = 5000
+
+_TABLE_SCHEMAS = {
+    # 聊天歷史紀錄：只保存 user/assistant 對話，系統提示以 user_settings.system_prompt (或預設值) 為準；
+    # job_id 為產生這段對話的工作佇列工作 (工作行程模式)，工作重新排入時用來避免重複寫入
+    "chat_history": """
+        CREATE TABLE IF NOT EXISTS {name} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, role TEXT NOT NULL,
+            content TEXT NOT NULL, model_used TEXT, created_at INTEGER NOT NULL, token_count INTEGER, job_id INTEGER
+        )
+    """,
+    # 對話滾動摘要：summarized_until_id 之前 (含) 的紀錄已被摺疊進摘要
+    "conversation_summaries": """
+        CREATE TABLE IF NOT EXISTS {name} (
+            user_id INTEGER PRIMARY KEY, summary TEXT NOT NULL, summarized_until_id INTEGER NOT NULL,
+            token_count INTEGER NOT NULL, updated_at INTEGER NOT NULL
+        )
+    """,
+    # 無上下文回應快取 (以 模型/系統提示/提問 的雜湊為鍵，跨重啟保留)
+    "response_cache": """
+        CREATE TABLE IF NOT EXISTS {name} (
+            cache_key TEXT PRIMARY KEY, model TEXT NOT NULL, response TEXT NOT NULL, created_at REAL NOT NULL
+        )
+    """,
+    # 使用者個人化設定
+    "user_settings": """
+        CREATE TABLE IF NOT EXISTS {name} (
+            user_id INTEGER PRIMARY KEY, model TEXT, remember_context INTEGER, system_prompt TEXT
+        )
+    """,
+    # 監聽頻道列表；context_mode 為 'user' (各自的歷史) 或 'channel' (共享頻道上下文)
+    "listened_channels": """
+        CREATE TABLE IF NOT EXISTS {name} (
+            channel_id INTEGER PRIMARY KEY, guild_id INTEGER NOT NULL, added_by_id INTEGER NOT NULL,
+            created_at INTEGER NOT NULL, context_mode TEXT NOT NULL DEFAULT 'user'
+        )
+    """,
+    # 頻道上下文模式的近期發言 (記憶體視窗的延遲寫入副本，每個頻道只保留最近的數百則)
+    "channel_messages": """
+        CREATE TABLE IF NOT EXISTS {name} (
+            id INTEGER PRIMARY KEY AUTOINCREMENT, channel_id INTEGER NOT NULL, author_id INTEGER NOT NULL,
+            author_name TEXT NOT NULL, role TEXT NOT NULL, content TEXT NOT NULL, created_at INTEGER NOT NULL,
+            token_count INTEGER NOT NULL
+        )
+    """,
+    # 每日用量彙總 (day 為 UTC 紀元日數，私訊的 guild_id 為 0)；由記憶體帳本批次累加寫入
+    "usage_daily": """
+        CREATE TABLE IF NOT EXISTS {name} (
+            day INTEGER NOT NULL, user_id INTEGER NOT NULL, guild_id INTEGER NOT NULL, model TEXT NOT NULL,
+            requests INTEGER NOT NULL, prompt_tokens INTEGER NOT NULL, completion_tokens INTEGER NOT NULL,
+            PRIMARY KEY (day, user_id, guild_id, model)
+        ) WITHOUT ROWID
+    """
+}
+
+_INDEXES = (
+    # 上下文查詢 (WHERE user_id = ? ORDER BY id DESC) 的覆蓋索引：依序走訪即可，token 預算與則數統計不需回表
+    "CREATE INDEX IF NOT EXISTS idx_chat_history_user_turns ON chat_history (user_id, id, role, token_count)",
+    "CREATE INDEX IF NOT EXISTS idx_listened_channels_guild ON listened_channels (guild_id)",
+    "CREATE INDEX IF NOT EXISTS idx_channel_messages_channel ON channel_messages (channel_id, id)",
+    "CREATE INDEX IF NOT EXISTS idx_chat_history_job ON chat_history (job_id) WHERE job_id IS NOT NULL",
+)
+
+def _now_ms() -> int:
+    return int(time.time() * 1000)
+
+def _to_epoch_ms(value) -> int:
+    """將舊版的時間戳記 (Python 或 SQLite 格式的字串，視為本地時間) 轉為毫秒"""
+    if isinstance(value, (int, float)):
+        return int(value)
+    try:
+        return int(datetime.datetime.fromisoformat(str(value)).timestamp() * 1000)
+    except (TypeError, ValueError):
+        return _now_ms()
+
+def _from_epoch_ms(value: int) -> datetime.datetime:
+    return datetime.datetime.fromtimestamp(value / 1000)
+
+def _create_schema(conn: sqlite3.Connection):
+    for name, ddl in _TABLE_SCHEMAS.items():
+        conn.execute(ddl.format(name=name))
+    for ddl in _INDEXES:
+        conn.execute(ddl)
+
+def _table_columns(conn: sqlite3.Connection, name: str) -> set:
+    return {row[1] for row in conn.execute(f"PRAGMA table_info({name})")}
+
+def _read_schema_state(conn: sqlite3.Connection):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    return version, bool(_table_columns(conn, "chat_history"))
+
+def _begin_migration(conn: sqlite3.Connection, target: int) -> bool:
+    """以 BEGIN IMMEDIATE 取得資料庫寫入鎖後重新讀取版本；其他行程已完成這一步時返回 False (略過)
+
+    閘道與工作行程 (或多個分片) 可能同時啟動並遷移同一個資料庫，每一步都在寫入鎖內確認版本，
+    後到的行程會等待先到的行程提交，再發現該步驟已完成而跳過。
+    """
+    conn.execute("BEGIN IMMEDIATE")
+    return conn.execute("PRAGMA user_version").fetchone()[0] < target
+
+def _create_fresh_schema(conn: sqlite3.Connection) -> bool:
+    """全新的資料庫直接建立最新結構；其他行程已先建立 (或資料庫並非全新) 時返回 False"""
+    if not _begin_migration(conn, 1) or _table_columns(conn, "chat_history"):
+        return False
+    _create_schema(conn)
+    conn.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+    return True
+
+def _rebuild_table(conn: sqlite3.Connection, name: str, select_sql: str, columns: Optional[str] = None):
+    """以新結構重建一張 (小型) 表格：建立新表、轉換複製、刪除舊表後改名"""
+    if not _table_columns(conn, name):
+        return
+    conn.execute(_TABLE_SCHEMAS[name].format(name=f"{name}_v2"))
+    target = f"{name}_v2 ({columns})" if columns else f"{name}_v2"
+    conn.execute(f"INSERT INTO {target} {select_sql}")
+    conn.execute(f"DROP TABLE {name}")
+    conn.execute(f"ALTER TABLE {name}_v2 RENAME TO {name}")
+
+def _migrate_small_tables(conn: sqlite3.Connection):
+    if not _begin_migration(conn, 1):
+        return
+    conn.create_function("epoch_ms", 1, _to_epoch_ms, deterministic=True)
+    _rebuild_table(conn, "user_settings", """
+        SELECT CAST(user_id AS INTEGER), model, remember_context, system_prompt FROM user_settings
+    """)
+    _rebuild_table(conn, "listened_channels", """
+        SELECT CAST(channel_id AS INTEGER), CAST(guild_id AS INTEGER), CAST(added_by_id AS INTEGER), epoch_ms(timestamp)
+        FROM listened_channels
+    """, columns="channel_id, guild_id, added_by_id, created_at")
+    _rebuild_table(conn, "conversation_summaries", """
+        SELECT CAST(user_id AS INTEGER), summary, summarized_until_id, token_count, epoch_ms(updated_at)
+        FROM conversation_summaries
+    """)
+    conn.execute("PRAGMA user_version = 1")
+
+async def _migrate_to_v1(engine: "_StorageEngine"):
+    """v1：設定、監聽頻道與摘要表格改用整數 ID 與毫秒時間戳記 (資料量小，單一交易完成)"""
+    await engine.write(_migrate_small_tables)
+
+def _copy_history_chunk(conn: sqlite3.Connection, after_id: int, chunk_rows: int) -> Optional[int]:
+    conn.create_function("epoch_ms", 1, _to_epoch_ms, deterministic=True)
+    last_id = conn.execute(
+        "SELECT MAX(id) FROM (SELECT id FROM chat_history WHERE id > ? ORDER BY id LIMIT ?)", (after_id, chunk_rows)
+    ).fetchone()[0]
+    if last_id is None:
+        return None
+    token_count = "token_count" if "token_count" in _table_columns(conn, "chat_history") else "NULL"
+    # 系統提示佔位列不再需要：實際送出的系統提示一向取自使用者設定 (或預設值)
+    conn.execute(f"""
+        INSERT OR IGNORE INTO chat_history_v2 (id, user_id, role, content, model_used, created_at, token_count)
+        SELECT id, CAST(user_id AS INTEGER), role, content, model_used, epoch_ms(timestamp), {token_count}
+        FROM chat_history WHERE id > ? AND id <= ? AND role != 'system'
+    """, (after_id, last_id))
+    return last_id
+
+def _copy_history_step(conn: sqlite3.Connection, after_id: int, chunk_rows: int) -> Optional[int]:
+    if not _begin_migration(conn, 2):
+        return None
+    return _copy_history_chunk(conn, after_id, chunk_rows)
+
+def _prepare_history_copy(conn: sqlite3.Connection) -> Optional[int]:
+    if not _begin_migration(conn, 2):
+        return None
+    conn.execute(_TABLE_SCHEMAS["chat_history"].format(name="chat_history_v2"))
+    # 中斷後重新啟動時從已複製的位置繼續
+    return conn.execute("SELECT COALESCE(MAX(id), 0) FROM chat_history_v2").fetchone()[0]
+
+def _finish_history_copy(conn: sqlite3.Connection, after_id: int):
+    if not _begin_migration(conn, 2):
+        return
+    while after_id is not None:
+        after_id = _copy_history_chunk(conn, after_id, MIGRATION_CHUNK_ROWS)
+    conn.execute("DROP TABLE chat_history")
+    conn.execute("ALTER TABLE chat_history_v2 RENAME TO chat_history")
+    conn.execute(_INDEXES[0])
+    conn.execute("PRAGMA user_version = 2")
+
+async def _migrate_to_v2(engine: "_StorageEngine"):
+    """v2：chat_history 改用整數 ID、毫秒時間戳記與覆蓋索引，並移除系統提示佔位列
+
+    以多個短交易分批複製到新表 (不長時間佔用寫入執行緒、可中斷續傳)，最後在單一交易中切換。
+    """
+    after_id = await engine.write(_prepare_history_copy)
+    if after_id is None:
+        return
+    copied = 0
+    while True:
+        last_id = await engine.write(_copy_history_step, after_id, MIGRATION_CHUNK_ROWS)
+        if last_id is None:
+            break
+        copied += 1
+        after_id = last_id
+        if copied % 20 == 0:
+            logger.info(f"遷移 chat_history 中：已處理至 id {after_id}。")
+        await asyncio.sleep(0)
+    await engine.write(_finish_history_copy, after_id)
+
+def _add_channel_context(conn: sqlite3.Connection):
+    if not _begin_migration(conn, 3):
+        return
+    columns = _table_columns(conn, "listened_channels")
+    if columns and "context_mode" not in columns:
+        conn.execute("ALTER TABLE listened_channels ADD COLUMN context_mode TEXT NOT NULL DEFAULT 'user'")
+    conn.execute(_TABLE_SCHEMAS["channel_messages"].format(name="channel_messages"))
+    conn.execute(_INDEXES[2])
+    conn.execute("PRAGMA user_version = 3")
+
+async def _migrate_to_v3(engine: "_StorageEngine"):
+    """v3：監聽頻道可個別切換為頻道上下文模式，並新增保存頻道近期發言的表格"""
+    await engine.write(_add_channel_context)
+
+def _add_usage_ledger(conn: sqlite3.Connection):
+    if not _begin_migration(conn, 4):
+        return
+    conn.execute(_TABLE_SCHEMAS["usage_daily"].format(name="usage_daily"))
+    conn.execute("PRAGMA user_version = 4")
+
+async def _migrate_to_v4(engine: "_StorageEngine"):
+    """v4：新增每日用量彙總表格 (用量帳本與配額)"""
+    await engine.write(_add_usage_ledger)
+
+def _add_history_job_id(conn: sqlite3.Connection):
+    if not _begin_migration(conn, 5):
+        return
+    if "job_id" not in _table_columns(conn, "chat_history"):
+        conn.execute("ALTER TABLE chat_history ADD COLUMN job_id INTEGER")
+    conn.execute(_INDEXES[3])
+    conn.execute("PRAGMA user_version = 5")
+
+async def _migrate_to_v5(engine: "_StorageEngine"):
+    """v5：聊天紀錄記錄產生它的工作 ID (工作重新排入時不重複寫入同一段對話)"""
+    await engine.write(_add_history_job_id)
+
+_MIGRATIONS = (
+    (1, _migrate_to_v1),
+    (2, _migrate_to_v2),
+    (3, _migrate_to_v3),
+    (4, _migrate_to_v4),
+    (5, _migrate_to_v5),
+)
+
+async def _apply_migrations(engine: "_StorageEngine"):
+    """將資料庫升級到 SCHEMA_VERSION；全新的資料庫直接建立最新結構"""
+    version, has_history = await engine.write(_read_schema_state)
+    if version == 0 and not has_history and await engine.write(_create_fresh_schema):
+        return
+    for target, migrate in _MIGRATIONS:
+        if version < target:
+            started = time.monotonic()
+            logger.info(f"正在將資料庫結構從版本 {version} 遷移至 {target}...")
+            await migrate(engine)
+            version = target
+            logger.info(f"資料庫結構已遷移至版本 {target} (耗時 {time.monotonic() - started:.1f}s)。")
+    # 補上舊版資料庫可能缺少的表格與索引
+    await engine.write(_create_schema)
+
+async def init_db(options: Optional[dict] = None, shared_process: bool = False):
+    """開啟儲存引擎並初始化所有資料庫表格
+
+    shared_process 為 True 表示其他行程也會處理同一批使用者的訊息，改用 DEFAULT_SHARED_PROCESS_SETTINGS 的快取策略。
+    """
+    global _engine, _flush_lock, _flush_task, _cache_windows, settings_cache, summary_cache, history_cache
+    options = options or {}
+    if _engine is None:
+        DATA_DIR.mkdir(parents=True, exist_ok=True)
+        engine_settings = {key: options.get(key, default) for key, default in DEFAULT_DB_SETTINGS.items()}
+        _engine = _StorageEngine(DB_PATH, **engine_settings)
+        _write_behind.update({key: options.get(key, default) for key, default in DEFAULT_WRITE_BEHIND_SETTINGS.items()})
+        settings_ttl = options.get("settings_cache_ttl", DEFAULT_SETTINGS_CACHE_SETTINGS["settings_cache_ttl"])
+        summary_ttl = None
+        _cache_windows = not shared_process
+        if shared_process:
+            shared_ttl = options.get("shared_cache_ttl", DEFAULT_SHARED_PROCESS_SETTINGS["shared_cache_ttl"])
+            settings_ttl = min(settings_ttl, shared_ttl) if settings_ttl else shared_ttl
+            summary_ttl = shared_ttl
+            _write_behind["history_flush_rows"] = 1
+            logger.info(f"多行程模式：設定與摘要快取 {shared_ttl}s、停用對話視窗快取、聊天紀錄直接寫入。")
+        settings_cache = LRUCache(options.get("settings_cache_size", DEFAULT_SETTINGS_CACHE_SETTINGS["settings_cache_size"]),
+                                  settings_ttl)
+        summary_cache = LRUCache(options.get("settings_cache_size", DEFAULT_SETTINGS_CACHE_SETTINGS["settings_cache_size"]),
+                                 summary_ttl)
+        history_cache = ConversationWindowCache(*(options.get(key, default) for key, default in DEFAULT_HISTORY_CACHE_SETTINGS.items()))
+        _flush_lock = asyncio.Lock()
+        _flush_task = asyncio.create_task(_periodic_flush())
+    await _apply_migrations(_engine)
     logger.info("資料庫表格初始化或檢查完畢。")
 
+def is_initialized() -> bool:
+    """儲存引擎是否已開啟 (由 bot.py 在啟動時開啟，cogs 重新載入時沿用)"""
+    return _engine is not None
+
+async def close_db():
+    """寫出緩衝中的紀錄並關閉儲存引擎；在執行緒中等待佇列清空，避免阻塞事件迴圈"""
+    global _engine, _flush_task
+    if _engine is None:
+        return
+    if _flush_task is not None:
+        _flush_task.cancel()
+        _flush_task = None
+    await flush_history()
+    engine, _engine = _engine, None
+    await asyncio.get_running_loop().run_in_executor(None, engine.close)
+    logger.info("資料庫連線已關閉。")
+
 # --- 使用者設定 (user_settings) ---
-def get_user_settings(user_id: str, default_settings: dict) -> dict:
-    """獲取指定使用者的設定，若無則返回預設值"""
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute("SELECT * FROM user_settings WHERE user_id = ?", (user_id,))
-        user_row = cursor.fetchone()
-
-        if user_row:
-            settings = dict(user_row)
-            settings["remember_context"] = bool(settings["remember_context"])
-            return settings
-        else:
-            return default_settings
-
-def update_user_setting(user_id: str, key: str, value):
+def _select_user_settings(conn: sqlite3.Connection, user_id: str):
+    return conn.execute(
+        "SELECT model, remember_context, system_prompt FROM user_settings WHERE user_id = ?", (int(user_id),)
+    ).fetchone()
+
+# 快取未命中時正在讀取的使用者 (使用者 → 進行中的讀取數)，以及讀取期間設定被寫入過的使用者；
+# 這些讀取結果可能早於寫入，不放進快取，避免蓋掉寫入時更新的快取內容
+_settings_loads: dict = {}
+_settings_stale: set = set()
+
+def _end_settings_load(user_id: str) -> bool:
+    """結束一次未命中的讀取；讀取期間設定有變動則返回 False"""
+    clean = user_id not in _settings_stale
+    remaining = _settings_loads.get(user_id, 1) - 1
+    if remaining > 0:
+        _settings_loads[user_id] = remaining
+    else:
+        _settings_loads.pop(user_id, None)
+        _settings_stale.discard(user_id)
+    return clean
+
+async def get_user_settings(user_id: str, default_settings: dict) -> dict:
+    """獲取指定使用者的設定 (優先讀取快取)，未設定的欄位以預設值補上"""
+    user_row = settings_cache.get(user_id)
+    if user_row is None:
+        _settings_loads[user_id] = _settings_loads.get(user_id, 0) + 1
+        try:
+            row = await _get_engine().read(_select_user_settings, user_id)
+        finally:
+            clean = _end_settings_load(user_id)
+        user_row = dict(row) if row else {}
+        if clean:
+            settings_cache.set(user_id, user_row)
+
+    if not user_row:
+        return default_settings
+    settings = {**default_settings, **{key: value for key, value in user_row.items() if value is not None}}
+    settings["remember_context"] = bool(settings["remember_context"])
+    return settings
+
+def _upsert_user_setting(conn: sqlite3.Connection, user_id: str, key: str, value):
+    conn.execute("INSERT OR IGNORE INTO user_settings (user_id) VALUES (?)", (int(user_id),))
+    conn.execute(f"UPDATE user_settings SET {key} = ? WHERE user_id = ?", (value, int(user_id)))
+
+async def update_user_setting(user_id: str, key: str, value):
     """更新使用者的單一設定"""
-    with sqlite3.connect(DB_PATH) as conn:
-        cursor = conn.cursor()
-        if isinstance(value, bool):
-            value = 1 if value else 0
-        
-        cursor.execute("INSERT OR IGNORE INTO user_settings (user_id) VALUES (?)", (user_id,))
-        cursor.execute(f"UPDATE user_settings SET {key} = ? WHERE user_id = ?", (value, user_id))
+    if isinstance(value, bool):
+        value = 1 if value else 0
+    await _get_engine().write(_upsert_user_setting, user_id, key, value)
+    if user_id in _settings_loads:
+        _settings_stale.add(user_id)
+
+    # 寫入後同步更新快取 (write-through)；未快取的使用者留待下次讀取時載入
+    cached_row = settings_cache.pop(user_id)
+    if cached_row is not None:
+        settings_cache.set(user_id, {**cached_row, key: value})
 
 # --- 聊天歷史 (chat_history) ---
-def add_message_to_db(user_id: str, role: str, content: str, model_used: Optional[str] = None):
-    """新增一筆聊天紀錄"""
-    with sqlite3.connect(DB_PATH) as conn:
-        cursor = conn.cursor()
+def _insert_messages(conn: sqlite3.Connection, rows: list):
+    # 逐筆插入以取回 rowid (仍在同一筆交易內)，供對話摘要判斷哪些紀錄已被摘要
+    cursor = conn.cursor()
+    for row in rows:
         cursor.execute("""
-            INSERT INTO chat_history (user_id, role, content, model_used, timestamp)
-            VALUES (?, ?, ?, ?, ?)
-        """, (user_id, role, content, model_used, datetime.datetime.now()))
+            INSERT INTO chat_history (user_id, role, content, model_used, created_at, token_count, job_id)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (int(row["user_id"]), row["role"], row["content"], row["model_used"],
+              int(row["timestamp"].timestamp() * 1000), row["token_count"], row["job_id"]))
+        row["id"] = cursor.lastrowid
 
-def get_user_history_from_db(user_id: str, system_prompt: str, limit: int = 11) -> list:
-    """獲取使用者的對話歷史以傳送給API"""
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        messages = []
-        
-        cursor.execute("SELECT 1 FROM chat_history WHERE user_id = ? AND role = 'system'", (user_id,))
-        system_prompt_exists = cursor.fetchone()
-
-        if not system_prompt_exists:
-            add_message_to_db(user_id, "system", system_prompt)
-
-        messages.append({"role": "system", "content": system_prompt})
-
-        num_to_fetch = max(0, limit - 1)
-        if num_to_fetch > 0:
-            cursor.execute("""
-                SELECT role, content FROM chat_history
-                WHERE user_id = ? AND role IN ('user', 'assistant')
-                ORDER BY timestamp DESC LIMIT ?
-            """, (user_id, num_to_fetch))
-            for row in reversed(cursor.fetchall()):
-                messages.append({"role": row["role"], "content": row["content"]})
-        return messages
-
-def clear_user_history_in_db(user_id: str):
-    """清除使用者的對話歷史"""
-    with sqlite3.connect(DB_PATH) as conn:
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM chat_history WHERE user_id = ?", (user_id,))
-
-def get_raw_user_history_for_viewing(user_id: str, limit: int = 10) -> list:
-    """獲取原始對話歷史以供檢視"""
-    with sqlite3.connect(DB_PATH) as conn:
-        conn.row_factory = sqlite3.Row
-        cursor = conn.cursor()
-        cursor.execute("""
-            SELECT role, content, model_used, timestamp FROM chat_history
-            WHERE user_id = ? ORDER BY timestamp DESC LIMIT ?
-        """, (user_id, limit))
-        return cursor.fetchall()
+async def flush_history() -> int:
+    """將緩衝中所有使用者的聊天紀錄以單一交易寫入資料庫，返回寫入筆數"""
+    global _pending_history, _flushing_history
+    if _engine is None or _flush_lock is None:
+        return 0
+    async with _flush_lock:
+        if not _pending_history:
+            return 0
+        _flushing_history, _pending_history = _pending_history, []
+        try:
+            with metrics.timed("db_flush"):
+                await _engine.write(_insert_messages, _flushing_history)
+        except Exception:
+            # 寫入失敗時放回緩衝前端，下次再試
+            _pending_history = _flushing_history + _pending_history
+            raise
+        finally:
+            flushed, _flushing_history = _flushing_history, []
+        write_stats["history_rows_flushed"] += len(flushed)
+        return len(flushed)
+
+async def _periodic_flush():
+    while True:
+        await asyncio.sleep(_write_behind["history_flush_interval"])
+        try:
+            await flush_history()
+        except Exception as e:
+            logger.error(f"定期寫入聊天紀錄失敗：{e}", exc_info=True)
+
+def pending_history_count() -> int:
+    """寫入緩衝中尚未提交的聊天紀錄筆數"""
+    return len(_pending_history) + len(_flushing_history)
+
+def _has_unflushed_history(user_id: str) -> bool:
+    return any(row["user_id"] == user_id for row in _pending_history) or \
+        any(row["user_id"] == user_id for row in _flushing_history)
+
+def _pending_rows_for(user_id: str) -> list:
+    return [row for row in _pending_history if row["user_id"] == user_id]
+
+async def _read_with_pending(user_id: str, func: Callable, *args):
+    """讀取資料庫並附上該使用者尚未寫入的緩衝紀錄 (read-your-writes)"""
+    if not _has_unflushed_history(user_id):
+        return await _get_engine().read(func, *args), []
+    # 持有寫入鎖，確保資料庫快照與緩衝內容之間沒有正在提交的批次
+    async with _flush_lock:
+        result = await _get_engine().read(func, *args)
+        return result, _pending_rows_for(user_id)
+
+async def add_message_to_db(user_id: str, role: str, content: str, model_used: Optional[str] = None,
+                            job_id: Optional[int] = None):
+    """新增一筆聊天紀錄 (先進入寫入緩衝，達到門檻時合併寫入)"""
+    _get_engine()
+    # 緩衝列同時作為對話視窗中的項目，寫入後取得的 id 會直接反映在視窗中
+    row = {
+        "id": None, "user_id": user_id, "role": role, "content": content, "model_used": model_used,
+        "timestamp": datetime.datetime.now(), "token_count": message_tokens(content), "job_id": job_id
+    }
+    history_cache.record(user_id, row)
+    _pending_history.append(row)
+    if len(_pending_history) >= _write_behind["history_flush_rows"]:
+        await flush_history()
+
+def _select_job_reply(conn: sqlite3.Connection, job_id: int):
+    row = conn.execute(
+        "SELECT content FROM chat_history WHERE job_id = ? AND role = 'assistant' LIMIT 1", (job_id,)
+    ).fetchone()
+    return None if row is None else row["content"]
+
+async def get_job_reply(user_id: str, job_id: int) -> Optional[str]:
+    """某個工作已寫入的回覆 (包含尚未寫入的緩衝紀錄)；尚未寫入時返回 None"""
+    stored, pending = await _read_with_pending(user_id, _select_job_reply, job_id)
+    if stored is not None:
+        return stored
+    return next((row["content"] for row in pending if row["job_id"] == job_id and row["role"] == "assistant"), None)
+
+def _select_history_for_api(conn: sqlite3.Connection, user_id: str, num_to_fetch: int):
+    if num_to_fetch <= 0:
+        return []
+    return conn.execute("""
+        SELECT id, role, content, token_count FROM chat_history WHERE user_id = ? ORDER BY id DESC LIMIT ?
+    """, (int(user_id), num_to_fetch)).fetchall()
+
+def _history_turn(row: sqlite3.Row) -> dict:
+    # 舊資料沒有保存 token 數量時才在載入當下估算
+    token_count = row["token_count"]
+    if token_count is None:
+        token_count = message_tokens(row["content"])
+    return {"id": row["id"], "role": row["role"], "content": row["content"], "token_count": token_count}
+
+async def _load_history_window(user_id: str, num_to_fetch: int):
+    """從資料庫 (與寫入緩衝) 載入最近的對話；結果足以涵蓋視窗時安裝至快取"""
+    cacheable = _cache_windows and num_to_fetch <= history_cache.window_size
+    fetch = max(num_to_fetch, history_cache.window_size)
+    history_cache.begin_load(user_id)
+    try:
+        rows, pending = await _read_with_pending(user_id, _select_history_for_api, user_id, fetch)
+    finally:
+        clean = history_cache.end_load(user_id)
+
+    history = [_history_turn(row) for row in reversed(rows)] + pending
+    if cacheable and clean:
+        history_cache.install(user_id, history)
+    return history
+
+async def get_user_history_from_db(user_id: str, system_prompt: str, limit: int = 11,
+                                   token_budget: Optional[int] = None, exclude: Optional[set] = None) -> list:
+    """獲取使用者的對話歷史以傳送給API (活躍使用者直接由記憶體中的對話視窗組成)
+
+    指定 token_budget 時改以 token 預算挑選：系統提示加上由新到舊放得下的對話，忽略 limit。
+    exclude 為 (role, 內容開頭) 集合，以這些內容開頭的對話已經出現在頻道上下文中，不再重複放入
+    (合併送出的提問、附加圖片註記或截斷過的頻道發言都只會是歷史內容的開頭)。
+    """
+    num_to_fetch = history_cache.window_size if token_budget is not None else max(0, limit - 1)
+    window = history_cache.get(user_id) if _cache_windows and num_to_fetch <= history_cache.window_size else None
+    history = list(window.turns) if window is not None else await _load_history_window(user_id, num_to_fetch)
+
+    messages = [{"role": "system", "content": system_prompt}]
+
+    # 已摺疊進滾動摘要的紀錄改以摘要取代
+    summary = await get_conversation_summary(user_id)
+    if summary:
+        history = [turn for turn in history if turn["id"] is None or turn["id"] > summary["summarized_until_id"]]
+        messages.append({"role": "system", "content": SUMMARY_PREFIX + summary["summary"]})
+    if exclude:
+        history = [turn for turn in history
+                   if not any(text and role == turn["role"] and turn["content"].startswith(text) for role, text in exclude)]
+
+    if token_budget is not None:
+        used = message_tokens(system_prompt) + (summary["token_count"] if summary else 0)
+        selected = select_within_budget(history, token_budget - used)
+    else:
+        selected = history[-num_to_fetch:] if num_to_fetch > 0 else []
+
+    messages += [{"role": turn["role"], "content": turn["content"]} for turn in selected]
+    return messages
+
+def _delete_user_history(conn: sqlite3.Connection, user_id: str):
+    conn.execute("DELETE FROM chat_history WHERE user_id = ?", (int(user_id),))
+    conn.execute("DELETE FROM conversation_summaries WHERE user_id = ?", (int(user_id),))
+
+async def clear_user_history_in_db(user_id: str):
+    """清除使用者的對話歷史 (包含尚未寫入的緩衝紀錄)"""
+    global _pending_history
+    engine = _get_engine()
+    history_cache.invalidate(user_id)
+    async with _flush_lock:
+        _pending_history = [row for row in _pending_history if row["user_id"] != user_id]
+        await engine.write(_delete_user_history, user_id)
+    history_cache.invalidate(user_id)
+    summary_cache.set(user_id, {})
+
+def _select_raw_history(conn: sqlite3.Connection, user_id: str, limit: int):
+    rows = conn.execute("""
+        SELECT role, content, model_used, created_at FROM chat_history WHERE user_id = ? ORDER BY id DESC LIMIT ?
+    """, (int(user_id), limit)).fetchall()
+    return [{"role": row["role"], "content": row["content"], "model_used": row["model_used"],
+             "timestamp": _from_epoch_ms(row["created_at"])} for row in rows]
+
+async def get_raw_user_history_for_viewing(user_id: str, limit: int = 10) -> list:
+    """獲取原始對話歷史以供檢視 (由新到舊，timestamp 為 datetime)"""
+    rows, pending = await _read_with_pending(user_id, _select_raw_history, user_id, limit)
+    if not pending:
+        return rows
+    # 緩衝中的紀錄一定比資料庫中的新，依新到舊排列後截斷
+    return (list(reversed(pending)) + list(rows))[:limit]
+
+# --- 對話摘要 (conversation_summaries) ---
+SUMMARY_PREFIX = "以下是你與使用者先前對話的摘要：\n"
+
+def _select_summary(conn: sqlite3.Connection, user_id: str):
+    return conn.execute("""
+        SELECT summary, summarized_until_id, token_count FROM conversation_summaries WHERE user_id = ?
+    """, (int(user_id),)).fetchone()
+
+async def get_conversation_summary(user_id: str) -> Optional[dict]:
+    """獲取使用者的滾動摘要 (優先讀取快取)，若無則返回 None"""
+    summary = summary_cache.get(user_id)
+    if summary is None:
+        row = await _get_engine().read(_select_summary, user_id)
+        summary = dict(row) if row else {}
+        summary_cache.set(user_id, summary)
+    return summary or None
+
+def _select_turns_for_compaction(conn: sqlite3.Connection, user_id: str, after_id: int, keep_recent: int, limit: int):
+    # 保留最新 keep_recent 則原文，只取更舊且尚未摘要的紀錄 (由舊到新)
+    return conn.execute("""
+        SELECT id, role, content FROM chat_history
+        WHERE user_id = ? AND id > ? AND id <= (
+            SELECT id FROM chat_history WHERE user_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?
+        )
+        ORDER BY id ASC LIMIT ?
+    """, (int(user_id), after_id, int(user_id), keep_recent, limit)).fetchall()
+
+async def get_turns_for_compaction(user_id: str, after_id: int, keep_recent: int, limit: int) -> list:
+    """獲取可被摺疊進摘要的舊紀錄"""
+    return await _get_engine().read(_select_turns_for_compaction, user_id, after_id, keep_recent, limit)
+
+def _upsert_summary(conn: sqlite3.Connection, user_id: str, summary: str, until_id: int, token_count: int) -> int:
+    # 若期間歷史已被清除 (紀錄不存在) 則不寫入，避免殘留過期摘要
+    return conn.execute("""
+        INSERT INTO conversation_summaries (user_id, summary, summarized_until_id, token_count, updated_at)
+        SELECT ?, ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM chat_history WHERE id = ? AND user_id = ?)
+        ON CONFLICT (user_id) DO UPDATE SET summary = excluded.summary,
+            summarized_until_id = excluded.summarized_until_id, token_count = excluded.token_count,
+            updated_at = excluded.updated_at
+    """, (int(user_id), summary, until_id, token_count, _now_ms(), until_id, int(user_id))).rowcount
+
+async def save_conversation_summary(user_id: str, summary: str, until_id: int) -> bool:
+    """儲存使用者的滾動摘要並更新快取；返回是否寫入成功"""
+    token_count = message_tokens(SUMMARY_PREFIX + summary)
+    saved = await _get_engine().write(_upsert_summary, user_id, summary, until_id, token_count) > 0
+    if saved:
+        summary_cache.set(user_id, {"summary": summary, "summarized_until_id": until_id, "token_count": token_count})
+    return saved
+
+# --- 回應快取 (response_cache) ---
+def _select_cached_response(conn: sqlite3.Connection, cache_key: str, min_created_at: float):
+    return conn.execute(
+        "SELECT response FROM response_cache WHERE cache_key = ? AND created_at >= ?", (cache_key, min_created_at)
+    ).fetchone()
+
+async def get_cached_response(cache_key: str, ttl: Optional[float] = None) -> Optional[str]:
+    """獲取已保存且未過期的回應，若無則返回 None"""
+    min_created_at = time.time() - ttl if ttl else 0
+    row = await _get_engine().read(_select_cached_response, cache_key, min_created_at)
+    return row["response"] if row else None
+
+def _upsert_cached_response(conn: sqlite3.Connection, cache_key: str, model: str, response: str):
+    conn.execute(
+        "INSERT OR REPLACE INTO response_cache (cache_key, model, response, created_at) VALUES (?, ?, ?, ?)",
+        (cache_key, model, response, time.time())
+    )
+
+async def save_cached_response(cache_key: str, model: str, response: str):
+    """保存一筆回應快取"""
+    await _get_engine().write(_upsert_cached_response, cache_key, model, response)
+
+def _delete_expired_responses(conn: sqlite3.Connection, min_created_at: float) -> int:
+    return conn.execute("DELETE FROM response_cache WHERE created_at < ?", (min_created_at,)).rowcount
+
+async def prune_response_cache(ttl: float) -> int:
+    """刪除過期的回應快取，返回刪除筆數"""
+    return await _get_engine().write(_delete_expired_responses, time.time() - ttl)
+
+# --- 保留政策與空間回收 (retention) ---
+def _invalidate_users(user_ids):
+    """使被刪除紀錄的使用者的對話視窗與摘要快取失效 (快取以字串 ID 為鍵)"""
+    for user_id in user_ids:
+        history_cache.invalidate(str(user_id))
+        summary_cache.pop(str(user_id))
+
+def _scope_clause(scope: Optional[tuple], column: str = "user_id") -> tuple:
+    """只清理部分使用者時的 SQL 條件與參數；scope 為 (分區總數, 分區列表)，與工作佇列相同以 user_id % 分區總數 分區"""
+    if scope is None:
+        return "", ()
+    count, partitions = scope
+    return f" AND {column} % ? IN ({', '.join('?' * len(partitions))})", (count, *partitions)
+
+def _delete_history_rows(conn: sqlite3.Connection, rows: list) -> list:
+    conn.executemany("DELETE FROM chat_history WHERE id = ?", [(row["id"],) for row in rows])
+    return [row["user_id"] for row in rows]
+
+def _purge_history_before(conn: sqlite3.Connection, cutoff: datetime.datetime, chunk_size: int,
+                          scope: Optional[tuple]) -> list:
+    # 依 id (即寫入順序) 由舊到新掃描，最舊的紀錄位於開頭，每批只需讀取少量資料列
+    clause, params = _scope_clause(scope)
+    rows = conn.execute(f"""
+        SELECT id, user_id FROM chat_history WHERE created_at < ?{clause} ORDER BY id LIMIT ?
+    """, (int(cutoff.timestamp() * 1000), *params, chunk_size)).fetchall()
+    return _delete_history_rows(conn, rows)
+
+async def purge_history_before(cutoff: datetime.datetime, chunk_size: int = 500, scope: Optional[tuple] = None) -> int:
+    """刪除一批早於 cutoff 的聊天紀錄，返回刪除筆數 (指定 scope 時只處理這些分區的使用者)"""
+    user_ids = await _get_engine().write(_purge_history_before, cutoff, chunk_size, scope)
+    _invalidate_users(set(user_ids))
+    return len(user_ids)
+
+def _purge_oldest_history(conn: sqlite3.Connection, chunk_size: int, scope: Optional[tuple]) -> list:
+    clause, params = _scope_clause(scope)
+    rows = conn.execute(
+        f"SELECT id, user_id FROM chat_history WHERE 1{clause} ORDER BY id LIMIT ?", (*params, chunk_size)
+    ).fetchall()
+    return _delete_history_rows(conn, rows)
+
+async def purge_oldest_history(chunk_size: int = 500, scope: Optional[tuple] = None) -> int:
+    """不分使用者刪除一批最舊的聊天紀錄 (資料庫容量超過上限時使用)，返回刪除筆數"""
+    user_ids = await _get_engine().write(_purge_oldest_history, chunk_size, scope)
+    _invalidate_users(set(user_ids))
+    return len(user_ids)
+
+def _select_users_over_turn_limit(conn: sqlite3.Connection, max_turns: int, limit: int, scope: Optional[tuple]):
+    clause, params = _scope_clause(scope)
+    return conn.execute(f"""
+        SELECT user_id, COUNT(*) - ? AS excess FROM chat_history WHERE 1{clause}
+        GROUP BY user_id HAVING COUNT(*) > ? ORDER BY excess DESC LIMIT ?
+    """, (max_turns, *params, max_turns, limit)).fetchall()
+
+async def get_users_over_turn_limit(max_turns: int, limit: int = 1000, scope: Optional[tuple] = None) -> list:
+    """找出對話則數超過上限的使用者，返回 (user_id, 超出則數) 列表"""
+    rows = await _get_engine().read(_select_users_over_turn_limit, max_turns, limit, scope)
+    return [(str(row["user_id"]), row["excess"]) for row in rows]
+
+def _purge_user_oldest_turns(conn: sqlite3.Connection, user_id: str, count: int) -> int:
+    return conn.execute("""
+        DELETE FROM chat_history WHERE id IN (
+            SELECT id FROM chat_history WHERE user_id = ? ORDER BY id LIMIT ?
+        )
+    """, (int(user_id), count)).rowcount
+
+async def purge_user_oldest_turns(user_id: str, count: int) -> int:
+    """刪除某位使用者最舊的 count 則對話，返回刪除筆數"""
+    deleted = await _get_engine().write(_purge_user_oldest_turns, user_id, count)
+    _invalidate_users((user_id,))
+    return deleted
+
+def _purge_orphaned_summaries(conn: sqlite3.Connection, cutoff: datetime.datetime, scope: Optional[tuple]) -> list:
+    # 對話已全部被刪除、且很久沒有更新的摘要
+    clause, params = _scope_clause(scope, "s.user_id")
+    rows = conn.execute(f"""
+        SELECT user_id FROM conversation_summaries s WHERE updated_at < ?{clause} AND NOT EXISTS (
+            SELECT 1 FROM chat_history h WHERE h.user_id = s.user_id
+        )
+    """, (int(cutoff.timestamp() * 1000), *params)).fetchall()
+    conn.executemany("DELETE FROM conversation_summaries WHERE user_id = ?", [(row["user_id"],) for row in rows])
+    return [row["user_id"] for row in rows]
+
+async def purge_orphaned_summaries(cutoff: datetime.datetime, scope: Optional[tuple] = None) -> int:
+    """刪除已沒有對應對話且早於 cutoff 的摘要，返回刪除筆數"""
+    user_ids = await _get_engine().write(_purge_orphaned_summaries, cutoff, scope)
+    _invalidate_users(user_ids)
+    return len(user_ids)
+
+def _select_database_size(conn: sqlite3.Connection) -> dict:
+    page_size = conn.execute("PRAGMA page_size").fetchone()[0]
+    page_count = conn.execute("PRAGMA page_count").fetchone()[0]
+    freelist_count = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    auto_vacuum = conn.execute("PRAGMA auto_vacuum").fetchone()[0]
+    return {
+        "page_size": page_size, "page_count": page_count, "freelist_count": freelist_count,
+        "file_bytes": page_count * page_size, "used_bytes": (page_count - freelist_count) * page_size,
+        "auto_vacuum": {0: "none", 1: "full", 2: "incremental"}.get(auto_vacuum, str(auto_vacuum))
+    }
+
+async def get_database_size() -> dict:
+    """返回資料庫的頁數、空頁數與實際使用的位元組數"""
+    return await _get_engine().read(_select_database_size)
+
+def _incremental_vacuum(conn: sqlite3.Connection, pages: int) -> int:
+    before = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    # incremental_vacuum 每歸還一頁就產生一列結果，必須讀完才會執行到底
+    conn.execute(f"PRAGMA incremental_vacuum({int(pages)})").fetchall()
+    after = conn.execute("PRAGMA freelist_count").fetchone()[0]
+    return (before - after) * conn.execute("PRAGMA page_size").fetchone()[0]
+
+async def incremental_vacuum(pages: int = 1000) -> int:
+    """將最多 pages 個空頁歸還給檔案系統，返回回收的位元組數 (資料庫需為增量自動清理模式)"""
+    return await _get_engine().write(_incremental_vacuum, pages)
+
+def _convert_to_incremental_vacuum(conn: sqlite3.Connection):
+    conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+    conn.execute("VACUUM")
+
+async def convert_to_incremental_vacuum():
+    """將既有資料庫轉換為增量自動清理模式；需要完整 VACUUM，期間會阻擋所有寫入"""
+    await _get_engine().write(_convert_to_incremental_vacuum)
 
 # --- 監聽頻道 (listened_channels) ---
-def load_listened_channels_to_cache() -> set:
+CONTEXT_MODES = ("user", "channel")
+
+def _select_all_listened_channels(conn: sqlite3.Connection):
+    return conn.execute("SELECT channel_id FROM listened_channels").fetchall()
+
+async def load_listened_channels_to_cache() -> set:
     """從資料庫載入所有監聽頻道的ID到一個集合中"""
-    with sqlite3.connect(DB_PATH) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT channel_id FROM listened_channels")
-        ids = {int(row[0]) for row in cursor.fetchall()}
-        logger.info(f"從資料庫載入 {len(ids)} 個監聽頻道至快取。")
-        return ids
-
-def add_listened_channel(channel_id: str, guild_id: str, user_id: str) -> bool:
+    rows = await _get_engine().read(_select_all_listened_channels)
+    ids = {int(row[0]) for row in rows}
+    logger.info(f"從資料庫載入 {len(ids)} 個監聽頻道至快取。")
+    return ids
+
+def _insert_listened_channel(conn: sqlite3.Connection, channel_id: str, guild_id: str, user_id: str):
+    conn.execute(
+        "INSERT INTO listened_channels (channel_id, guild_id, added_by_id, created_at) VALUES (?, ?, ?, ?)",
+        (int(channel_id), int(guild_id), int(user_id), _now_ms())
+    )
+
+async def add_listened_channel(channel_id: str, guild_id: str, user_id: str) -> bool:
     """新增一個監聽頻道，如果已存在則返回 False"""
     try:
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "INSERT INTO listened_channels (channel_id, guild_id, added_by_id, timestamp) VALUES (?, ?, ?, ?)",
-                (channel_id, guild_id, user_id, datetime.datetime.now())
-            )
+        await _get_engine().write(_insert_listened_channel, channel_id, guild_id, user_id)
         return True
     except sqlite3.IntegrityError:
-        # PRIMARY KEY a-zsta-raint，表示頻道已存在
+        # 違反 PRIMARY KEY 限制，表示頻道已存在
         return False
 
-def remove_listened_channel(channel_id: str) -> bool:
+def _delete_listened_channel(conn: sqlite3.Connection, channel_id: str) -> int:
+    conn.execute("DELETE FROM channel_messages WHERE channel_id = ?", (int(channel_id),))
+    return conn.execute("DELETE FROM listened_channels WHERE channel_id = ?", (int(channel_id),)).rowcount
+
+async def remove_listened_channel(channel_id: str) -> bool:
     """移除一個監聽頻道，如果成功移除返回 True"""
-    with sqlite3.connect(DB_PATH) as conn:
-        cursor = conn.cursor()
-        cursor.execute("DELETE FROM listened_channels WHERE channel_id = ?", (channel_id,))
-        return conn.total_changes > 0
-
-def get_listened_channels_for_guild(guild_id: str) -> list:
-    """獲取指定伺服器的所有監聽頻道"""
-    with sqlite3.connect(DB_PATH) as conn:
-        cursor = conn.cursor()
-        cursor.execute("SELECT channel_id FROM listened_channels WHERE guild_id = ?", (guild_id,))
-        return cursor.fetchall()
\ No newline at end of file
+    return await _get_engine().write(_delete_listened_channel, channel_id) > 0
+
+def _select_guild_listened_channels(conn: sqlite3.Connection, guild_id: str):
+    return conn.execute("SELECT channel_id, context_mode FROM listened_channels WHERE guild_id = ?", (int(guild_id),)).fetchall()
+
+async def get_listened_channels_for_guild(guild_id: str) -> list:
+    """獲取指定伺服器的所有監聽頻道 (channel_id, context_mode)"""
+    return await _get_engine().read(_select_guild_listened_channels, guild_id)
+
+def _select_channel_context_ids(conn: sqlite3.Connection):
+    return conn.execute("SELECT channel_id FROM listened_channels WHERE context_mode = 'channel'").fetchall()
+
+async def load_channel_context_ids() -> set:
+    """載入所有使用頻道上下文模式的監聽頻道ID"""
+    return {int(row[0]) for row in await _get_engine().read(_select_channel_context_ids)}
+
+def _update_context_mode(conn: sqlite3.Connection, channel_id: str, mode: str) -> int:
+    return conn.execute("UPDATE listened_channels SET context_mode = ? WHERE channel_id = ?", (mode, int(channel_id))).rowcount
+
+async def set_channel_context_mode(channel_id: str, mode: str) -> bool:
+    """切換監聽頻道的上下文模式；頻道不在監聽列表中時返回 False"""
+    if mode not in CONTEXT_MODES:
+        raise ValueError(f"未知的上下文模式：{mode}")
+    return await _get_engine().write(_update_context_mode, channel_id, mode) > 0
+
+# --- 頻道上下文 (channel_messages) ---
+def _insert_channel_messages(conn: sqlite3.Connection, rows: list, keep_per_channel: int):
+    conn.executemany("""
+        INSERT INTO channel_messages (channel_id, author_id, author_name, role, content, created_at, token_count)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+    """, [(int(row["channel_id"]), int(row["author_id"]), row["author_name"], row["role"], row["content"],
+           row["created_at"], row["token_count"]) for row in rows])
+    # 每個頻道只保留最近 keep_per_channel 則
+    for channel_id in {int(row["channel_id"]) for row in rows}:
+        conn.execute("""
+            DELETE FROM channel_messages WHERE channel_id = ? AND id <= (
+                SELECT id FROM channel_messages WHERE channel_id = ? ORDER BY id DESC LIMIT 1 OFFSET ?
+            )
+        """, (channel_id, channel_id, keep_per_channel))
+
+async def add_channel_messages(rows: list, keep_per_channel: int = 200):
+    """以單一交易寫入一批頻道發言並修剪舊紀錄"""
+    await _get_engine().write(_insert_channel_messages, rows, keep_per_channel)
+
+def _select_recent_channel_messages(conn: sqlite3.Connection, channel_id: int, limit: int):
+    return conn.execute("""
+        SELECT author_id, author_name, role, content, created_at, token_count FROM channel_messages
+        WHERE channel_id = ? ORDER BY id DESC LIMIT ?
+    """, (int(channel_id), limit)).fetchall()
+
+async def get_recent_channel_messages(channel_id: int, limit: int) -> list:
+    """頻道最近的發言 (由舊到新)"""
+    rows = await _get_engine().read(_select_recent_channel_messages, channel_id, limit)
+    return [dict(row) for row in reversed(rows)]
+
+def _delete_channel_messages(conn: sqlite3.Connection, channel_id: int):
+    conn.execute("DELETE FROM channel_messages WHERE channel_id = ?", (int(channel_id),))
+
+async def clear_channel_messages(channel_id: int):
+    await _get_engine().write(_delete_channel_messages, channel_id)
+
+# --- 用量彙總 (usage_daily) ---
+def _upsert_usage(conn: sqlite3.Connection, rows: list):
+    conn.executemany("""
+        INSERT INTO usage_daily (day, user_id, guild_id, model, requests, prompt_tokens, completion_tokens)
+        VALUES (?, ?, ?, ?, ?, ?, ?)
+        ON CONFLICT (day, user_id, guild_id, model) DO UPDATE SET
+            requests = requests + excluded.requests,
+            prompt_tokens = prompt_tokens + excluded.prompt_tokens,
+            completion_tokens = completion_tokens + excluded.completion_tokens
+    """, rows)
+
+async def add_usage(rows: list):
+    """以單一交易累加一批用量；rows 為 (day, user_id, guild_id, model, requests, prompt_tokens, completion_tokens)"""
+    await _get_engine().write(_upsert_usage, [
+        (day, int(user_id), int(guild_id or 0), model, requests, prompt_tokens, completion_tokens)
+        for day, user_id, guild_id, model, requests, prompt_tokens, completion_tokens in rows
+    ])
+
+def _select_usage_for_day(conn: sqlite3.Connection, day: int):
+    return conn.execute("""
+        SELECT user_id, guild_id, model, prompt_tokens + completion_tokens AS tokens FROM usage_daily WHERE day = ?
+    """, (day,)).fetchall()
+
+async def get_usage_for_day(day: int) -> list:
+    """某一天 (UTC 紀元日數) 各使用者/伺服器/模型已使用的 token 數，供啟動時重建配額計數"""
+    rows = await _get_engine().read(_select_usage_for_day, day)
+    return [(str(row["user_id"]), str(row["guild_id"]) if row["guild_id"] else None, row["model"], row["tokens"])
+            for row in rows]
+
+def _select_usage_report(conn: sqlite3.Connection, since_day: int, user_id: Optional[int], guild_id: Optional[int],
+                         limit: int) -> dict:
+    conditions, params = ["day >= ?"], [since_day]
+    if user_id is not None:
+        conditions.append("user_id = ?")
+        params.append(user_id)
+    if guild_id is not None:
+        conditions.append("guild_id = ?")
+        params.append(guild_id)
+    where = " AND ".join(conditions)
+    totals = "SUM(requests) AS requests, SUM(prompt_tokens) AS prompt_tokens, SUM(completion_tokens) AS completion_tokens"
+    return {
+        "models": [dict(row) for row in conn.execute(
+            f"SELECT model, {totals} FROM usage_daily WHERE {where} GROUP BY model "
+            f"ORDER BY SUM(prompt_tokens + completion_tokens) DESC", params)],
+        "users": [dict(row) for row in conn.execute(
+            f"SELECT user_id, {totals} FROM usage_daily WHERE {where} GROUP BY user_id "
+            f"ORDER BY SUM(prompt_tokens + completion_tokens) DESC LIMIT ?", params + [limit])],
+        "guilds": [dict(row) for row in conn.execute(
+            f"SELECT guild_id, {totals} FROM usage_daily WHERE {where} GROUP BY guild_id "
+            f"ORDER BY SUM(prompt_tokens + completion_tokens) DESC LIMIT ?", params + [limit])],
+    }
+
+async def get_usage_report(since_day: int, user_id: Optional[str] = None, guild_id: Optional[str] = None,
+                           limit: int = 10) -> dict:
+    """從每日彙總讀取 since_day 之後 (含) 依模型、使用者與伺服器加總的用量 (guild_id 為 0 代表私訊)"""
+    return await _get_engine().read(_select_usage_report, since_day,
+                                    None if user_id is None else int(user_id),
+                                    None if guild_id is None else int(guild_id), limit)
+
+def _delete_usage_before(conn: sqlite3.Connection, before_day: int) -> int:
+    return conn.execute("DELETE FROM usage_daily WHERE day < ?", (before_day,)).rowcount
+
+async def prune_usage(before_day: int) -> int:
+    """刪除 before_day 之前的每日彙總，返回刪除筆數"""
+    return await _get_engine().write(_delete_usage_before, before_day)
@@ -0,0 +1,133 @@
+import time
+from collections import OrderedDict, deque
+from typing import Optional
+
+
+class _ConversationWindow:
+    """單一使用者最近對話的環狀緩衝區"""
+    __slots__ = ("turns", "size_bytes", "last_access")
+
+    def __init__(self, max_turns: int):
+        self.turns = deque(maxlen=max_turns)
+        self.size_bytes = 0
+        self.last_access = time.monotonic()
+
+
+def _turn_size(turn: dict) -> int:
+    # 以 UTF-8 長度加上固定的物件開銷估算記憶體用量
+    return len(turn["content"].encode("utf-8")) + 64
+
+
+class ConversationWindowCache:
+    """每位使用者最近 N 則對話的記憶體快取；依 LRU 與閒置時間淘汰，並受全域記憶體上限約束"""
+
+    def __init__(self, window_size: int = 20, max_bytes: int = 32 * 1024 * 1024, idle_ttl: Optional[float] = 1800):
+        self.window_size = max(1, int(window_size))
+        self.max_bytes = int(max_bytes)
+        self.idle_ttl = float(idle_ttl) if idle_ttl else None
+        self._windows: "OrderedDict[str, _ConversationWindow]" = OrderedDict()
+        self._loaders: dict = {}
+        self._dirty: set = set()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._windows)
+
+    def begin_load(self, user_id: str):
+        """標記開始從資料庫載入某位使用者的視窗"""
+        self._loaders[user_id] = self._loaders.get(user_id, 0) + 1
+
+    def end_load(self, user_id: str) -> bool:
+        """結束載入；若載入期間對話有變動則返回 False，呼叫端不應安裝該結果"""
+        clean = user_id not in self._dirty
+        remaining = self._loaders.get(user_id, 1) - 1
+        if remaining > 0:
+            self._loaders[user_id] = remaining
+        else:
+            self._loaders.pop(user_id, None)
+            self._dirty.discard(user_id)
+        return clean
+
+    def _mark_dirty(self, user_id: str):
+        if user_id in self._loaders:
+            self._dirty.add(user_id)
+
+    def get(self, user_id: str) -> Optional[_ConversationWindow]:
+        self._expire_idle()
+        window = self._windows.get(user_id)
+        if window is None:
+            self.misses += 1
+            return None
+        window.last_access = time.monotonic()
+        self._windows.move_to_end(user_id)
+        self.hits += 1
+        return window
+
+    def install(self, user_id: str, turns: list):
+        """安裝從資料庫載入的對話視窗"""
+        self.invalidate(user_id)
+        window = _ConversationWindow(self.window_size)
+        self._windows[user_id] = window
+        for turn in turns[-self.window_size:]:
+            self._append(window, turn)
+        self._enforce_limits()
+
+    def record(self, user_id: str, turn: dict):
+        """新的一則紀錄寫入時同步更新已快取的視窗"""
+        self._mark_dirty(user_id)
+        window = self._windows.get(user_id)
+        if window is None:
+            return
+        self._append(window, turn)
+        self._enforce_limits()
+
+    def invalidate(self, user_id: Optional[str] = None):
+        """使指定使用者 (未指定時為全部) 的快取失效"""
+        if user_id is None:
+            self._dirty.update(self._loaders)
+            self._windows.clear()
+            self.total_bytes = 0
+            return
+        self._mark_dirty(user_id)
+        window = self._windows.pop(user_id, None)
+        if window is not None:
+            self.total_bytes -= window.size_bytes
+
+    def _append(self, window: _ConversationWindow, turn: dict):
+        if len(window.turns) == window.turns.maxlen:
+            dropped = _turn_size(window.turns[0])
+            window.size_bytes -= dropped
+            self.total_bytes -= dropped
+        window.turns.append(turn)
+        size = _turn_size(turn)
+        window.size_bytes += size
+        self.total_bytes += size
+
+    def _evict_oldest(self):
+        user_id, window = self._windows.popitem(last=False)
+        self.total_bytes -= window.size_bytes
+        self.evictions += 1
+
+    def _enforce_limits(self):
+        while self._windows and self.total_bytes > self.max_bytes:
+            self._evict_oldest()
+
+    def _expire_idle(self):
+        if self.idle_ttl is None:
+            return
+        deadline = time.monotonic() - self.idle_ttl
+        while self._windows:
+            oldest = next(iter(self._windows.values()))
+            if oldest.last_access >= deadline:
+                break
+            self._evict_oldest()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "users": len(self._windows), "bytes": self.total_bytes, "hits": self.hits,
+            "misses": self.misses, "evictions": self.evictions, "hit_rate": self.hits / total if total else 0.0
+        }
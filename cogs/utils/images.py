@@ -0,0 +1,253 @@
+import io
+import base64
+import asyncio
+import hashlib
+import logging
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional
+
+from . import metrics
+from .cache import LRUCache
+
+logger = logging.getLogger("discord_bot")
+
+# 預設圖片附件設定值 (可由 config.json 的 "vision" 區塊覆寫)
+DEFAULT_VISION_SETTINGS = {
+    "enabled": True,
+    "models": ["gpt-4o", "gpt-4-turbo"],
+    "fallback_model": "gpt-4o",
+    "max_images": 4,
+    "max_bytes": 8 * 1024 * 1024,
+    "max_pixels": 40_000_000,
+    "max_dimension": 1024,
+    "quality": 80,
+    "detail": "auto",
+    "download_timeout": 15,
+    "executor": "thread",
+    "pool_size": 2,
+    "cache_size": 256,
+    "cache_ttl": 3600
+}
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".gif", ".webp", ".bmp")
+
+# 只附上圖片而沒有文字時使用的提問
+DEFAULT_IMAGE_PROMPT = "請描述這張圖片。"
+
+# 歷史紀錄只保存文字，圖片以這段註記代替
+IMAGE_HISTORY_NOTE = "[附上了 {count} 張圖片]"
+
+IMAGES = metrics.registry.counter("vision_images_total", "Image attachments handled, by outcome.")
+
+
+class ImageError(Exception):
+    """圖片無法下載或解碼；訊息會直接顯示給使用者"""
+
+
+def vision_models(config: dict) -> list:
+    """支援圖片輸入的模型 (依 config.json 的 "vision" 區塊)"""
+    return list(config.get("vision", {}).get("models", DEFAULT_VISION_SETTINGS["models"]))
+
+
+def has_images(messages: list) -> bool:
+    return any(isinstance(m["content"], list) and any(part.get("type") == "image_url" for part in m["content"])
+               for m in messages)
+
+
+def image_parts(prompt: str, images: list) -> list:
+    """提問文字加上圖片的多段內容 (Chat Completions 的 content 列表格式)"""
+    return [{"type": "text", "text": prompt}] + \
+        [{"type": "image_url", "image_url": {"url": image["url"], "detail": image["detail"]}} for image in images]
+
+
+def image_tokens(width: int, height: int, detail: str = "auto") -> int:
+    """依 OpenAI 的計價方式估算一張圖片的 token 數：縮放到 2048 以內、短邊 768，再以 512 像素的方格計算"""
+    if detail == "low":
+        return 85
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+    tiles = -(-int(width) // 512) * -(-int(height) // 512)
+    return 85 + 170 * tiles
+
+
+def is_image_attachment(attachment) -> bool:
+    content_type = (getattr(attachment, "content_type", None) or "").split(";")[0]
+    if content_type:
+        return content_type.startswith("image/")
+    return attachment.filename.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def _process_image(data: bytes, max_dimension: int, quality: int, max_pixels: int) -> tuple:
+    """解碼、縮小並重新編碼成 JPEG (在執行緒或行程池中執行，不佔用事件迴圈)；返回 (JPEG 位元組, 寬, 高)"""
+    from PIL import Image, ImageOps
+
+    Image.MAX_IMAGE_PIXELS = max_pixels
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            # JPEG 可在解碼時直接以 1/2、1/4、1/8 縮小，大幅減少解碼時間
+            image.draft("RGB", (max_dimension, max_dimension))
+            image = ImageOps.exif_transpose(image)
+            if image.mode in ("RGBA", "LA", "P"):
+                # 透明背景鋪成白色，避免轉成 JPEG 後變成黑底
+                image = image.convert("RGBA")
+                background = Image.new("RGB", image.size, (255, 255, 255))
+                background.paste(image, mask=image.getchannel("A"))
+                image = background
+            elif image.mode != "RGB":
+                image = image.convert("RGB")
+            image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+            output = io.BytesIO()
+            image.save(output, format="JPEG", quality=quality, optimize=True)
+            return output.getvalue(), image.width, image.height
+    except Image.DecompressionBombError:
+        raise ImageError("圖片解析度過大")
+    except (OSError, ValueError, SyntaxError) as e:
+        raise ImageError(f"無法解碼圖片 ({type(e).__name__})")
+
+
+class ImagePipeline:
+    """圖片附件的處理流程：下載、縮小、重新編碼並轉成 data URL
+
+    下載共用同一個 aiohttp 連線並在超過 max_bytes 時中止；解碼與縮放交給執行緒池 (或行程池)，
+    事件迴圈不會被大圖片卡住。結果以原始內容的 SHA-256 快取，同一張圖片重複貼上時不再處理。
+    """
+
+    def __init__(self, models: list, fallback_model: str = "gpt-4o", max_images: int = 4, max_bytes: int = 8 * 1024 * 1024,
+                 max_pixels: int = 40_000_000, max_dimension: int = 1024, quality: int = 80, detail: str = "auto",
+                 download_timeout: float = 15, executor: str = "thread", pool_size: int = 2, cache_size: int = 256,
+                 cache_ttl: float = 3600):
+        self.models = list(models)
+        self.fallback_model = fallback_model
+        self.max_images = int(max_images)
+        self.max_bytes = int(max_bytes)
+        self.max_pixels = int(max_pixels)
+        self.max_dimension = int(max_dimension)
+        self.quality = int(quality)
+        self.detail = detail
+        self.download_timeout = download_timeout
+        self._pool_kind = executor
+        self._pool_size = max(1, int(pool_size))
+        self._pool = None
+        self._session = None
+        # SHA-256 → 處理後的圖片；附件 ID → SHA-256 (同一則附件重試時連下載都省略)
+        self._cache = LRUCache(maxsize=cache_size, ttl=cache_ttl)
+        self._digests = LRUCache(maxsize=cache_size * 4, ttl=cache_ttl)
+        self._inflight: dict = {}
+
+    @classmethod
+    def from_config(cls, config: dict) -> Optional["ImagePipeline"]:
+        """依照 config.json 的 "vision" 區塊建立處理流程；停用時返回 None (忽略圖片附件)"""
+        options = {**DEFAULT_VISION_SETTINGS, **(config or {})}
+        if not options["enabled"]:
+            return None
+        return cls(**{key: options[key] for key in DEFAULT_VISION_SETTINGS if key != "enabled"})
+
+    @property
+    def cache_hit_rate(self) -> float:
+        total = self._cache.hits + self._cache.misses
+        return self._cache.hits / total if total else 0.0
+
+    def model_for(self, model: str) -> str:
+        """這次提問實際使用的模型：使用者選擇的模型不支援圖片時改用 fallback_model"""
+        return model if model in self.models else self.fallback_model
+
+    def select(self, attachments) -> list:
+        """挑出要處理的圖片附件 (最多 max_images 張)"""
+        return [attachment for attachment in attachments if is_image_attachment(attachment)][:self.max_images]
+
+    def _executor(self):
+        if self._pool is None:
+            if self._pool_kind == "process":
+                self._pool = ProcessPoolExecutor(max_workers=self._pool_size)
+            else:
+                self._pool = ThreadPoolExecutor(max_workers=self._pool_size, thread_name_prefix="image")
+        return self._pool
+
+    def _get_session(self):
+        if self._session is None or self._session.closed:
+            import aiohttp
+
+            self._session = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.download_timeout))
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
+
+    async def _download(self, attachment) -> bytes:
+        if attachment.size > self.max_bytes:
+            raise ImageError(f"「{attachment.filename}」超過 {self.max_bytes // (1024 * 1024)} MB 的大小上限")
+        chunks = []
+        received = 0
+        try:
+            async with self._get_session().get(attachment.url) as response:
+                response.raise_for_status()
+                async for chunk in response.content.iter_chunked(64 * 1024):
+                    received += len(chunk)
+                    if received > self.max_bytes:
+                        raise ImageError(f"「{attachment.filename}」超過 {self.max_bytes // (1024 * 1024)} MB 的大小上限")
+                    chunks.append(chunk)
+        except asyncio.TimeoutError:
+            raise ImageError(f"下載「{attachment.filename}」逾時")
+        except ImageError:
+            raise
+        except Exception as e:
+            raise ImageError(f"無法下載「{attachment.filename}」({type(e).__name__})")
+        return b"".join(chunks)
+
+    async def _encode(self, digest: str, data: bytes) -> dict:
+        loop = asyncio.get_running_loop()
+        with metrics.timed("image_process"):
+            jpeg, width, height = await loop.run_in_executor(
+                self._executor(), _process_image, data, self.max_dimension, self.quality, self.max_pixels)
+        return {"url": "data:image/jpeg;base64," + base64.b64encode(jpeg).decode("ascii"), "detail": self.detail,
+                "tokens": image_tokens(width, height, self.detail), "digest": digest}
+
+    async def prepare_one(self, attachment) -> dict:
+        """下載並處理一張附件；返回 {"url", "detail", "tokens", "digest"}"""
+        digest = self._digests.get(attachment.id)
+        if digest is not None:
+            image = self._cache.get(digest)
+            if image is not None:
+                IMAGES.inc(outcome="cached")
+                return image
+
+        with metrics.timed("image_download"):
+            data = await self._download(attachment)
+        digest = hashlib.sha256(data).hexdigest()
+        self._digests.set(attachment.id, digest)
+        image = self._cache.get(digest)
+        if image is not None:
+            IMAGES.inc(outcome="cached")
+            return image
+
+        # 同一張圖片同時被多則訊息貼上時只處理一次
+        pending = self._inflight.get(digest)
+        if pending is None:
+            pending = self._inflight[digest] = asyncio.ensure_future(self._encode(digest, data))
+            pending.add_done_callback(lambda _: self._inflight.pop(digest, None))
+        image = await asyncio.shield(pending)
+        self._cache.set(digest, image)
+        IMAGES.inc(outcome="processed")
+        return image
+
+    async def prepare(self, attachments) -> tuple:
+        """並行處理多張附件；返回 (成功的圖片列表, 失敗原因列表)"""
+        results = await asyncio.gather(*(self.prepare_one(attachment) for attachment in attachments),
+                                       return_exceptions=True)
+        images, errors = [], []
+        for result in results:
+            if isinstance(result, ImageError):
+                IMAGES.inc(outcome="rejected")
+                errors.append(str(result))
+            elif isinstance(result, BaseException):
+                raise result
+            else:
+                images.append(result)
+        return images, errors
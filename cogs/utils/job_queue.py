@@ -0,0 +1,504 @@
+import os
+import json
+import time
+import asyncio
+import sqlite3
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Callable, Optional
+
+from . import db_manager
+from . import metrics
+
+logger = logging.getLogger("discord_bot")
+
+# 預設閘道/工作行程分離設定 (可由 config.json 的 "workers" 區塊覆寫)
+DEFAULT_WORKER_SETTINGS = {
+    "enabled": False,
+    "partitions": 4,
+    "processes": 4,
+    "concurrency": 8,
+    "poll_interval": 0.05,
+    "job_timeout": 180,
+    "result_timeout": 240,
+    "max_attempts": 2,
+    "heartbeat_interval": 5,
+    "result_ttl": 600
+}
+
+QUEUE_DB_NAME = "job_queue.db"
+
+QUEUED, RUNNING, DONE, FAILED = "queued", "running", "done", "failed"
+
+JOBS_SUBMITTED = metrics.registry.counter("job_queue_submitted_total", "Jobs enqueued by the gateway, by kind.")
+JOBS_FINISHED = metrics.registry.counter("job_queue_finished_total", "Jobs finished by this worker, by kind and status.")
+JOBS_REQUEUED = metrics.registry.counter("job_queue_requeued_total", "Running jobs returned to the queue after a worker was lost.")
+
+_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS chat_jobs (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        kind TEXT NOT NULL,
+        partition INTEGER NOT NULL,
+        payload TEXT NOT NULL,
+        status TEXT NOT NULL DEFAULT 'queued',
+        attempts INTEGER NOT NULL DEFAULT 0,
+        worker_id TEXT,
+        result TEXT,
+        created_at INTEGER NOT NULL,
+        deadline INTEGER NOT NULL,
+        claimed_at INTEGER,
+        finished_at INTEGER
+    );
+    CREATE INDEX IF NOT EXISTS idx_chat_jobs_claim ON chat_jobs (status, partition, id);
+    CREATE TABLE IF NOT EXISTS queue_workers (
+        worker_id TEXT PRIMARY KEY,
+        pid INTEGER NOT NULL,
+        partitions TEXT NOT NULL,
+        started_at INTEGER NOT NULL,
+        heartbeat_at INTEGER NOT NULL,
+        jobs_done INTEGER NOT NULL DEFAULT 0
+    );
+"""
+
+
+class JobFailedError(Exception):
+    """工作行程回報失敗；error_type 為工作行程中原始例外的類別名稱"""
+
+    def __init__(self, error_type: str, message: str = ""):
+        super().__init__(message or error_type)
+        self.error_type = error_type
+
+
+def partition_for(user_id: str, partitions: int) -> int:
+    """同一位使用者的工作固定落在同一個分區，讓其寫入緩衝與對話視窗快取只存在於一個工作行程中"""
+    return int(user_id) % max(1, partitions)
+
+
+def _now_ms() -> int:
+    return int(time.time() * 1000)
+
+
+def _in_clause(values) -> str:
+    return ",".join("?" * len(values))
+
+
+# --- 佇列資料表操作 (在佇列專屬的執行緒上執行) ---
+class _Transaction:
+    """BEGIN IMMEDIATE 交易：跨行程領取工作時先取得寫入鎖，避免兩個工作行程領到同一筆"""
+
+    def __init__(self, conn: sqlite3.Connection):
+        self.conn = conn
+
+    def __enter__(self):
+        self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+
+
+def _insert_job(conn: sqlite3.Connection, kind: str, partition: int, payload: str, timeout_ms: int) -> int:
+    now = _now_ms()
+    cursor = conn.execute(
+        "INSERT INTO chat_jobs (kind, partition, payload, created_at, deadline) VALUES (?, ?, ?, ?, ?)",
+        (kind, partition, payload, now, now + timeout_ms)
+    )
+    return cursor.lastrowid
+
+
+def _claim_jobs(conn: sqlite3.Connection, worker_id: str, partitions: list, limit: int) -> list:
+    now = _now_ms()
+    with _Transaction(conn):
+        # 閘道已放棄等待的工作不再執行
+        conn.execute(f"DELETE FROM chat_jobs WHERE status = ? AND partition IN ({_in_clause(partitions)}) AND deadline < ?",
+                     (QUEUED, *partitions, now))
+        rows = conn.execute(
+            f"SELECT id, kind, payload, attempts FROM chat_jobs WHERE status = ? AND partition IN ({_in_clause(partitions)}) "
+            "ORDER BY id LIMIT ?",
+            (QUEUED, *partitions, limit)
+        ).fetchall()
+        conn.executemany(
+            "UPDATE chat_jobs SET status = ?, worker_id = ?, claimed_at = ?, attempts = attempts + 1 WHERE id = ?",
+            [(RUNNING, worker_id, now, row[0]) for row in rows]
+        )
+    return [{"id": row[0], "kind": row[1], "payload": json.loads(row[2]), "attempts": row[3] + 1} for row in rows]
+
+
+def _finish_job(conn: sqlite3.Connection, job_id: int, worker_id: str, status: str, result: str) -> bool:
+    cursor = conn.execute(
+        "UPDATE chat_jobs SET status = ?, result = ?, finished_at = ? WHERE id = ? AND worker_id = ? AND status = ?",
+        (status, result, _now_ms(), job_id, worker_id, RUNNING)
+    )
+    conn.execute("UPDATE queue_workers SET jobs_done = jobs_done + 1 WHERE worker_id = ?", (worker_id,))
+    return cursor.rowcount > 0
+
+
+def _recover_jobs(conn: sqlite3.Connection, worker_id: str, partitions: list, job_timeout_ms: int,
+                  dead_after_ms: int, max_attempts: int, restarted: bool) -> int:
+    """把遺失工作行程 (心跳逾時、執行過久，或是本行程重新啟動前) 手上的工作放回佇列，超過重試次數則標記失敗"""
+    now = _now_ms()
+    with _Transaction(conn):
+        alive = {row[0] for row in conn.execute("SELECT worker_id FROM queue_workers WHERE heartbeat_at >= ?",
+                                                (now - dead_after_ms,))}
+        rows = conn.execute(
+            f"SELECT id, attempts, worker_id, claimed_at FROM chat_jobs WHERE status = ? AND partition IN ({_in_clause(partitions)})",
+            (RUNNING, *partitions)
+        ).fetchall()
+        lost = [row for row in rows
+                if (row[2] == worker_id and restarted) or (row[2] != worker_id and row[2] not in alive)
+                or row[3] < now - job_timeout_ms]
+        failed = json.dumps({"error_type": "WorkerLost", "message": "工作行程在處理期間中斷"})
+        for job_id, attempts, _, _ in lost:
+            if attempts >= max_attempts:
+                conn.execute("UPDATE chat_jobs SET status = ?, result = ?, finished_at = ? WHERE id = ?",
+                             (FAILED, failed, now, job_id))
+            else:
+                conn.execute("UPDATE chat_jobs SET status = ?, worker_id = NULL, claimed_at = NULL WHERE id = ?",
+                             (QUEUED, job_id))
+    return len(lost)
+
+
+def _upsert_worker(conn: sqlite3.Connection, worker_id: str, partitions: list, started: bool):
+    now = _now_ms()
+    if started:
+        conn.execute(
+            "INSERT INTO queue_workers (worker_id, pid, partitions, started_at, heartbeat_at) VALUES (?, ?, ?, ?, ?) "
+            "ON CONFLICT(worker_id) DO UPDATE SET pid = excluded.pid, partitions = excluded.partitions, "
+            "started_at = excluded.started_at, heartbeat_at = excluded.heartbeat_at, jobs_done = 0",
+            (worker_id, os.getpid(), json.dumps(partitions), now, now)
+        )
+    else:
+        conn.execute("UPDATE queue_workers SET heartbeat_at = ? WHERE worker_id = ?", (now, worker_id))
+
+
+def _delete_worker(conn: sqlite3.Connection, worker_id: str):
+    conn.execute("DELETE FROM queue_workers WHERE worker_id = ?", (worker_id,))
+
+
+def _take_finished(conn: sqlite3.Connection, job_ids: list) -> list:
+    with _Transaction(conn):
+        rows = conn.execute(
+            f"SELECT id, status, result FROM chat_jobs WHERE id IN ({_in_clause(job_ids)}) AND status IN (?, ?)",
+            (*job_ids, DONE, FAILED)
+        ).fetchall()
+        if rows:
+            conn.execute(f"DELETE FROM chat_jobs WHERE id IN ({_in_clause(rows)})", [row[0] for row in rows])
+    return rows
+
+
+def _cancel_job(conn: sqlite3.Connection, job_id: int):
+    conn.execute("DELETE FROM chat_jobs WHERE id = ? AND status = ?", (job_id, QUEUED))
+
+
+def _prune_jobs(conn: sqlite3.Connection, ttl_ms: int) -> int:
+    return conn.execute("DELETE FROM chat_jobs WHERE created_at < ?", (_now_ms() - ttl_ms,)).rowcount
+
+
+def _select_stats(conn: sqlite3.Connection, dead_after_ms: int) -> dict:
+    counts = dict(conn.execute("SELECT status, COUNT(*) FROM chat_jobs GROUP BY status").fetchall())
+    workers = conn.execute(
+        "SELECT worker_id, pid, partitions, heartbeat_at, jobs_done FROM queue_workers ORDER BY worker_id"
+    ).fetchall()
+    alive_after = _now_ms() - dead_after_ms
+    return {
+        "queued": counts.get(QUEUED, 0),
+        "running": counts.get(RUNNING, 0),
+        "workers": [{"worker_id": row[0], "pid": row[1], "partitions": json.loads(row[2]),
+                     "alive": row[3] >= alive_after, "jobs_done": row[4]} for row in workers]
+    }
+
+
+class JobQueue:
+    """以獨立 SQLite 檔案 (WAL) 實作的跨行程工作佇列
+
+    閘道與工作行程各自開啟一個連線，所有操作都在佇列專屬的單一執行緒上執行，不阻塞事件迴圈；
+    佇列與聊天紀錄分開存放，領取/回報工作的寫入鎖不會與聊天紀錄的寫入互相等待。
+    """
+
+    def __init__(self, path: Path, busy_timeout_ms: int = 5000):
+        self.path = path
+        self.busy_timeout_ms = busy_timeout_ms
+        self._conn: Optional[sqlite3.Connection] = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="job-queue", initializer=self._open)
+
+    @classmethod
+    def default_path(cls) -> Path:
+        return db_manager.DATA_DIR / QUEUE_DB_NAME
+
+    def _open(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        # isolation_level=None：交易範圍由 _Transaction 明確控制
+        conn = sqlite3.connect(self.path, timeout=self.busy_timeout_ms / 1000, isolation_level=None, check_same_thread=False)
+        conn.execute(f"PRAGMA busy_timeout = {self.busy_timeout_ms}")
+        conn.execute("PRAGMA journal_mode = WAL")
+        conn.execute("PRAGMA synchronous = NORMAL")
+        conn.executescript(_SCHEMA)
+        self._conn = conn
+
+    async def _run(self, func: Callable, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, lambda: func(self._conn, *args))
+
+    async def enqueue(self, kind: str, partition: int, payload: dict, timeout: float) -> int:
+        return await self._run(_insert_job, kind, partition, json.dumps(payload, ensure_ascii=False), int(timeout * 1000))
+
+    async def claim(self, worker_id: str, partitions: list, limit: int) -> list:
+        return await self._run(_claim_jobs, worker_id, partitions, limit)
+
+    async def finish(self, job_id: int, worker_id: str, status: str, result: dict) -> bool:
+        return await self._run(_finish_job, job_id, worker_id, status, json.dumps(result, ensure_ascii=False))
+
+    async def recover(self, worker_id: str, partitions: list, job_timeout: float, dead_after: float,
+                      max_attempts: int, restarted: bool = False) -> int:
+        return await self._run(_recover_jobs, worker_id, partitions, int(job_timeout * 1000), int(dead_after * 1000),
+                               max_attempts, restarted)
+
+    async def register_worker(self, worker_id: str, partitions: list):
+        await self._run(_upsert_worker, worker_id, partitions, True)
+
+    async def heartbeat(self, worker_id: str):
+        await self._run(_upsert_worker, worker_id, None, False)
+
+    async def unregister_worker(self, worker_id: str):
+        await self._run(_delete_worker, worker_id)
+
+    async def take_finished(self, job_ids: list) -> list:
+        """取回並刪除已完成的工作；返回 (id, status, result) 列表"""
+        return await self._run(_take_finished, job_ids)
+
+    async def cancel(self, job_id: int):
+        """閘道放棄等待時撤回尚未被領取的工作"""
+        await self._run(_cancel_job, job_id)
+
+    async def prune(self, ttl: float) -> int:
+        return await self._run(_prune_jobs, int(ttl * 1000))
+
+    async def stats(self, dead_after: float) -> dict:
+        return await self._run(_select_stats, int(dead_after * 1000))
+
+    async def close(self):
+        def _close():
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+        await asyncio.get_running_loop().run_in_executor(self._executor, _close)
+        self._executor.shutdown(wait=True)
+
+
+# --- 閘道端 ---
+class JobClient:
+    """閘道行程的佇列用戶端：送出工作並等待工作行程寫回結果
+
+    單一背景輪詢工作只在有人等待結果時查詢佇列，一次取回所有已完成的工作。
+    """
+
+    def __init__(self, queue: JobQueue, partitions: int = 4, poll_interval: float = 0.05,
+                 result_timeout: float = 240, result_ttl: float = 600, heartbeat_interval: float = 5):
+        self.queue = queue
+        self.partitions = max(1, int(partitions))
+        self.poll_interval = poll_interval
+        self.result_timeout = result_timeout
+        self.result_ttl = result_ttl
+        self.dead_after = heartbeat_interval * 3
+        self._waiters: dict = {}
+        self._wakeup = asyncio.Event()
+        self._poller: Optional[asyncio.Task] = None
+
+    @classmethod
+    def from_config(cls, config: dict) -> Optional["JobClient"]:
+        """依照 config.json 的 "workers" 區塊建立用戶端；停用時返回 None (於同一行程內處理對話)"""
+        options = {**DEFAULT_WORKER_SETTINGS, **(config or {})}
+        if not options["enabled"]:
+            return None
+        return cls(JobQueue(JobQueue.default_path()), partitions=options["partitions"],
+                   poll_interval=options["poll_interval"], result_timeout=options["result_timeout"],
+                   result_ttl=options["result_ttl"], heartbeat_interval=options["heartbeat_interval"])
+
+    @property
+    def waiting(self) -> int:
+        """已送出、尚未取回結果的工作數量"""
+        return len(self._waiters)
+
+    async def start(self):
+        removed = await self.queue.prune(self.result_ttl)
+        if removed:
+            logger.info(f"已清除 {removed} 筆過期的佇列工作。")
+        if self._poller is None:
+            self._poller = asyncio.create_task(self._poll())
+
+    async def close(self):
+        if self._poller is not None:
+            self._poller.cancel()
+            try:
+                await self._poller
+            except asyncio.CancelledError:
+                pass
+            self._poller = None
+        for future in self._waiters.values():
+            if not future.done():
+                future.cancel()
+        self._waiters.clear()
+        await self.queue.close()
+
+    async def submit(self, kind: str, user_id: str, payload: dict) -> dict:
+        """送出工作並等待結果；逾時會撤回尚未開始的工作並拋出 asyncio.TimeoutError"""
+        job_id = await self.queue.enqueue(kind, partition_for(user_id, self.partitions), payload, self.result_timeout)
+        JOBS_SUBMITTED.inc(kind=kind)
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[job_id] = future
+        self._wakeup.set()
+        try:
+            with metrics.timed("job_roundtrip"):
+                return await asyncio.wait_for(future, self.result_timeout)
+        except asyncio.TimeoutError:
+            await self.queue.cancel(job_id)
+            raise
+        finally:
+            self._waiters.pop(job_id, None)
+
+    async def chat(self, user_id: str, prompt: str, user_settings: dict, channel_context: Optional[list] = None,
+                   images: Optional[list] = None, usage: Optional[dict] = None) -> str:
+        result = await self.submit("chat", user_id, {"user_id": user_id, "prompt": prompt, "settings": user_settings,
+                                                     "channel_context": channel_context, "images": images})
+        if usage is not None and result.get("usage"):
+            # 工作行程回報的用量交給閘道的用量帳本記錄
+            usage.update(result["usage"])
+        return result["reply"]
+
+    async def clear_history(self, user_id: str):
+        """由負責該使用者的工作行程清除歷史，連同它的寫入緩衝與快取"""
+        await self.submit("clear_history", user_id, {"user_id": user_id})
+
+    async def stats(self) -> dict:
+        return await self.queue.stats(self.dead_after)
+
+    async def _poll(self):
+        while True:
+            if not self._waiters:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+            try:
+                rows = await self.queue.take_finished(list(self._waiters))
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"讀取工作結果時發生錯誤：{e}", exc_info=True)
+                rows = []
+            for job_id, status, result in rows:
+                future = self._waiters.get(job_id)
+                if future is None or future.done():
+                    continue
+                result = json.loads(result) if result else {}
+                if status == DONE:
+                    future.set_result(result)
+                elif result.get("error_type") == "TimeoutError":
+                    future.set_exception(asyncio.TimeoutError())
+                else:
+                    future.set_exception(JobFailedError(result.get("error_type", "Exception"), result.get("message", "")))
+            await asyncio.sleep(self.poll_interval)
+
+
+# --- 工作行程端 ---
+class JobWorker:
+    """工作行程的主迴圈：領取所屬分區的工作、以對應的處理函式執行並寫回結果
+
+    handlers 為 {kind: async (payload) -> dict}；處理函式拋出的例外會以類別名稱回報給閘道。
+    """
+
+    def __init__(self, queue: JobQueue, worker_id: str, partitions: list, handlers: dict, concurrency: int = 8,
+                 poll_interval: float = 0.05, job_timeout: float = 180, max_attempts: int = 2,
+                 heartbeat_interval: float = 5):
+        self.queue = queue
+        self.worker_id = worker_id
+        self.partitions = list(partitions)
+        self.handlers = handlers
+        self.concurrency = max(1, int(concurrency))
+        self.poll_interval = poll_interval
+        self.job_timeout = job_timeout
+        self.max_attempts = max(1, int(max_attempts))
+        self.heartbeat_interval = heartbeat_interval
+        self._tasks: set = set()
+        self._stopping = asyncio.Event()
+
+    @classmethod
+    def from_config(cls, config: dict, queue: JobQueue, worker_id: str, partitions: list, handlers: dict) -> "JobWorker":
+        options = {**DEFAULT_WORKER_SETTINGS, **(config or {})}
+        return cls(queue, worker_id, partitions, handlers, concurrency=options["concurrency"],
+                   poll_interval=options["poll_interval"], job_timeout=options["job_timeout"],
+                   max_attempts=options["max_attempts"], heartbeat_interval=options["heartbeat_interval"])
+
+    @property
+    def running(self) -> int:
+        return len(self._tasks)
+
+    def request_stop(self):
+        """停止領取新工作；run() 會在手上的工作完成後返回"""
+        self._stopping.set()
+
+    async def run(self, drain_timeout: float = 30):
+        await self.queue.register_worker(self.worker_id, self.partitions)
+        recovered = await self.queue.recover(self.worker_id, self.partitions, self.job_timeout,
+                                             self.heartbeat_interval * 3, self.max_attempts, restarted=True)
+        if recovered:
+            JOBS_REQUEUED.inc(recovered)
+            logger.warning(f"{self.worker_id} 重新排入 {recovered} 筆先前未完成的工作。")
+        logger.info(f"{self.worker_id} 開始處理分區 {self.partitions}。")
+        heartbeat = asyncio.create_task(self._heartbeat())
+        try:
+            while not self._stopping.is_set():
+                free = self.concurrency - len(self._tasks)
+                jobs = await self.queue.claim(self.worker_id, self.partitions, free) if free > 0 else []
+                for job in jobs:
+                    task = asyncio.create_task(self._execute(job))
+                    self._tasks.add(task)
+                    task.add_done_callback(self._tasks.discard)
+                if jobs and len(self._tasks) < self.concurrency:
+                    continue
+                # 沒有新工作或已滿載：等到有工作完成、收到停止要求或下一個輪詢週期
+                waiters = [*self._tasks, asyncio.ensure_future(self._stopping.wait())]
+                await asyncio.wait(waiters, timeout=self.poll_interval, return_when=asyncio.FIRST_COMPLETED)
+                waiters[-1].cancel()
+            if self._tasks:
+                logger.info(f"{self.worker_id} 正在等待 {len(self._tasks)} 筆進行中的工作完成...")
+                await asyncio.wait(self._tasks, timeout=drain_timeout)
+        finally:
+            heartbeat.cancel()
+            await self.queue.unregister_worker(self.worker_id)
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+            try:
+                await self.queue.heartbeat(self.worker_id)
+                recovered = await self.queue.recover(self.worker_id, self.partitions, self.job_timeout,
+                                                     self.heartbeat_interval * 3, self.max_attempts)
+                if recovered:
+                    JOBS_REQUEUED.inc(recovered)
+                    logger.warning(f"{self.worker_id} 重新排入 {recovered} 筆逾時或遺失的工作。")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"更新工作行程心跳時發生錯誤：{e}", exc_info=True)
+
+    async def _execute(self, job: dict):
+        handler = self.handlers.get(job["kind"])
+        try:
+            if handler is None:
+                raise ValueError(f"未知的工作類型：{job['kind']}")
+            with metrics.timed(f"job_{job['kind']}"):
+                # 工作 ID 一併交給處理常式，重新排入的工作可藉此辨識已完成的部分
+                result = await handler({**job["payload"], "job_id": job["id"]})
+            status = DONE
+        except Exception as e:
+            if not isinstance(e, asyncio.TimeoutError):
+                logger.error(f"處理工作 {job['id']} ({job['kind']}) 時發生錯誤：{e}", exc_info=True)
+            status = FAILED
+            result = {"error_type": "TimeoutError" if isinstance(e, asyncio.TimeoutError) else type(e).__name__,
+                      "message": str(e)[:500]}
+        JOBS_FINISHED.inc(kind=job["kind"], status=status)
+        try:
+            if not await self.queue.finish(job["id"], self.worker_id, status, result):
+                logger.warning(f"工作 {job['id']} 已被重新分派，捨棄本次結果。")
+        except Exception as e:
+            logger.error(f"寫回工作 {job['id']} 的結果時發生錯誤：{e}", exc_info=True)
@@ -0,0 +1,56 @@
+from typing import Optional
+
+# Discord 單則訊息的字數上限
+DISCORD_MESSAGE_LIMIT = 2000
+
+CODE_FENCE = "```"
+_FENCE_CLOSE = "\n" + CODE_FENCE
+
+
+def open_code_fence(text: str) -> Optional[str]:
+    """若文字結尾仍處於未關閉的程式碼區塊中，返回其開頭那一行 (例如 ```python)，否則返回 None"""
+    opening = None
+    for line in text.split("\n"):
+        stripped = line.strip()
+        if stripped.startswith(CODE_FENCE):
+            opening = None if opening is not None else stripped
+    return opening
+
+
+def find_split_point(text: str, limit: int) -> int:
+    """在 limit 之內找出最適合切開的位置：段落 > 換行 > 空白 > 硬切"""
+    if len(text) <= limit:
+        return len(text)
+    window = text[:limit]
+    for separator in ("\n\n", "\n", " "):
+        index = window.rfind(separator)
+        # 切點太前面會產生過短的訊息，寧可退而求其次
+        if index >= limit // 2:
+            return index + len(separator)
+    return limit
+
+
+def take_chunk(text: str, prefix: str = "", limit: int = DISCORD_MESSAGE_LIMIT):
+    """從 text 切出一則不超過 limit 的訊息；返回 (訊息內容, 剩餘文字, 下一則訊息的前綴)
+
+    若切點落在程式碼區塊中，會在本則結尾補上 ``` 並於下一則重新開啟相同語言的區塊。
+    """
+    budget = limit - len(prefix) - len(_FENCE_CLOSE)
+    cut = find_split_point(text, budget)
+    chunk, rest = prefix + text[:cut], text[cut:].lstrip("\n")
+    fence = open_code_fence(chunk)
+    if fence is None:
+        return chunk.rstrip(), rest, ""
+    return chunk.rstrip("\n") + _FENCE_CLOSE, rest, fence + "\n"
+
+
+def split_message(text: str, limit: int = DISCORD_MESSAGE_LIMIT) -> list:
+    """將長文字切成多則不超過 limit 的 Discord 訊息，並維持程式碼區塊完整"""
+    chunks = []
+    prefix = ""
+    while len(prefix) + len(text) > limit:
+        chunk, text, prefix = take_chunk(text, prefix, limit)
+        chunks.append(chunk)
+    if text.strip() or not chunks:
+        chunks.append(prefix + text)
+    return chunks
@@ -0,0 +1,191 @@
+import time
+import bisect
+import logging
+from contextlib import contextmanager
+from typing import Callable, Optional
+
+logger = logging.getLogger("discord_bot")
+
+# 預設延遲分桶 (秒)，涵蓋快取命中到長篇生成
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key: tuple, extra: Optional[tuple] = None) -> str:
+    items = list(key) + ([extra] if extra else [])
+    if not items:
+        return ""
+    escaped = (
+        f'{name}="' + str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") + '"'
+        for name, value in items
+    )
+    return "{" + ",".join(escaped) + "}"
+
+
+class Counter:
+    """只增不減的計數器"""
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self.values: dict = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = _label_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def total(self) -> float:
+        return sum(self.values.values())
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        lines += [f"{self.name}{_format_labels(key)} {value}" for key, value in self.values.items()]
+        return lines
+
+
+class Gauge:
+    """以回呼函式在讀取時取值的量測值"""
+
+    def __init__(self, name: str, help_text: str, func: Callable[[], float]):
+        self.name = name
+        self.help = help_text
+        self.func = func
+
+    def value(self) -> float:
+        try:
+            return float(self.func())
+        except Exception:
+            return float("nan")
+
+    def render(self) -> list:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge", f"{self.name} {self.value()}"]
+
+
+class _HistogramSeries:
+    __slots__ = ("counts", "sum", "count")
+
+    def __init__(self, size: int):
+        self.counts = [0] * size
+        self.sum = 0.0
+        self.count = 0
+
+
+class Histogram:
+    """固定分桶的直方圖；observe 只做一次二分搜尋與幾個加法"""
+
+    def __init__(self, name: str, help_text: str, buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(sorted(buckets))
+        self.series: dict = {}
+
+    def observe(self, value: float, **labels):
+        key = _label_key(labels)
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = _HistogramSeries(len(self.buckets) + 1)
+        series.counts[bisect.bisect_left(self.buckets, value)] += 1
+        series.sum += value
+        series.count += 1
+
+    def quantile(self, q: float, **labels) -> Optional[float]:
+        """以分桶上界估算分位數 (資料不足時返回 None)"""
+        series = self.series.get(_label_key(labels))
+        if series is None or series.count == 0:
+            return None
+        target = q * series.count
+        cumulative = 0
+        for index, count in enumerate(series.counts):
+            cumulative += count
+            if cumulative >= target:
+                return self.buckets[index] if index < len(self.buckets) else float("inf")
+        return float("inf")
+
+    def label_values(self, name: str) -> list:
+        return sorted({dict(key).get(name) for key in self.series if name in dict(key)})
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for key, series in self.series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series.counts):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(key, ('le', bound))} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(key, ('le', '+Inf'))} {series.count}")
+            lines.append(f"{self.name}_sum{_format_labels(key)} {series.sum}")
+            lines.append(f"{self.name}_count{_format_labels(key)} {series.count}")
+        return lines
+
+
+class MetricsRegistry:
+    """行程內的指標登錄處；模組層級單例在 cog 重新載入後仍會保留累積的數值"""
+
+    def __init__(self):
+        self._metrics: dict = {}
+
+    def counter(self, name: str, help_text: str) -> Counter:
+        return self._metrics.setdefault(name, Counter(name, help_text))
+
+    def histogram(self, name: str, help_text: str, buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self._metrics.setdefault(name, Histogram(name, help_text, buckets))
+
+    def gauge(self, name: str, help_text: str, func: Callable[[], float]) -> Gauge:
+        """註冊 (或取代) 一個量測值；cog 重新載入時會以新的回呼覆蓋舊的"""
+        gauge = Gauge(name, help_text, func)
+        self._metrics[name] = gauge
+        return gauge
+
+    def get(self, name: str):
+        return self._metrics.get(name)
+
+    def render_prometheus(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+# --- 對話熱路徑指標 ---
+STAGE_SECONDS = registry.histogram("chat_stage_seconds", "Time spent in each stage of a chat turn.")
+REQUESTS = registry.counter("chat_requests_total", "Chat turns handled, by outcome.")
+ERRORS = registry.counter("chat_errors_total", "Chat turn errors, by exception type.")
+TOKENS = registry.counter("openai_tokens_total", "Tokens consumed, by model and kind.")
+
+
+@contextmanager
+def timed(stage: str):
+    """量測一段程式的耗時並記錄到 chat_stage_seconds{stage=...}"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        STAGE_SECONDS.observe(time.perf_counter() - start, stage=stage)
+
+
+def record_usage(model: str, prompt_tokens: int, completion_tokens: int):
+    """累計一次補全請求的 token 用量"""
+    TOKENS.inc(prompt_tokens, model=model, kind="prompt")
+    TOKENS.inc(completion_tokens, model=model, kind="completion")
+
+
+# --- Prometheus 文字格式的本地 HTTP 端點 ---
+async def start_http_server(host: str = "127.0.0.1", port: int = 9108):
+    """啟動 /metrics 端點，返回 aiohttp 的 AppRunner (關閉時呼叫 cleanup())"""
+    from aiohttp import web
+
+    async def handle_metrics(request):
+        return web.Response(text=registry.render_prometheus(), content_type="text/plain", charset="utf-8",
+                            headers={"X-Content-Type-Options": "nosniff"})
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"指標端點已啟動：http://{host}:{port}/metrics")
+    return runner
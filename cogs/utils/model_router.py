@@ -0,0 +1,417 @@
+import time
+import asyncio
+import logging
+from collections import deque
+from typing import Optional
+
+import openai
+
+from . import metrics
+from .images import has_images, vision_models
+from .tokens import context_budget, message_tokens
+
+logger = logging.getLogger("discord_bot")
+
+# 預設路由設定值 (可由 config.json 的 "model_router" 區塊覆寫)
+DEFAULT_ROUTER_SETTINGS = {
+    "enabled": True,
+    "fallback_chains": {},
+    "hedge_enabled": False,
+    "hedge_percentile": 0.95,
+    "hedge_min_samples": 20,
+    "hedge_min_delay": 2.0,
+    "hedge_models": {},
+    "window": 60,
+    "failure_threshold": 0.5,
+    "min_requests": 5,
+    "open_seconds": 30,
+    "latency_samples": 200
+}
+
+CLOSED, OPEN, HALF_OPEN = "closed", "open", "half_open"
+
+ATTEMPTS = metrics.registry.counter("model_router_attempts_total", "Completion attempts made by the router, by model and outcome.")
+EVENTS = metrics.registry.counter("model_router_events_total", "Router fallbacks, hedges and circuit transitions, by event and model.")
+
+
+def is_retryable(error: Exception) -> bool:
+    """逾時、連線錯誤、限流與上游 5xx 值得換模型重試；其餘錯誤 (4xx、程式錯誤、請求被取消等) 換模型也不會成功，直接拋出"""
+    if isinstance(error, (asyncio.TimeoutError, openai.APITimeoutError, openai.APIConnectionError, openai.RateLimitError)):
+        return True
+    return isinstance(error, openai.APIStatusError) and error.status_code >= 500
+
+
+class ModelHealth:
+    """單一模型的近期延遲、錯誤率與斷路器狀態"""
+
+    def __init__(self, model: str, window: float = 60, failure_threshold: float = 0.5, min_requests: int = 5,
+                 open_seconds: float = 30, latency_samples: int = 200):
+        self.model = model
+        self.window = window
+        self.failure_threshold = failure_threshold
+        self.min_requests = max(1, int(min_requests))
+        self.open_seconds = open_seconds
+        self.outcomes: deque = deque()
+        self.latencies: deque = deque(maxlen=latency_samples)
+        self.first_token_latencies: deque = deque(maxlen=latency_samples)
+        self.state = CLOSED
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+
+    def _prune(self, now: float):
+        while self.outcomes and self.outcomes[0][0] < now - self.window:
+            self.outcomes.popleft()
+
+    def error_rate(self) -> tuple:
+        """返回 (錯誤率, 統計窗口內的請求數)"""
+        self._prune(time.monotonic())
+        if not self.outcomes:
+            return 0.0, 0
+        failures = sum(1 for _, ok in self.outcomes if not ok)
+        return failures / len(self.outcomes), len(self.outcomes)
+
+    def available(self) -> bool:
+        """是否可以送出請求 (不佔用半開狀態的試探名額)"""
+        if self.state == OPEN and time.monotonic() - self.opened_at >= self.open_seconds:
+            self.state = HALF_OPEN
+            self._probe_in_flight = False
+        return self.state == CLOSED or (self.state == HALF_OPEN and not self._probe_in_flight)
+
+    def acquire(self) -> bool:
+        """準備送出請求；半開狀態下只放行一個試探請求"""
+        if not self.available():
+            return False
+        if self.state == HALF_OPEN:
+            self._probe_in_flight = True
+        return True
+
+    def release(self):
+        """請求被取消或因非模型因素失敗時歸還試探名額"""
+        self._probe_in_flight = False
+
+    def record_success(self, latency: float, first_token: bool = False):
+        self.outcomes.append((time.monotonic(), True))
+        (self.first_token_latencies if first_token else self.latencies).append(latency)
+        if self.state != CLOSED:
+            # 試探成功：關閉斷路器並捨棄開啟前的錯誤紀錄
+            self.state = CLOSED
+            self.outcomes.clear()
+            self._probe_in_flight = False
+            EVENTS.inc(event="circuit_closed", model=self.model)
+            logger.info(f"模型 {self.model} 已恢復，關閉斷路器。")
+
+    def record_failure(self):
+        now = time.monotonic()
+        self.outcomes.append((now, False))
+        rate, count = self.error_rate()
+        if self.state == HALF_OPEN or (self.state == CLOSED and count >= self.min_requests and rate >= self.failure_threshold):
+            self.state = OPEN
+            self.opened_at = now
+            self._probe_in_flight = False
+            EVENTS.inc(event="circuit_opened", model=self.model)
+            logger.warning(f"模型 {self.model} 錯誤率 {rate:.0%} ({count} 次請求)，開啟斷路器 {self.open_seconds}s。")
+
+    def quantile(self, q: float, first_token: bool = False, min_samples: int = 1) -> Optional[float]:
+        samples = self.first_token_latencies if first_token else self.latencies
+        if len(samples) < max(1, min_samples):
+            return None
+        ordered = sorted(samples)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+    def snapshot(self) -> dict:
+        rate, count = self.error_rate()
+        return {"state": self.state, "error_rate": rate, "requests": count,
+                "p50": self.quantile(0.5), "p95": self.quantile(0.95),
+                "ttft_p50": self.quantile(0.5, first_token=True), "ttft_p95": self.quantile(0.95, first_token=True)}
+
+
+_END = object()
+
+
+class _StreamAttempt:
+    """在背景讀取一個串流請求；first 在收到第一段文字 (或失敗) 時完成，之後由 deltas() 取出其餘內容"""
+
+    def __init__(self, router: "ModelRouter", model: str, messages: list, kwargs: dict):
+        self.router = router
+        self.model = model
+        self.usage: dict = {}
+        self.queue: asyncio.Queue = asyncio.Queue()
+        self.first = asyncio.get_running_loop().create_future()
+        self.task = asyncio.create_task(self._pump(messages, kwargs))
+
+    async def _pump(self, messages: list, kwargs: dict):
+        health = self.router.health(self.model)
+        started = time.monotonic()
+        try:
+            async for delta in self.router.executor.stream(model=self.model, messages=messages, usage=self.usage, **kwargs):
+                if not self.first.done():
+                    health.record_success(time.monotonic() - started, first_token=True)
+                    self.first.set_result(None)
+                self.queue.put_nowait(delta)
+            if not self.first.done():
+                health.record_success(time.monotonic() - started, first_token=True)
+                self.first.set_result(None)
+            ATTEMPTS.inc(model=self.model, outcome="ok")
+            self.queue.put_nowait(_END)
+        except asyncio.CancelledError:
+            ATTEMPTS.inc(model=self.model, outcome="cancelled")
+            health.release()
+            raise
+        except Exception as e:
+            ATTEMPTS.inc(model=self.model, outcome="error")
+            if is_retryable(e):
+                health.record_failure()
+            else:
+                health.release()
+            if not self.first.done():
+                self.first.set_exception(e)
+            else:
+                # 已開始輸出後的錯誤交給讀取端拋出，不再換模型
+                self.queue.put_nowait(e)
+
+    async def deltas(self):
+        while True:
+            item = await self.queue.get()
+            if item is _END:
+                return
+            if isinstance(item, Exception):
+                raise item
+            yield item
+
+    def cancel(self):
+        self.task.cancel()
+        if self.first.done() and not self.first.cancelled():
+            self.first.exception()  # 避免「例外未被讀取」的警告
+
+
+class ModelRouter:
+    """依 allowed_models 建立的補全路由：斷路器、備援鏈與對沖請求
+
+    - 每個模型記錄近期的錯誤率與延遲；錯誤率超過門檻時開啟斷路器，一段時間後以單一請求試探。
+    - 請求失敗 (逾時、限流、5xx) 或模型斷路時，依 fallback_chains 改用下一個模型。
+    - 等待時間超過該模型延遲的 hedge_percentile 分位數時，對較快的模型送出一份相同的請求，
+      先成功者勝出並取消另一個；串流模式以首個 token 的延遲判斷。
+    與 CompletionExecutor 有相同的 complete / stream 介面，另可傳入 route 字典取得實際回答的模型。
+    """
+
+    def __init__(self, executor, config: dict, models: list, fallback_chains: dict = None, hedge_enabled: bool = False,
+                 hedge_percentile: float = 0.95, hedge_min_samples: int = 20, hedge_min_delay: float = 2.0,
+                 hedge_models: dict = None, window: float = 60, failure_threshold: float = 0.5, min_requests: int = 5,
+                 open_seconds: float = 30, latency_samples: int = 200):
+        self.executor = executor
+        self.config = config
+        self.models = list(models)
+        self.fallback_chains = fallback_chains or {}
+        self.hedge_enabled = hedge_enabled
+        self.hedge_percentile = hedge_percentile
+        self.hedge_min_samples = int(hedge_min_samples)
+        self.hedge_min_delay = hedge_min_delay
+        self.hedge_models = hedge_models or {}
+        self._health_options = {"window": window, "failure_threshold": failure_threshold, "min_requests": min_requests,
+                                "open_seconds": open_seconds, "latency_samples": int(latency_samples)}
+        self._health: dict = {}
+
+    @classmethod
+    def from_config(cls, config: dict, executor) -> Optional["ModelRouter"]:
+        """依照 config.json 的 "model_router" 區塊建立路由；停用時返回 None (直接使用執行器)"""
+        options = {**DEFAULT_ROUTER_SETTINGS, **config.get("model_router", {})}
+        if not options["enabled"]:
+            return None
+        return cls(executor, config, config.get("allowed_models", []),
+                   **{key: options[key] for key in DEFAULT_ROUTER_SETTINGS if key != "enabled"})
+
+    def health(self, model: str) -> ModelHealth:
+        health = self._health.get(model)
+        if health is None:
+            health = self._health[model] = ModelHealth(model, **self._health_options)
+        return health
+
+    @property
+    def open_circuits(self) -> int:
+        return sum(1 for health in self._health.values() if health.state != CLOSED)
+
+    def snapshot(self) -> dict:
+        return {model: health.snapshot() for model, health in self._health.items()}
+
+    def chain(self, model: str, messages: list) -> list:
+        """請求的模型加上備援模型；略過上下文預算放不下這次訊息，或訊息含圖片但不支援圖片的備援模型"""
+        fallbacks = self.fallback_chains.get(model)
+        if fallbacks is None:
+            fallbacks = [candidate for candidate in self.models if candidate != model]
+        needed = sum(message_tokens(m["content"]) for m in messages)
+        capable = vision_models(self.config) if has_images(messages) else None
+        return [model] + [candidate for candidate in fallbacks
+                          if candidate != model and (not self.models or candidate in self.models)
+                          and (capable is None or candidate in capable)
+                          and context_budget(self.config, candidate) >= needed]
+
+    def _hedge_delay(self, model: str, first_token: bool) -> Optional[float]:
+        if not self.hedge_enabled:
+            return None
+        threshold = self.health(model).quantile(self.hedge_percentile, first_token, self.hedge_min_samples)
+        return None if threshold is None else max(self.hedge_min_delay, threshold)
+
+    def _hedge_target(self, model: str, chain: list, first_token: bool, tried: set) -> Optional[str]:
+        """挑選對沖用的模型：指定的 hedge_models，否則取備援鏈中中位延遲最低且健康的模型
+
+        tried 為這次請求已經送出過的模型 (例如剛失敗而改用備援的主要模型)，不再對它們重複送出。
+        """
+        if self.executor.waiting:
+            # 執行器已滿載時不再加倍送出請求
+            return None
+        configured = self.hedge_models.get(model)
+        candidates = [configured] if configured else [candidate for candidate in chain if candidate != model]
+        candidates = [candidate for candidate in candidates if candidate not in tried]
+        best, best_latency = None, None
+        for candidate in candidates:
+            health = self.health(candidate)
+            latency = health.quantile(0.5, first_token, self.hedge_min_samples)
+            if health.state != CLOSED or (latency is None and not configured):
+                continue
+            if best is None or (latency is not None and (best_latency is None or latency < best_latency)):
+                best, best_latency = candidate, latency
+        return best
+
+    def _candidates(self, model: str, chain: list):
+        """依序產生可送出的模型；全部斷路時仍以原模型嘗試一次"""
+        tried = False
+        for index, candidate in enumerate(chain):
+            if not self.health(candidate).acquire():
+                continue
+            if index > 0:
+                EVENTS.inc(event="fallback", model=candidate)
+                logger.info(f"模型 {model} 無法使用，改用 {candidate}。")
+            tried = True
+            yield candidate
+        if not tried:
+            yield model
+
+    # --- 一般請求 ---
+    async def _attempt(self, model: str, messages: list, kwargs: dict):
+        health = self.health(model)
+        started = time.monotonic()
+        try:
+            response = await self.executor.complete(model=model, messages=messages, **kwargs)
+        except asyncio.CancelledError:
+            ATTEMPTS.inc(model=model, outcome="cancelled")
+            health.release()
+            raise
+        except Exception as e:
+            ATTEMPTS.inc(model=model, outcome="error")
+            if is_retryable(e):
+                health.record_failure()
+            else:
+                health.release()
+            raise
+        ATTEMPTS.inc(model=model, outcome="ok")
+        health.record_success(time.monotonic() - started)
+        return response
+
+    async def _complete_hedged(self, model: str, chain: list, messages: list, kwargs: dict, tried: set) -> tuple:
+        primary = asyncio.create_task(self._attempt(model, messages, kwargs))
+        delay = self._hedge_delay(model, first_token=False)
+        if delay is None:
+            return await primary, model
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        hedge_model = None if done else self._hedge_target(model, chain, first_token=False, tried=tried)
+        if hedge_model is None or not self.health(hedge_model).acquire():
+            return await primary, model
+
+        tried.add(hedge_model)
+        EVENTS.inc(event="hedge", model=hedge_model)
+        tasks = {primary: model, asyncio.create_task(self._attempt(hedge_model, messages, kwargs)): hedge_model}
+        pending = set(tasks)
+        errors = []
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if tasks[task] != model:
+                            EVENTS.inc(event="hedge_won", model=tasks[task])
+                        return task.result(), tasks[task]
+                    errors.append(task.exception())
+            raise errors[0]
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def complete(self, model: str, messages: list, route: Optional[dict] = None, **kwargs):
+        """送出補全請求並在失敗時依備援鏈改用其他模型；route 會填入實際回答的模型"""
+        chain = self.chain(model, messages)
+        last_error = None
+        tried = set()
+        for candidate in self._candidates(model, chain):
+            tried.add(candidate)
+            try:
+                response, used = await self._complete_hedged(candidate, chain, messages, kwargs, tried)
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                last_error = e
+                continue
+            if route is not None:
+                route["model"] = used
+            return response
+        raise last_error
+
+    # --- 串流請求 ---
+    async def _open_stream_hedged(self, model: str, chain: list, messages: list, kwargs: dict,
+                                  tried: set) -> _StreamAttempt:
+        """開始串流並等到某個請求產生第一段文字；返回勝出的請求"""
+        attempts = [_StreamAttempt(self, model, messages, kwargs)]
+        winner = None
+        try:
+            delay = self._hedge_delay(model, first_token=True)
+            if delay is not None:
+                done, _ = await asyncio.wait({attempts[0].first}, timeout=delay)
+                hedge_model = None if done else self._hedge_target(model, chain, first_token=True, tried=tried)
+                if hedge_model is not None and self.health(hedge_model).acquire():
+                    tried.add(hedge_model)
+                    EVENTS.inc(event="hedge", model=hedge_model)
+                    attempts.append(_StreamAttempt(self, hedge_model, messages, kwargs))
+
+            pending = {attempt.first: attempt for attempt in attempts}
+            errors = []
+            while pending:
+                done, _ = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for future in done:
+                    attempt = pending.pop(future)
+                    if future.exception() is None:
+                        winner = attempt
+                        if attempt.model != model:
+                            EVENTS.inc(event="hedge_won", model=attempt.model)
+                        return winner
+                    errors.append(future.exception())
+            raise errors[0]
+        finally:
+            for attempt in attempts:
+                if attempt is not winner:
+                    attempt.cancel()
+
+    async def stream(self, model: str, messages: list, usage: Optional[dict] = None, route: Optional[dict] = None,
+                     **kwargs):
+        """串流版本的 complete；只在產生第一段文字之前改用其他模型，開始輸出後的錯誤直接拋出"""
+        chain = self.chain(model, messages)
+        last_error = None
+        tried = set()
+        for candidate in self._candidates(model, chain):
+            tried.add(candidate)
+            try:
+                attempt = await self._open_stream_hedged(candidate, chain, messages, kwargs, tried)
+            except Exception as e:
+                if not is_retryable(e):
+                    raise
+                last_error = e
+                continue
+            if route is not None:
+                route["model"] = attempt.model
+            try:
+                async for delta in attempt.deltas():
+                    yield delta
+            finally:
+                attempt.cancel()
+                if usage is not None:
+                    usage.update(attempt.usage)
+            return
+        raise last_error
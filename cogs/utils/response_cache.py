@@ -0,0 +1,117 @@
+import asyncio
+import hashlib
+import json
+import logging
+from typing import Optional
+
+from . import db_manager
+from .cache import LRUCache
+
+logger = logging.getLogger("discord_bot")
+
+# 預設回應快取設定值 (可由 config.json 的 "response_cache" 區塊覆寫)
+DEFAULT_RESPONSE_CACHE_SETTINGS = {
+    "enabled": True,
+    "maxsize": 1024,
+    "ttl": 86400,
+    "persist": True
+}
+
+
+class ResponseCache:
+    """無上下文 (remember_context=False) 提問的內容定址回應快取
+
+    記憶體中為 LRU+TTL，可選擇以 SQLite 跨重啟保存；相同的提問同時進行時只會送出一次上游請求。
+    使用方式：fetch() 返回 None 的呼叫者成為負責計算的一方，完成後必須呼叫 store()，失敗時呼叫 release()。
+    """
+
+    def __init__(self, maxsize: int = 1024, ttl: Optional[float] = 86400, persist: bool = True):
+        self.ttl = ttl
+        self.persist = persist
+        self._memory = LRUCache(maxsize, ttl)
+        self._inflight: dict = {}
+        self._background: set = set()
+        self.lookups = 0
+        self.memory_hits = 0
+        self.persisted_hits = 0
+        self.deduplicated = 0
+
+    @classmethod
+    def from_config(cls, config: dict) -> Optional["ResponseCache"]:
+        """依照 config.json 的 "response_cache" 區塊建立快取；停用時返回 None"""
+        options = {**DEFAULT_RESPONSE_CACHE_SETTINGS, **(config or {})}
+        if not options["enabled"]:
+            return None
+        return cls(options["maxsize"], options["ttl"], options["persist"])
+
+    @staticmethod
+    def make_key(model: str, system_prompt: str, prompt: str) -> str:
+        payload = json.dumps([model, system_prompt, prompt], ensure_ascii=False)
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    async def fetch(self, key: str) -> Optional[str]:
+        """查詢快取；若相同提問正在計算中則等待其結果。返回 None 表示呼叫者需自行計算"""
+        self.lookups += 1
+        while True:
+            text = self._memory.get(key)
+            if text is not None:
+                self.memory_hits += 1
+                return text
+            waiter = self._inflight.get(key)
+            if waiter is None:
+                break
+            text = await asyncio.shield(waiter)
+            if text is not None:
+                self.deduplicated += 1
+                return text
+            # 負責計算的一方失敗了，重新檢查後由自己接手
+
+        self._inflight[key] = asyncio.get_running_loop().create_future()
+        if self.persist:
+            try:
+                text = await db_manager.get_cached_response(key, self.ttl)
+            except Exception as e:
+                logger.warning(f"讀取持久化回應快取失敗：{e}")
+                text = None
+            if text is not None:
+                self.persisted_hits += 1
+                self._memory.set(key, text)
+                self.release(key, text)
+                return text
+        return None
+
+    def store(self, key: str, model: str, text: str):
+        """保存計算結果並喚醒等待中的相同提問"""
+        self._memory.set(key, text)
+        if self.persist:
+            task = asyncio.create_task(self._persist(key, model, text))
+            self._background.add(task)
+            task.add_done_callback(self._background.discard)
+        self.release(key, text)
+
+    def release(self, key: str, text: Optional[str] = None):
+        """結束計算中的狀態；text 為 None 時等待者會自行重新計算"""
+        waiter = self._inflight.pop(key, None)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(text)
+
+    async def _persist(self, key: str, model: str, text: str):
+        try:
+            await db_manager.save_cached_response(key, model, text)
+        except Exception as e:
+            logger.warning(f"寫入持久化回應快取失敗：{e}")
+
+    async def close(self):
+        """等待尚未完成的持久化寫入"""
+        await asyncio.gather(*self._background, return_exceptions=True)
+
+    @property
+    def hit_rate(self) -> float:
+        hits = self.memory_hits + self.persisted_hits + self.deduplicated
+        return hits / self.lookups if self.lookups else 0.0
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._memory), "lookups": self.lookups, "memory_hits": self.memory_hits,
+            "persisted_hits": self.persisted_hits, "deduplicated": self.deduplicated, "hit_rate": self.hit_rate
+        }
@@ -0,0 +1,174 @@
+import asyncio
+import time
+import datetime
+import logging
+from typing import Optional
+
+from . import db_manager
+from . import metrics
+
+logger = logging.getLogger("discord_bot")
+
+# 預設保留政策 (可由 config.json 的 "retention" 區塊覆寫；數值為 0 表示不限制)
+DEFAULT_RETENTION_SETTINGS = {
+    "enabled": True,
+    "interval": 3600,
+    "initial_delay": 300,
+    "max_turns_per_user": 1000,
+    "max_age_days": 365,
+    "max_db_size_mb": 0,
+    "chunk_size": 500,
+    "chunk_pause": 0.05,
+    "max_chunks_per_run": 200,
+    "vacuum_pages": 2000,
+    "convert_auto_vacuum": False
+}
+
+ROWS_DELETED = metrics.registry.counter("retention_rows_deleted_total", "Chat history rows deleted by retention, by policy.")
+RECLAIMED_BYTES = metrics.registry.counter("db_reclaimed_bytes_total", "Bytes returned to the filesystem by incremental vacuum.")
+
+
+class RetentionManager:
+    """定期依保留政策清理 chat_history 的背景維護工作
+
+    每一批刪除都是獨立的短交易，批次之間讓出寫入執行緒，聊天紀錄的寫入緩衝不會被長時間阻擋。
+    scope 為 (分區總數, 分區列表) 時只清理這些分區的使用者 (工作行程模式下由持有快取的工作行程各自清理)，
+    空頁回收則只由負責分區 0 的行程執行。
+    """
+
+    def __init__(self, interval: float = 3600, initial_delay: float = 300, max_turns_per_user: int = 1000,
+                 max_age_days: float = 365, max_db_size_mb: float = 0, chunk_size: int = 500,
+                 chunk_pause: float = 0.05, max_chunks_per_run: int = 200, vacuum_pages: int = 2000,
+                 convert_auto_vacuum: bool = False, scope: Optional[tuple] = None):
+        self.interval = interval
+        self.initial_delay = initial_delay
+        self.max_turns_per_user = int(max_turns_per_user)
+        self.max_age_days = max_age_days
+        self.max_db_size_bytes = int(max_db_size_mb * 1024 * 1024)
+        self.chunk_size = max(1, int(chunk_size))
+        self.chunk_pause = chunk_pause
+        self.max_chunks_per_run = max(1, int(max_chunks_per_run))
+        self.vacuum_pages = int(vacuum_pages)
+        self.convert_auto_vacuum = convert_auto_vacuum
+        self.scope = scope
+        self._worker: Optional[asyncio.Task] = None
+        self._vacuum_hint_logged = False
+        self.last_report: Optional[dict] = None
+
+    @classmethod
+    def from_config(cls, config: dict, scope: Optional[tuple] = None) -> Optional["RetentionManager"]:
+        """依照 config.json 的 "retention" 區塊建立維護工作；停用時返回 None"""
+        options = {**DEFAULT_RETENTION_SETTINGS, **(config or {})}
+        if not options["enabled"]:
+            return None
+        return cls(scope=scope, **{key: options[key] for key in DEFAULT_RETENTION_SETTINGS if key != "enabled"})
+
+    def start(self):
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+
+    async def _run(self):
+        await asyncio.sleep(self.initial_delay)
+        while True:
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"執行資料保留維護時發生錯誤：{e}", exc_info=True)
+            await asyncio.sleep(self.interval)
+
+    async def _purge_in_chunks(self, purge, *args) -> int:
+        """重複執行單批刪除直到沒有可刪的資料或達到本輪上限"""
+        total = 0
+        for _ in range(self.max_chunks_per_run):
+            deleted = await purge(*args)
+            total += deleted
+            if deleted < self.chunk_size:
+                break
+            await asyncio.sleep(self.chunk_pause)
+        return total
+
+    async def run_once(self) -> dict:
+        """依序套用存活時間、每人則數與容量上限，最後回收空頁；返回本輪的清理報告"""
+        started = time.monotonic()
+        size_before = await db_manager.get_database_size()
+        report = {"expired": 0, "over_turn_limit": 0, "over_size_cap": 0, "summaries": 0, "reclaimed_bytes": 0}
+
+        if self.max_age_days:
+            cutoff = datetime.datetime.now() - datetime.timedelta(days=self.max_age_days)
+            report["expired"] = await self._purge_in_chunks(db_manager.purge_history_before, cutoff, self.chunk_size,
+                                                            self.scope)
+            report["summaries"] = await db_manager.purge_orphaned_summaries(cutoff, self.scope)
+
+        if self.max_turns_per_user:
+            for user_id, excess in await db_manager.get_users_over_turn_limit(self.max_turns_per_user, scope=self.scope):
+                while excess > 0:
+                    deleted = await db_manager.purge_user_oldest_turns(user_id, min(excess, self.chunk_size))
+                    report["over_turn_limit"] += deleted
+                    excess = excess - deleted if deleted else 0
+                    await asyncio.sleep(self.chunk_pause)
+
+        if self.max_db_size_bytes:
+            # 以實際使用的頁數 (不含空頁) 判斷是否超過上限，每批刪除後重新量測
+            for _ in range(self.max_chunks_per_run):
+                if (await db_manager.get_database_size())["used_bytes"] <= self.max_db_size_bytes:
+                    break
+                deleted = await db_manager.purge_oldest_history(self.chunk_size, self.scope)
+                report["over_size_cap"] += deleted
+                if not deleted:
+                    logger.warning("資料庫仍超過容量上限，但已沒有可刪除的聊天紀錄。")
+                    break
+                await asyncio.sleep(self.chunk_pause)
+
+        report["reclaimed_bytes"] = await self._vacuum(size_before["auto_vacuum"])
+        size_after = await db_manager.get_database_size()
+        report.update(file_bytes=size_after["file_bytes"], used_bytes=size_after["used_bytes"],
+                      duration=time.monotonic() - started)
+
+        for policy in ("expired", "over_turn_limit", "over_size_cap"):
+            if report[policy]:
+                ROWS_DELETED.inc(report[policy], policy=policy)
+        RECLAIMED_BYTES.inc(report["reclaimed_bytes"])
+        self.last_report = report
+        logger.info(
+            f"資料保留維護完成：過期 {report['expired']} 筆、超出則數 {report['over_turn_limit']} 筆、"
+            f"超出容量 {report['over_size_cap']} 筆、摘要 {report['summaries']} 筆，"
+            f"回收 {report['reclaimed_bytes'] / 1024 / 1024:.1f}MB，"
+            f"目前檔案 {report['file_bytes'] / 1024 / 1024:.1f}MB (耗時 {report['duration']:.1f}s)"
+        )
+        return report
+
+    async def _vacuum(self, auto_vacuum: str) -> int:
+        if self.scope is not None and 0 not in self.scope[1]:
+            return 0
+        if auto_vacuum == "none":
+            if not self.convert_auto_vacuum:
+                if not self._vacuum_hint_logged:
+                    self._vacuum_hint_logged = True
+                    logger.info("資料庫未啟用增量自動清理，刪除後的空間只會被重複使用而不會歸還；"
+                                "可在 retention 設定中啟用 convert_auto_vacuum 進行一次性轉換。")
+                return 0
+            size = await db_manager.get_database_size()
+            logger.warning("正在將資料庫轉換為增量自動清理模式 (完整 VACUUM，期間暫停寫入)...")
+            await db_manager.convert_to_incremental_vacuum()
+            return max(0, size["file_bytes"] - (await db_manager.get_database_size())["file_bytes"])
+        if auto_vacuum != "incremental" or self.vacuum_pages <= 0:
+            return 0
+        # 分批歸還空頁，避免單次長時間持有寫入鎖
+        reclaimed = 0
+        while True:
+            freed = await db_manager.incremental_vacuum(self.vacuum_pages)
+            reclaimed += freed
+            if not freed or (await db_manager.get_database_size())["freelist_count"] == 0:
+                return reclaimed
+            await asyncio.sleep(self.chunk_pause)
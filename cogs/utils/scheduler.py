@@ -0,0 +1,285 @@
+import asyncio
+import time
+import logging
+from collections import deque
+from typing import Awaitable, Callable, Optional
+
+from .cache import LRUCache
+from . import metrics
+
+logger = logging.getLogger("discord_bot")
+
+# 預設排程設定值 (可由 config.json 的 "scheduler" 區塊覆寫)
+DEFAULT_SCHEDULER_SETTINGS = {
+    "max_concurrency": 8,
+    "user_rate": 0.2,
+    "user_burst": 3,
+    "guild_rate": 2.0,
+    "guild_burst": 20,
+    "dm_weight": 2.0,
+    "guild_weights": {},
+    "max_queue_dm": 50,
+    "max_queue_channel": 200,
+    "max_queue_per_flow": 20,
+    "max_wait": 120.0
+}
+
+# 優先權類別
+PRIORITY_DM = "dm"
+PRIORITY_CHANNEL = "channel"
+
+# 准入結果
+ADMITTED = "admitted"
+QUEUED = "queued"
+USER_RATE_LIMITED = "user_rate_limited"
+GUILD_RATE_LIMITED = "guild_rate_limited"
+QUEUE_FULL = "queue_full"
+
+
+class TokenBucket:
+    """權杖桶限流器：每秒補充 rate 個權杖，最多累積 capacity 個"""
+    __slots__ = ("rate", "capacity", "tokens", "updated_at")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def retry_after(self, now: Optional[float] = None) -> float:
+        """取得一個權杖還需等待的秒數 (0 表示現在即可取得)"""
+        now = time.monotonic() if now is None else now
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0.0
+        return (1 - self.tokens) / self.rate if self.rate > 0 else float("inf")
+
+    def consume(self):
+        self.tokens -= 1
+
+
+class ChatJob:
+    """排程中的一則對話請求"""
+    __slots__ = ("user_id", "guild_id", "priority", "handler", "on_expired", "on_start", "enqueued_at")
+
+    def __init__(self, user_id: str, guild_id: Optional[str], handler: Callable[[], Awaitable],
+                 on_start: Optional[Callable[[], Awaitable]] = None,
+                 on_expired: Optional[Callable[[], Awaitable]] = None):
+        self.user_id = user_id
+        self.guild_id = guild_id
+        self.priority = PRIORITY_DM if guild_id is None else PRIORITY_CHANNEL
+        self.handler = handler
+        self.on_start = on_start
+        self.on_expired = on_expired
+        self.enqueued_at = time.monotonic()
+
+    @property
+    def flow_key(self) -> tuple:
+        # 私訊以使用者為單位公平排隊，伺服器頻道以伺服器為單位
+        return (PRIORITY_DM, self.user_id) if self.guild_id is None else (PRIORITY_CHANNEL, self.guild_id)
+
+
+class Admission:
+    """submit() 的結果"""
+    __slots__ = ("status", "retry_after", "position")
+
+    def __init__(self, status: str, retry_after: float = 0.0, position: int = 0):
+        self.status = status
+        self.retry_after = retry_after
+        self.position = position
+
+    @property
+    def accepted(self) -> bool:
+        return self.status in (ADMITTED, QUEUED)
+
+
+class _Flow:
+    __slots__ = ("jobs", "quantum", "deficit")
+
+    def __init__(self, quantum: float):
+        self.jobs = deque()
+        self.quantum = quantum
+        self.deficit = 0.0
+
+
+class FairScheduler:
+    """介於 on_message 與 API 呼叫之間的排程器：使用者/伺服器權杖桶限流 + 跨伺服器加權公平佇列 (DRR)"""
+
+    def __init__(self, max_concurrency: int = 8, user_rate: float = 0.2, user_burst: float = 3,
+                 guild_rate: float = 2.0, guild_burst: float = 20, dm_weight: float = 2.0,
+                 guild_weights: Optional[dict] = None, max_queue_dm: int = 50, max_queue_channel: int = 200,
+                 max_queue_per_flow: int = 20, max_wait: Optional[float] = 120.0):
+        self.max_concurrency = max(1, int(max_concurrency))
+        self.user_rate, self.user_burst = user_rate, user_burst
+        self.guild_rate, self.guild_burst = guild_rate, guild_burst
+        self.dm_weight = float(dm_weight)
+        self.guild_weights = {str(key): float(value) for key, value in (guild_weights or {}).items()}
+        # 權重即 DRR 每輪的配額，為 0 或負數時該佇列永遠無法出列，_next_job 會無限輪轉
+        invalid = {key: value for key, value in self.guild_weights.items() if value <= 0}
+        if self.dm_weight <= 0 or invalid:
+            raise ValueError(f"排程權重必須大於 0 (dm_weight={self.dm_weight}，guild_weights 中的無效值：{invalid})")
+        self.max_queue = {PRIORITY_DM: int(max_queue_dm), PRIORITY_CHANNEL: int(max_queue_channel)}
+        self.max_queue_per_flow = int(max_queue_per_flow)
+        self.max_wait = float(max_wait) if max_wait else None
+
+        self._user_buckets = LRUCache(maxsize=50000)
+        self._guild_buckets = LRUCache(maxsize=10000)
+        self._flows: dict = {}
+        self._active: deque = deque()
+        self._queued = {PRIORITY_DM: 0, PRIORITY_CHANNEL: 0}
+        self._wakeup = asyncio.Condition()
+        self._workers: list = []
+        self._notify_tasks: set = set()
+        self.running = 0
+        self.stats = {ADMITTED: 0, QUEUED: 0, USER_RATE_LIMITED: 0, GUILD_RATE_LIMITED: 0, QUEUE_FULL: 0, "expired": 0}
+
+    @classmethod
+    def from_config(cls, config: dict) -> "FairScheduler":
+        """依照 config.json 的 "scheduler" 區塊建立排程器"""
+        config = config or {}
+        return cls(**{key: config.get(key, default) for key, default in DEFAULT_SCHEDULER_SETTINGS.items()})
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(self._queued.values())
+
+    def queue_depths(self) -> dict:
+        return dict(self._queued)
+
+    @property
+    def idle(self) -> bool:
+        """沒有排隊或執行中的工作 (排空時判斷是否可以安全卸載)"""
+        return self.queue_depth == 0 and self.running == 0
+
+    # --- 准入控制 ---
+    def _bucket(self, cache: LRUCache, key: str, rate: float, burst: float) -> TokenBucket:
+        bucket = cache.get(key)
+        if bucket is None:
+            bucket = TokenBucket(rate, burst)
+            cache.set(key, bucket)
+        return bucket
+
+    def submit(self, job: ChatJob) -> Admission:
+        """嘗試讓一則請求進入排程；被拒絕時返回原因與建議的重試秒數"""
+        now = time.monotonic()
+        user_bucket = self._bucket(self._user_buckets, job.user_id, self.user_rate, self.user_burst)
+        wait = user_bucket.retry_after(now)
+        if wait > 0:
+            return self._reject(USER_RATE_LIMITED, wait)
+
+        guild_bucket = None
+        if job.guild_id is not None:
+            guild_bucket = self._bucket(self._guild_buckets, job.guild_id, self.guild_rate, self.guild_burst)
+            wait = guild_bucket.retry_after(now)
+            if wait > 0:
+                return self._reject(GUILD_RATE_LIMITED, wait)
+
+        flow = self._flows.get(job.flow_key)
+        if self._queued[job.priority] >= self.max_queue[job.priority] or \
+                (flow is not None and len(flow.jobs) >= self.max_queue_per_flow):
+            return self._reject(QUEUE_FULL)
+
+        user_bucket.consume()
+        if guild_bucket is not None:
+            guild_bucket.consume()
+
+        if flow is None:
+            flow = _Flow(self.dm_weight if job.guild_id is None else self.guild_weights.get(job.guild_id, 1.0))
+            self._flows[job.flow_key] = flow
+            self._active.append(job.flow_key)
+        flow.jobs.append(job)
+        self._queued[job.priority] += 1
+
+        # 沒有空閒的工作者時，這則請求需要排隊等待
+        idle_workers = self.max_concurrency - self.running
+        status = ADMITTED if idle_workers > self.queue_depth - 1 else QUEUED
+        self.stats[status] += 1
+        # 保留工作的參照直到完成，避免尚未執行就被垃圾回收
+        task = asyncio.create_task(self._notify())
+        self._notify_tasks.add(task)
+        task.add_done_callback(self._notify_tasks.discard)
+        return Admission(status, position=max(0, self.queue_depth - idle_workers))
+
+    def _reject(self, status: str, retry_after: float = 0.0) -> Admission:
+        self.stats[status] += 1
+        return Admission(status, retry_after=retry_after)
+
+    async def _notify(self):
+        async with self._wakeup:
+            self._wakeup.notify()
+
+    # --- 加權公平佇列 (Deficit Round Robin) ---
+    def _next_job(self) -> Optional[ChatJob]:
+        while self._active:
+            key = self._active[0]
+            flow = self._flows[key]
+            if flow.deficit >= 1:
+                flow.deficit -= 1
+                job = flow.jobs.popleft()
+                self._queued[job.priority] -= 1
+                if not flow.jobs:
+                    self._active.popleft()
+                    del self._flows[key]
+                return job
+            flow.deficit += flow.quantum
+            self._active.rotate(-1)
+        return None
+
+    async def expire_pending(self) -> int:
+        """排空期限已到時取出所有仍在排隊的工作並通知它們已取消，返回取消的數量"""
+        expired = 0
+        job = self._next_job()
+        while job is not None:
+            expired += 1
+            self.stats["expired"] += 1
+            if job.on_expired:
+                try:
+                    await job.on_expired()
+                except Exception as e:
+                    logger.error(f"通知取消的排程工作時發生錯誤 (user {job.user_id})：{e}", exc_info=True)
+            job = self._next_job()
+        return expired
+
+    # --- 工作者 ---
+    def start(self):
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._worker()) for _ in range(self.max_concurrency)]
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def _worker(self):
+        while True:
+            async with self._wakeup:
+                job = self._next_job()
+                while job is None:
+                    await self._wakeup.wait()
+                    job = self._next_job()
+            self.running += 1
+            try:
+                await self._run(job)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"排程工作執行失敗 (user {job.user_id})：{e}", exc_info=True)
+            finally:
+                self.running -= 1
+
+    async def _run(self, job: ChatJob):
+        waited = time.monotonic() - job.enqueued_at
+        metrics.STAGE_SECONDS.observe(waited, stage="queue_wait")
+        if self.max_wait is not None and waited > self.max_wait:
+            self.stats["expired"] += 1
+            if job.on_expired:
+                await job.on_expired()
+            return
+        if job.on_start:
+            await job.on_start()
+        await job.handler()
@@ -0,0 +1,86 @@
+import json
+import time
+import hashlib
+import logging
+from contextlib import contextmanager
+from typing import Optional
+
+from . import db_manager
+from . import metrics
+
+logger = logging.getLogger("discord_bot")
+
+# 上次同步到 Discord 的指令樹雜湊值 (依應用程式 ID 分開記錄)
+COMMAND_SYNC_FILE = "command_sync.json"
+
+STARTUP_SECONDS = metrics.registry.histogram("bot_startup_seconds", "Time spent in each startup or reload phase.")
+
+
+class StartupTimer:
+    """記錄啟動各階段的耗時並寫入日誌，供比較重新啟動與重新載入的速度"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.phases: dict = {}
+        self.ready_after: Optional[float] = None
+
+    @contextmanager
+    def phase(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            self.phases[name] = elapsed
+            STARTUP_SECONDS.observe(elapsed, phase=name)
+            logger.info(f"⏱️ {name}：{elapsed * 1000:.0f}ms")
+
+    def ready(self):
+        """第一次 on_ready 時記錄從啟動到就緒的總時間；之後的重新連線不再記錄"""
+        if self.ready_after is not None:
+            return
+        self.ready_after = time.perf_counter() - self.started
+        STARTUP_SECONDS.observe(self.ready_after, phase="ready")
+        summary = "，".join(f"{name} {elapsed * 1000:.0f}ms" for name, elapsed in self.phases.items())
+        logger.info(f"🚀 啟動完成，共 {self.ready_after:.2f}s ({summary})")
+
+
+def command_tree_hash(tree) -> str:
+    """指令樹內容 (名稱、描述、參數、權限) 的雜湊值，與 Discord 端的定義相同時不需要重新同步"""
+    payload = sorted((command.to_dict(tree) for command in tree.get_commands()), key=lambda command: command["name"])
+    return hashlib.sha256(json.dumps(payload, sort_keys=True, ensure_ascii=False).encode("utf-8")).hexdigest()
+
+
+def _load_sync_state() -> dict:
+    try:
+        with open(db_manager.DATA_DIR / COMMAND_SYNC_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, json.JSONDecodeError):
+        return {}
+
+
+def _save_sync_state(state: dict):
+    db_manager.DATA_DIR.mkdir(parents=True, exist_ok=True)
+    path = db_manager.DATA_DIR / COMMAND_SYNC_FILE
+    temp_path = path.with_suffix(".tmp")
+    with open(temp_path, "w", encoding="utf-8") as f:
+        json.dump(state, f)
+    temp_path.replace(path)
+
+
+async def sync_command_tree(tree, application_id: int, force: bool = False) -> Optional[list]:
+    """指令樹與上次同步的內容不同 (或 force) 時才呼叫 Discord 同步，避免每次重新連線都觸發同步的速率限制
+
+    返回同步後的指令列表；內容未變更而略過時返回 None。
+    """
+    digest = command_tree_hash(tree)
+    state = _load_sync_state()
+    key = str(application_id)
+    if not force and state.get(key) == digest:
+        logger.info("斜線指令未變更，略過同步。")
+        return None
+    synced = await tree.sync()
+    state[key] = digest
+    _save_sync_state(state)
+    logger.info(f"已同步 {len(synced)} 個斜線指令。")
+    return synced
@@ -0,0 +1,82 @@
+import time
+import logging
+from typing import Optional
+
+import discord
+
+from .message_splitter import DISCORD_MESSAGE_LIMIT, take_chunk
+
+logger = logging.getLogger("discord_bot")
+
+PLACEHOLDER = "💭 思考中..."
+CURSOR = " ▌"
+
+
+class StreamingReply:
+    """先送出佔位訊息，隨著 token 到達節流地編輯內容，超過字數上限時於安全切點延續到下一則訊息"""
+
+    def __init__(self, message: discord.Message, edit_interval: float = 1.0, limit: int = DISCORD_MESSAGE_LIMIT):
+        self.source = message
+        self.edit_interval = edit_interval
+        self.limit = limit
+        self.messages: list = []
+        self.text = ""
+        self._prefix = ""
+        self._current = ""
+        self._shown = ""
+        self._last_edit = 0.0
+        self.first_token_at: Optional[float] = None
+
+    async def start(self):
+        """回覆佔位訊息"""
+        self.messages.append(await self.source.reply(PLACEHOLDER))
+        self._last_edit = time.monotonic()
+
+    async def feed(self, delta: str):
+        """加入新產生的文字；必要時換到下一則訊息，並依節流間隔更新畫面"""
+        if self.first_token_at is None:
+            self.first_token_at = time.monotonic()
+        self.text += delta
+        self._current += delta
+        # 預留游標的長度，避免串流中的內容超過上限
+        while len(self._prefix) + len(self._current) + len(CURSOR) > self.limit:
+            await self._roll_over()
+        if time.monotonic() - self._last_edit >= self.edit_interval:
+            await self._render(self._prefix + self._current + CURSOR)
+
+    async def finish(self, empty_text: str = "(空白回應)"):
+        """串流結束，寫入最終內容 (不含游標)"""
+        content = self._prefix + self._current
+        await self._render(content if content.strip() else empty_text)
+
+    async def fail(self, error_text: str):
+        """串流失敗時，在目前的訊息尾端附上錯誤說明"""
+        content = (self._prefix + self._current).strip()
+        note = f"{content}\n\n{error_text}" if content else error_text
+        if len(note) > self.limit:
+            await self._render(content)
+            self.messages.append(await self.source.channel.send(error_text))
+        else:
+            await self._render(note)
+
+    async def _roll_over(self):
+        chunk, rest, prefix = take_chunk(self._current, self._prefix, self.limit)
+        await self._render(chunk)
+        self._prefix, self._current = prefix, rest
+        # 剩餘文字仍超過上限時先送出游標，交由下一輪切割後再更新
+        initial = self._prefix + self._current + CURSOR
+        if len(initial) > self.limit:
+            initial = CURSOR.strip()
+        self.messages.append(await self.source.channel.send(initial))
+        self._shown = initial
+        self._last_edit = time.monotonic()
+
+    async def _render(self, content: str):
+        if content == self._shown:
+            return
+        try:
+            await self.messages[-1].edit(content=content)
+            self._shown = content
+        except discord.HTTPException as e:
+            logger.warning(f"更新串流訊息時發生錯誤：{e}")
+        self._last_edit = time.monotonic()
@@ -0,0 +1,149 @@
+import asyncio
+import logging
+from typing import Optional
+
+from . import db_manager
+
+logger = logging.getLogger("discord_bot")
+
+# 預設摘要設定值 (可由 config.json 的 "summarization" 區塊覆寫)
+DEFAULT_SUMMARIZER_SETTINGS = {
+    "enabled": True,
+    "backend": "openai",
+    "model": "gpt-3.5-turbo",
+    "keep_recent": 20,
+    "min_batch": 10,
+    "max_batch": 40,
+    "max_summary_chars": 2000
+}
+
+SUMMARY_INSTRUCTIONS = (
+    "你是一個對話摘要助手。請將「既有摘要」與「新的對話紀錄」整合成一份精簡的摘要，"
+    "保留使用者的身分、偏好、重要事實與尚未解決的問題，使用與對話相同的語言，不要加入評論。"
+)
+
+
+# --- 摘要後端 ---
+class CompletionSummaryBackend:
+    """透過補全執行器呼叫模型產生摘要"""
+
+    def __init__(self, executor, model: str):
+        self.executor = executor
+        self.model = model
+
+    def has_capacity(self) -> bool:
+        # 低優先權：只在執行器仍有空位且沒有人在排隊時才送出摘要請求
+        return self.executor.waiting == 0 and self.executor.in_flight < self.executor.max_concurrency
+
+    async def summarize(self, previous_summary: Optional[str], turns: list) -> str:
+        transcript = "\n".join(f"{turn['role']}: {turn['content']}" for turn in turns)
+        messages = [
+            {"role": "system", "content": SUMMARY_INSTRUCTIONS},
+            {"role": "user", "content": f"既有摘要：\n{previous_summary or '(無)'}\n\n新的對話紀錄：\n{transcript}"}
+        ]
+        response = await self.executor.complete(model=self.model, messages=messages)
+        return response.choices[0].message.content.strip()
+
+
+class FakeSummaryBackend:
+    """不需網路的本地摘要後端，以截斷串接的方式產生可預測的摘要，供測試與離線環境使用"""
+
+    def __init__(self, max_chars: int = 2000):
+        self.max_chars = max_chars
+        self.calls = 0
+
+    def has_capacity(self) -> bool:
+        return True
+
+    async def summarize(self, previous_summary: Optional[str], turns: list) -> str:
+        self.calls += 1
+        lines = [previous_summary] if previous_summary else []
+        lines += [f"{turn['role']}: {turn['content'][:80]}" for turn in turns]
+        return "\n".join(lines)[-self.max_chars:]
+
+
+def create_backend(options: dict, executor):
+    """依設定建立摘要後端"""
+    if options["backend"] == "fake":
+        return FakeSummaryBackend(options["max_summary_chars"])
+    return CompletionSummaryBackend(executor, options["model"])
+
+
+# --- 背景壓縮 ---
+class ConversationSummarizer:
+    """在請求路徑之外，將使用者較舊的對話摺疊進滾動摘要的低優先權背景佇列"""
+
+    def __init__(self, backend, keep_recent: int = 20, min_batch: int = 10, max_batch: int = 40,
+                 max_summary_chars: int = 2000, idle_delay: float = 1.0):
+        self.backend = backend
+        self.keep_recent = keep_recent
+        self.min_batch = min_batch
+        self.max_batch = max_batch
+        self.max_summary_chars = max_summary_chars
+        self.idle_delay = idle_delay
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._queued: set = set()
+        self._worker: Optional[asyncio.Task] = None
+        self.compactions = 0
+
+    @classmethod
+    def from_config(cls, config: dict, executor) -> Optional["ConversationSummarizer"]:
+        """依照 config.json 的 "summarization" 區塊建立摘要器；停用時返回 None"""
+        options = {**DEFAULT_SUMMARIZER_SETTINGS, **(config or {})}
+        if not options["enabled"]:
+            return None
+        return cls(create_backend(options, executor), keep_recent=options["keep_recent"],
+                   min_batch=options["min_batch"], max_batch=options["max_batch"],
+                   max_summary_chars=options["max_summary_chars"])
+
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    def start(self):
+        if self._worker is None:
+            self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+
+    def notify(self, user_id: str):
+        """對話新增後通知摘要器檢查該使用者；同一使用者在佇列中只會排一次"""
+        if user_id not in self._queued:
+            self._queued.add(user_id)
+            self._queue.put_nowait(user_id)
+
+    async def _run(self):
+        while True:
+            user_id = await self._queue.get()
+            self._queued.discard(user_id)
+            try:
+                while not self.backend.has_capacity():
+                    await asyncio.sleep(self.idle_delay)
+                await self.compact(user_id)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"摘要使用者 {user_id} 的對話時發生錯誤：{e}", exc_info=True)
+
+    async def compact(self, user_id: str) -> bool:
+        """將使用者最新 keep_recent 則之前、尚未摘要的紀錄摺疊進摘要；返回是否有更新"""
+        # 摘要只處理已寫入資料庫 (具有 id) 的紀錄，緩衝中的新紀錄自然被保留為原文
+        summary = await db_manager.get_conversation_summary(user_id)
+        after_id = summary["summarized_until_id"] if summary else 0
+        turns = await db_manager.get_turns_for_compaction(user_id, after_id, self.keep_recent, self.max_batch)
+        if len(turns) < self.min_batch:
+            return False
+
+        new_summary = await self.backend.summarize(summary["summary"] if summary else None, [dict(turn) for turn in turns])
+        saved = await db_manager.save_conversation_summary(user_id, new_summary[:self.max_summary_chars], turns[-1]["id"])
+        if saved:
+            self.compactions += 1
+            logger.info(f"已將使用者 {user_id} 的 {len(turns)} 則舊對話摺疊進摘要。")
+        return saved
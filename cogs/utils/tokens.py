@@ -0,0 +1,57 @@
+import math
+import re
+
+# 每則訊息在 Chat Completions 格式中的固定開銷 (角色標記與分隔符號)
+MESSAGE_OVERHEAD_TOKENS = 4
+
+# 內容中的圖片沒有附帶尺寸時使用的估計值 (1024x1024 以 high 解析度計算為 765)
+IMAGE_PART_TOKENS = {"low": 85, "high": 765, "auto": 765}
+
+# 中日韓文字大約一字一個 token，其餘文字大約四個字元一個 token
+_CJK_PATTERN = re.compile(r"[぀-ヿ㐀-䶿一-鿿가-힯豈-﫿＀-￯]")
+
+
+def estimate_tokens(text: str) -> int:
+    """在本地估算一段文字的 token 數量 (不需呼叫 API 或下載編碼表)"""
+    if not text:
+        return 0
+    cjk_count = len(_CJK_PATTERN.findall(text))
+    other_count = len(text) - cjk_count
+    return cjk_count + math.ceil(other_count / 4)
+
+
+def content_tokens(content) -> int:
+    """訊息內容的 token 數量；內容可以是文字或包含圖片的多段內容列表"""
+    if isinstance(content, list):
+        total = 0
+        for part in content:
+            if part.get("type") == "image_url":
+                total += IMAGE_PART_TOKENS.get(part["image_url"].get("detail", "auto"), IMAGE_PART_TOKENS["auto"])
+            else:
+                total += estimate_tokens(part.get("text", ""))
+        return total
+    return estimate_tokens(content)
+
+
+def message_tokens(content) -> int:
+    """單則訊息 (含格式開銷) 的 token 數量"""
+    return content_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+
+
+def select_within_budget(turns: list, budget: int) -> list:
+    """從最新的對話往回挑選，直到放不下為止；turns 需帶有 "token_count" 欄位，依舊到新排列"""
+    selected = []
+    used = 0
+    for turn in reversed(turns):
+        if used + turn["token_count"] > budget:
+            break
+        used += turn["token_count"]
+        selected.append(turn)
+    selected.reverse()
+    return selected
+
+
+def context_budget(config: dict, model: str) -> int:
+    """依 config.json 的 model_context_budgets 取得模型可用於輸入內容的 token 預算"""
+    budgets = config.get("model_context_budgets", {})
+    return int(budgets.get(model, config.get("default_context_budget", 4000)))
@@ -0,0 +1,161 @@
+import time
+import asyncio
+import logging
+from collections import defaultdict
+from typing import Optional
+
+from . import db_manager
+from . import metrics
+
+logger = logging.getLogger("discord_bot")
+
+# 預設用量帳本設定值 (可由 config.json 的 "usage" 區塊覆寫)；配額為每日 (UTC) token 數，0 表示不限制
+DEFAULT_USAGE_SETTINGS = {
+    "enabled": True,
+    "flush_interval": 10.0,
+    "daily_user_tokens": 0,
+    "daily_guild_tokens": 0,
+    "daily_model_user_tokens": {},
+    "exempt_users": [],
+    "retention_days": 90
+}
+
+QUOTA_REJECTIONS = metrics.registry.counter("usage_quota_rejections_total", "Messages rejected by a daily token quota, by scope.")
+
+
+def today() -> int:
+    """目前的 UTC 紀元日數 (usage_daily.day 的單位)"""
+    return int(time.time() // 86400)
+
+
+class UsageLedger:
+    """每位使用者/伺服器/模型的 token 用量帳本與每日配額
+
+    每次回應只在記憶體中累加 (O(1))，定期把累積的差額以單一交易 upsert 到 usage_daily 每日彙總；
+    配額檢查只查記憶體中的當日計數，不需查詢資料庫。啟動時從當日彙總重建計數。
+    分片為多個行程時各行程只看得到自己的用量 (加上啟動時已寫入的部分)，配額為近似值。
+    """
+
+    def __init__(self, flush_interval: float = 10.0, daily_user_tokens: int = 0, daily_guild_tokens: int = 0,
+                 daily_model_user_tokens: dict = None, exempt_users: list = None, retention_days: int = 90):
+        self.flush_interval = flush_interval
+        self.daily_user_tokens = int(daily_user_tokens or 0)
+        self.daily_guild_tokens = int(daily_guild_tokens or 0)
+        self.daily_model_user_tokens = {model: int(limit) for model, limit in (daily_model_user_tokens or {}).items()}
+        self.exempt_users = {str(user_id) for user_id in (exempt_users or [])}
+        self.retention_days = int(retention_days)
+        self._day = today()
+        # 當日累計 (配額檢查用)
+        self._user_tokens: dict = defaultdict(int)
+        self._guild_tokens: dict = defaultdict(int)
+        self._user_model_tokens: dict = defaultdict(int)
+        # 尚未寫入資料庫的差額：(day, user_id, guild_id, model) → [requests, prompt_tokens, completion_tokens]
+        self._pending: dict = {}
+        self._worker: Optional[asyncio.Task] = None
+
+    @classmethod
+    def from_config(cls, config: dict) -> Optional["UsageLedger"]:
+        """依照 config.json 的 "usage" 區塊建立帳本；停用時返回 None (不記錄也不限制)"""
+        options = {**DEFAULT_USAGE_SETTINGS, **(config or {})}
+        if not options["enabled"]:
+            return None
+        return cls(**{key: options[key] for key in DEFAULT_USAGE_SETTINGS if key != "enabled"})
+
+    @property
+    def pending_count(self) -> int:
+        return len(self._pending)
+
+    async def start(self):
+        """從當日彙總重建配額計數、清除過期彙總並開始定期寫入"""
+        if self._worker is not None:
+            return
+        self._day = today()
+        for user_id, guild_id, model, tokens in await db_manager.get_usage_for_day(self._day):
+            self._count(user_id, guild_id, model, tokens)
+        if self.retention_days:
+            removed = await db_manager.prune_usage(self._day - self.retention_days)
+            if removed:
+                logger.info(f"已清除 {removed} 筆過期的用量彙總。")
+        self._worker = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+        await self.flush()
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"寫入用量彙總時發生錯誤：{e}", exc_info=True)
+
+    async def flush(self) -> int:
+        """把累積的差額寫入每日彙總，返回寫入的列數"""
+        if not self._pending:
+            return 0
+        pending, self._pending = self._pending, {}
+        rows = [(*key, *values) for key, values in pending.items()]
+        try:
+            await db_manager.add_usage(rows)
+        except Exception:
+            # 寫入失敗時把差額放回去，下次一併寫入
+            for key, values in pending.items():
+                merged = self._pending.setdefault(key, [0, 0, 0])
+                for index, value in enumerate(values):
+                    merged[index] += value
+            raise
+        return len(rows)
+
+    def _rollover(self):
+        day = today()
+        if day != self._day:
+            self._day = day
+            self._user_tokens.clear()
+            self._guild_tokens.clear()
+            self._user_model_tokens.clear()
+
+    def _count(self, user_id: str, guild_id: Optional[str], model: str, tokens: int):
+        self._user_tokens[user_id] += tokens
+        self._user_model_tokens[(user_id, model)] += tokens
+        if guild_id is not None:
+            self._guild_tokens[guild_id] += tokens
+
+    def record(self, user_id: str, guild_id: Optional[str], model: str, prompt_tokens: int, completion_tokens: int):
+        """記錄一次回應的用量 (只更新記憶體)"""
+        self._rollover()
+        self._count(user_id, guild_id, model, prompt_tokens + completion_tokens)
+        entry = self._pending.setdefault((self._day, user_id, guild_id, model), [0, 0, 0])
+        entry[0] += 1
+        entry[1] += prompt_tokens
+        entry[2] += completion_tokens
+
+    def used_today(self, user_id: str) -> int:
+        self._rollover()
+        return self._user_tokens.get(user_id, 0)
+
+    def check(self, user_id: str, guild_id: Optional[str], model: str) -> Optional[str]:
+        """檢查每日配額；超過時返回超過的範圍 ("model"、"user" 或 "guild")，否則返回 None"""
+        if user_id in self.exempt_users:
+            return None
+        self._rollover()
+        model_limit = self.daily_model_user_tokens.get(model)
+        if model_limit and self._user_model_tokens.get((user_id, model), 0) >= model_limit:
+            scope = "model"
+        elif self.daily_user_tokens and self._user_tokens.get(user_id, 0) >= self.daily_user_tokens:
+            scope = "user"
+        elif guild_id is not None and self.daily_guild_tokens and \
+                self._guild_tokens.get(guild_id, 0) >= self.daily_guild_tokens:
+            scope = "guild"
+        else:
+            return None
+        QUOTA_REJECTIONS.inc(scope=scope)
+        return scope
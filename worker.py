@@ -0,0 +1,190 @@
+"""LLM 工作行程：從本地工作佇列領取對話工作，呼叫模型並寫回結果
+
+搭配 config.json 的 "workers" 區塊 (enabled 為 true) 使用。bot.py 只負責 Discord 閘道連線與排程，
+把對話工作放進 data/job_queue.db；本程式啟動一組工作行程處理這些工作。工作行程可以單獨重新啟動或部署，
+閘道的 Discord 連線不受影響，重新啟動期間送出的工作會留在佇列中等候。
+
+用法 (於專案根目錄)：
+    python worker.py                    # 依設定啟動 processes 個工作行程並在異常結束時自動重啟
+    python worker.py --index 0 --processes 2   # 只執行其中一個工作行程 (交由 systemd 等外部工具管理)
+"""
+import os
+import sys
+import json
+import time
+import signal
+import asyncio
+import argparse
+import logging
+import multiprocessing
+
+from dotenv import load_dotenv
+
+from cogs.utils import db_manager
+from cogs.utils import metrics
+from cogs.utils.completion import CompletionExecutor
+from cogs.utils.conversation import ConversationEngine
+from cogs.utils.job_queue import DEFAULT_WORKER_SETTINGS, JobQueue, JobWorker
+from cogs.utils.retention import RetentionManager
+from cogs.utils.summarizer import ConversationSummarizer
+
+logger = logging.getLogger("discord_bot")
+
+# 工作行程在這段時間內反覆結束時延後重啟，避免設定錯誤時不斷重試
+RESTART_BACKOFF = (1, 2, 5, 10, 30)
+
+
+def setup_logging(name: str):
+    handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(f'%(asctime)s:%(levelname)s:{name}: %(message)s'))
+    logger.setLevel(logging.INFO)
+    logger.addHandler(handler)
+
+
+def load_config() -> dict:
+    try:
+        with open('config.json', 'r', encoding='utf8') as jfile:
+            return json.load(jfile)
+    except (FileNotFoundError, json.JSONDecodeError) as e:
+        logger.warning(f"⚠️ 無法讀取 config.json ({e})，將使用空設定。")
+        return {}
+
+
+def worker_partitions(partitions: int, index: int, processes: int) -> list:
+    """第 index 個工作行程負責的分區 (分區編號除以行程數的餘數等於 index)"""
+    return [partition for partition in range(partitions) if partition % processes == index]
+
+
+async def run_worker(config: dict, index: int, processes: int):
+    options = {**DEFAULT_WORKER_SETTINGS, **config.get("workers", {})}
+    partitions = worker_partitions(int(options["partitions"]), index, processes)
+    if not partitions:
+        logger.warning(f"工作行程 {index} 沒有分配到任何分區 (partitions={options['partitions']}，processes={processes})。")
+        return
+
+    await db_manager.init_db(config.get("database", {}))
+    completions = CompletionExecutor.from_config(config.get("openai", {}))
+    summarizer = ConversationSummarizer.from_config(config.get("summarization", {}), completions)
+    conversation = ConversationEngine(config, completions, summarizer)
+    # 對話視窗與摘要快取在工作行程中，保留政策也由工作行程各自清理自己分區的使用者，刪除後才能讓快取失效
+    retention = RetentionManager.from_config(config.get("retention", {}), scope=(int(options["partitions"]), partitions))
+    queue = JobQueue(JobQueue.default_path())
+
+    async def handle_chat(payload: dict) -> dict:
+        usage = {}
+        reply = await conversation.complete(payload["user_id"], payload["prompt"], payload["settings"],
+                                            payload.get("channel_context"), payload.get("images"), usage, payload["job_id"])
+        return {"reply": reply, "usage": usage}
+
+    async def handle_clear_history(payload: dict) -> dict:
+        await db_manager.clear_user_history_in_db(payload["user_id"])
+        return {}
+
+    worker = JobWorker.from_config(options, queue, f"worker-{index}", partitions,
+                                   {"chat": handle_chat, "clear_history": handle_clear_history})
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        try:
+            loop.add_signal_handler(sig, worker.request_stop)
+        except (NotImplementedError, RuntimeError):
+            pass
+
+    metrics_runner = None
+    metrics_config = config.get("metrics", {})
+    if metrics_config.get("http_enabled", False):
+        # 每個工作行程使用閘道指標連接埠之後的連接埠
+        metrics_runner = await metrics.start_http_server(metrics_config.get("host", "127.0.0.1"),
+                                                         int(metrics_config.get("port", 9108)) + 1 + index)
+    if summarizer:
+        summarizer.start()
+    if retention:
+        retention.start()
+    try:
+        await worker.run(drain_timeout=config.get("lifecycle", {}).get("drain_timeout", 25))
+    finally:
+        if retention:
+            await retention.stop()
+        if summarizer:
+            await summarizer.stop()
+        await completions.aclose()
+        await queue.close()
+        await db_manager.close_db()
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        logger.info(f"工作行程 {index} 已停止。")
+
+
+def _worker_main(index: int, processes: int):
+    if not logger.handlers:
+        setup_logging(f"worker-{index}")
+    load_dotenv()
+    asyncio.run(run_worker(load_config(), index, processes))
+
+
+def supervise(processes: int):
+    """啟動並看管所有工作行程；非正常結束的工作行程會在退避後重新啟動"""
+    context = multiprocessing.get_context("spawn")
+    children = {}
+    failures = {index: 0 for index in range(processes)}
+    stopping = False
+
+    def spawn(index: int):
+        process = context.Process(target=_worker_main, args=(index, processes), name=f"worker-{index}")
+        process.start()
+        children[index] = (process, time.monotonic())
+        logger.info(f"已啟動工作行程 {index} (PID {process.pid})。")
+
+    def handle_stop(sig, frame):
+        nonlocal stopping
+        stopping = True
+        for process, _ in children.values():
+            if process.is_alive():
+                process.terminate()
+
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, handle_stop)
+
+    for index in range(processes):
+        spawn(index)
+    while not stopping:
+        time.sleep(1)
+        for index, (process, started) in list(children.items()):
+            if process.is_alive() or stopping:
+                continue
+            # 持續運作超過一分鐘後才結束的視為偶發錯誤，重新計算退避
+            failures[index] = 0 if time.monotonic() - started > 60 else failures[index] + 1
+            delay = RESTART_BACKOFF[min(failures[index], len(RESTART_BACKOFF) - 1)]
+            logger.warning(f"工作行程 {index} 已結束 (代碼 {process.exitcode})，{delay} 秒後重新啟動。")
+            time.sleep(delay)
+            if not stopping:
+                spawn(index)
+    for process, _ in children.values():
+        process.join()
+    logger.info("所有工作行程已停止。")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="對話工作行程")
+    parser.add_argument("--index", type=int, default=None, help="只執行第 index 個工作行程 (不啟動看管程式)")
+    parser.add_argument("--processes", type=int, default=None, help="工作行程總數 (預設為設定檔的 workers.processes)")
+    args = parser.parse_args(argv)
+    setup_logging("supervisor" if args.index is None else f"worker-{args.index}")
+
+    load_dotenv()
+    config = load_config()
+    options = {**DEFAULT_WORKER_SETTINGS, **config.get("workers", {})}
+    processes = max(1, int(args.processes or os.getenv("WORKER_PROCESSES") or options["processes"]))
+    if not options["enabled"]:
+        # 未啟用時閘道自行處理對話，工作行程沒有工作可做，直接結束而不是空等
+        logger.warning("⚠️ config.json 的 workers.enabled 為 false，閘道不會把工作送進佇列；工作行程不啟動。")
+        return
+    if args.index is not None:
+        if not 0 <= args.index < processes:
+            sys.exit(f"--index 必須介於 0 與 {processes - 1} 之間")
+        _worker_main(args.index, processes)
+    else:
+        supervise(processes)
+
+
+if __name__ == "__main__":
+    main()